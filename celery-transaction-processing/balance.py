@@ -0,0 +1,155 @@
+from typing import Final, Optional
+
+from redis import Redis as Dragonfly
+from redis.asyncio import Redis as AsyncDragonfly
+from redis.exceptions import ResponseError
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import metrics
+import models
+
+# Transaction IDs are allocated from this counter, since the transactions are inserted into the database later.
+TXN_ID_SEQUENCE_KEY: Final[str] = "user_account_transaction_id_sequence"
+# Debited transactions waiting to be persisted to the database, consumed by the write-behind worker.
+TXN_WRITE_BEHIND_STREAM_KEY: Final[str] = "user_account_transaction_write_behind"
+TXN_WRITE_BEHIND_GROUP: Final[str] = "write_behind"
+
+counters = metrics.Counters('balance_ledger')
+
+
+def available_balance_key(user_account_id: int) -> str:
+    return f"user_account_available_balance:{user_account_id}"
+
+
+# Keeps the available balance of each user account in Dragonfly, so that creating a transaction
+# does not need the per-account lock or a database commit.
+#
+# The balance check, the debit, the transaction ID allocation, and the enqueue of the transaction record
+# run in a single Lua script, which Dragonfly executes atomically. Concurrent transactions of the same account
+# are serialized by Dragonfly, instead of being rejected by the lock.
+# The write-behind worker ('tasks.persist_debited_transactions') inserts the enqueued transactions
+# and applies the debits to the database in batches.
+#
+# The balance of an account is loaded from the database on first use, and Dragonfly is the source of truth
+# for the available balance from then on. Thus, the available balance must not be updated in the database directly
+# while this mode is on, and the keys of this module should be deleted when switching modes.
+class BalanceLedger:
+    # KEYS[1]: the available balance of the user account
+    # KEYS[2]: the transaction ID sequence
+    # KEYS[3]: the write-behind stream
+    # ARGV[1]: the total amount to debit
+    # ARGV[2...]: the fields of the transaction record
+    #
+    # Returns the allocated transaction ID, or one of the negative results below.
+    # DECRBY is used for the check, since Lua numbers are doubles and cannot compare large Wei amounts exactly,
+    # while the sign of the result is always exact.
+    __DEBIT_SCRIPT: Final[str] = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return -2
+end
+if redis.call('DECRBY', KEYS[1], ARGV[1]) < 0 then
+    redis.call('INCRBY', KEYS[1], ARGV[1])
+    return 0
+end
+local txn_id = redis.call('INCR', KEYS[2])
+redis.call('XADD', KEYS[3], '*', 'id', txn_id, unpack(ARGV, 2))
+return txn_id
+"""
+    __DEBIT_INSUFFICIENT_BALANCE: Final[int] = 0
+    __DEBIT_BALANCE_NOT_LOADED: Final[int] = -1
+    __DEBIT_SEQUENCE_NOT_LOADED: Final[int] = -2
+
+    def __init__(self, df: AsyncDragonfly):
+        self.df = df
+        self.__debit_script = df.register_script(self.__DEBIT_SCRIPT)
+
+    # Returns the available balance of the user account, or None if the user account does not exist.
+    async def get_available_balance(self, db: AsyncSession, user_account_id: int) -> Optional[int]:
+        balance = await self.df.get(available_balance_key(user_account_id))
+        if balance is None:
+            if not await self.__load_balance(db, user_account_id):
+                return None
+            balance = await self.df.get(available_balance_key(user_account_id))
+        return int(balance)
+
+    # Debit the total amount from the available balance, and enqueue the transaction for the write-behind worker.
+    # Returns the allocated transaction ID, or None if the available balance is insufficient.
+    async def debit(
+            self,
+            db: AsyncSession,
+            txn: models.UserAccountTransaction,
+            total_amount_in_wei: int,
+    ) -> Optional[int]:
+        keys = [available_balance_key(txn.user_account_id), TXN_ID_SEQUENCE_KEY, TXN_WRITE_BEHIND_STREAM_KEY]
+        args = [total_amount_in_wei, *_txn_to_fields(txn)]
+        while True:
+            result = int(await self.__debit_script(keys=keys, args=args))
+            if result == self.__DEBIT_BALANCE_NOT_LOADED:
+                if not await self.__load_balance(db, txn.user_account_id):
+                    return None
+            elif result == self.__DEBIT_SEQUENCE_NOT_LOADED:
+                await self.__load_sequence(db)
+            elif result == self.__DEBIT_INSUFFICIENT_BALANCE:
+                counters.incr('insufficient_balance')
+                return None
+            else:
+                counters.incr('debited')
+                return result
+
+    async def __load_balance(self, db: AsyncSession, user_account_id: int) -> bool:
+        user_account = await db.get(models.UserAccount, user_account_id)
+        if user_account is None:
+            return False
+        await self.df.set(available_balance_key(user_account_id), user_account.available_balance_in_wei, nx=True)
+        counters.incr('balance_loaded')
+        return True
+
+    # Start the sequence after the largest transaction ID in the database.
+    async def __load_sequence(self, db: AsyncSession):
+        max_txn_id = await db.scalar(select(func.max(models.UserAccountTransaction.id)))
+        await self.df.set(TXN_ID_SEQUENCE_KEY, max_txn_id or 0, nx=True)
+
+
+_TXN_FIELDS: Final[tuple] = (
+    "user_account_id",
+    "transaction_hash",
+    "from_public_address",
+    "to_public_address",
+    "transaction_amount_in_wei",
+    "transaction_fee_total_in_wei",
+)
+
+
+def _txn_to_fields(txn: models.UserAccountTransaction) -> list:
+    fields = []
+    for name in _TXN_FIELDS:
+        fields.extend([name, getattr(txn, name)])
+    return fields
+
+
+# Convert a write-behind stream entry back to a pending transaction.
+def stream_entry_to_txn(entry: dict) -> models.UserAccountTransaction:
+    return models.UserAccountTransaction(
+        id=int(entry[b"id"]),
+        user_account_id=int(entry[b"user_account_id"]),
+        transaction_hash=entry[b"transaction_hash"].decode(),
+        from_public_address=entry[b"from_public_address"].decode(),
+        to_public_address=entry[b"to_public_address"].decode(),
+        transaction_amount_in_wei=int(entry[b"transaction_amount_in_wei"]),
+        transaction_fee_total_in_wei=int(entry[b"transaction_fee_total_in_wei"]),
+        transaction_fee_blockchain_in_wei=0,
+        status=models.UserAccountTransactionStatus.PENDING,
+    )
+
+
+def ensure_write_behind_group(df: Dragonfly):
+    try:
+        df.xgroup_create(TXN_WRITE_BEHIND_STREAM_KEY, TXN_WRITE_BEHIND_GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        # The group already exists.
+        if "BUSYGROUP" not in str(e):
+            raise
@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+from eth_account import Account
+from redis.asyncio import Redis as AsyncDragonfly
+from sqlalchemy import create_engine, insert
+
+import load_test
+import models
+import utils
+
+# An end-to-end benchmark of the whole service on a single machine.
+#
+# It starts a local chain stub ('chain_stub.py'), the API server, a Celery worker, and the Celery beat scheduler
+# against a fresh SQLite database with '--accounts' seeded user accounts. Then it drives a mixed create/get workload
+# with 'load_test.py', and waits for the created transactions to be reconciled.
+# The report is printed as JSON (and written to '--output'), so that it can be compared across changes:
+#   - Requests per second and p50/p95/p99 latencies of each endpoint.
+#   - Celery queue depth, sampled every second during the run.
+#   - Reconciliation lag: from the creation of a transaction to its settlement on the status stream.
+#
+# Dragonfly must be running. The selected Dragonfly database is flushed before the run,
+# so use a database that nothing else uses:
+#   python benchmark.py --dragonfly-url redis://localhost:6380/15 --accounts 1000 --duration 30
+
+SERVICE_START_TIMEOUT_SECONDS = 30
+SAMPLE_INTERVAL_SECONDS = 1.0
+# The Celery queues (see 'tasks.py'), and the sorted sets of the reconciliation.
+CELERY_QUEUES = ["celery", "reconcile_first", "reconcile_retry_short", "reconcile_retry_long"]
+RECONCILE_RETRY_DELAY_QUEUE_KEY = "reconcile_transaction_retries"
+SEED_BALANCE_IN_WEI = 10 ** 18
+SEED_BATCH_SIZE = 10000
+
+
+# The tables are recreated, so that a run with the same '--workdir' starts from a fresh database too.
+def _seed_database(database_url: str, accounts: int):
+    engine = create_engine(database_url)
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for start in range(1, accounts + 1, SEED_BATCH_SIZE):
+            conn.execute(insert(models.UserAccount), [
+                {
+                    "id": i,
+                    "available_balance_in_wei": SEED_BALANCE_IN_WEI,
+                    "current_balance_in_wei": SEED_BALANCE_IN_WEI,
+                }
+                for i in range(start, min(start + SEED_BATCH_SIZE, accounts + 1))
+            ])
+    engine.dispose()
+
+
+def _service_env(args: argparse.Namespace, database_url: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "DF_DRAGONFLY_URL": args.dragonfly_url,
+        "DF_CELERY_BROKER_URL": args.dragonfly_url,
+        "DF_CELERY_BACKEND_URL": args.dragonfly_url,
+        "DF_DATABASE_URL": database_url,
+        "DF_WEB3_PROVIDER_URI": f"http://127.0.0.1:{args.chain_port}",
+        "DF_RECONCILE_MODE": args.reconcile_mode,
+        "DF_BALANCE_MODE": args.balance_mode,
+    })
+    # A throwaway system account, since the chain stub does not check balances.
+    if "DF_SYSTEM_ACCOUNT_PRIVATE_KEY" not in env and "DF_SYSTEM_ACCOUNT_PRIVATE_KEYS" not in env:
+        env["DF_SYSTEM_ACCOUNT_PRIVATE_KEY"] = Account.create().key.hex()
+    return env
+
+
+def _start_services(args: argparse.Namespace, env: Dict[str, str], workdir: str) -> List[subprocess.Popen]:
+    python = sys.executable
+    commands = [
+        [python, "chain_stub.py", "--port", str(args.chain_port),
+         "--latency-ms", str(args.chain_latency_ms), "--block-time", str(args.block_time)],
+        [python, "-m", "uvicorn", "main:api_app", "--port", str(args.api_port),
+         "--workers", str(args.api_workers), "--log-level", "warning"],
+        [python, "-m", "celery", "-A", "tasks", "worker", "--loglevel", "WARNING",
+         "--concurrency", str(args.celery_concurrency)],
+        [python, "-m", "celery", "-A", "tasks", "beat", "--loglevel", "WARNING",
+         "--schedule", os.path.join(workdir, "celerybeat-schedule")],
+    ]
+    log = open(os.path.join(workdir, "services.log"), "w")
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    return [subprocess.Popen(command, env=env, cwd=cwd, stdout=log, stderr=subprocess.STDOUT) for command in commands]
+
+
+def _stop_services(processes: List[subprocess.Popen]):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def _wait_for_api(base_url: str):
+    deadline = time.monotonic() + SERVICE_START_TIMEOUT_SECONDS
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/metrics")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    raise TimeoutError(f"API server did not start in {SERVICE_START_TIMEOUT_SECONDS} seconds")
+
+
+class _Sampler:
+    def __init__(self, df: AsyncDragonfly):
+        self.df = df
+        self.celery_queue_depths: Dict[str, List[int]] = {queue: [] for queue in CELERY_QUEUES}
+        self.pending_set_sizes: List[int] = []
+        self.retry_delay_queue_sizes: List[int] = []
+
+    async def run(self):
+        while True:
+            pipe = self.df.pipeline(transaction=False)
+            for queue in CELERY_QUEUES:
+                pipe.llen(queue)
+            pipe.zcard(utils.PENDING_TXN_KEY)
+            pipe.zcard(RECONCILE_RETRY_DELAY_QUEUE_KEY)
+            *celery_queue_depths, pending_set_size, retry_delay_queue_size = await pipe.execute()
+            for queue, depth in zip(CELERY_QUEUES, celery_queue_depths):
+                self.celery_queue_depths[queue].append(depth)
+            self.pending_set_sizes.append(pending_set_size)
+            self.retry_delay_queue_sizes.append(retry_delay_queue_size)
+            await asyncio.sleep(SAMPLE_INTERVAL_SECONDS)
+
+    def report(self) -> dict:
+        def summary(values: List[int]) -> dict:
+            if not values:
+                return {"max": 0, "mean": 0.0}
+            return {"max": max(values), "mean": round(sum(values) / len(values), 2)}
+
+        return {
+            "celery_queue_depth": {queue: summary(depths) for queue, depths in self.celery_queue_depths.items()},
+            "pending_set_size": summary(self.pending_set_sizes),
+            "retry_delay_queue_size": summary(self.retry_delay_queue_sizes),
+        }
+
+
+# Settled transactions are appended to the status stream, and the stream entry ID starts with the Unix time in ms.
+async def _read_settled_at(df: AsyncDragonfly) -> Dict[int, float]:
+    settled_at = {}
+    last_id = "-"
+    while True:
+        entries = await df.xrange(utils.TXN_STATUS_STREAM_KEY, min=last_id, count=10000)
+        if last_id != "-":
+            entries = entries[1:]
+        if not entries:
+            return settled_at
+        for entry_id, fields in entries:
+            settled_at.setdefault(int(fields[b"id"]), int(entry_id.split(b"-")[0]) / 1000)
+        last_id = entries[-1][0]
+
+
+async def _wait_for_reconciliation(df: AsyncDragonfly, created_at: Dict[int, float], timeout: float) -> dict:
+    deadline = time.monotonic() + timeout
+    settled_at = await _read_settled_at(df)
+    while time.monotonic() < deadline and not created_at.keys() <= settled_at.keys():
+        await asyncio.sleep(SAMPLE_INTERVAL_SECONDS)
+        settled_at = await _read_settled_at(df)
+
+    lags = sorted(settled_at[txn_id] - t for txn_id, t in created_at.items() if txn_id in settled_at)
+    return {
+        "created": len(created_at),
+        "settled": len(lags),
+        "unsettled": len(created_at) - len(lags),
+        "lag_p50_seconds": round(load_test.percentile(lags, 50), 3),
+        "lag_p95_seconds": round(load_test.percentile(lags, 95), 3),
+        "lag_p99_seconds": round(load_test.percentile(lags, 99), 3),
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    database_url = f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+    _seed_database(database_url, args.accounts)
+
+    df = AsyncDragonfly.from_url(args.dragonfly_url)
+    await df.flushdb()
+
+    sampler = _Sampler(df)
+    sampler_task = None
+    processes = _start_services(args, _service_env(args, database_url), workdir)
+    try:
+        base_url = f"http://127.0.0.1:{args.api_port}"
+        await _wait_for_api(base_url)
+
+        sampler_task = asyncio.create_task(sampler.run())
+        load_args = argparse.Namespace(
+            base_url=base_url,
+            concurrency=args.concurrency,
+            duration=args.duration,
+            timeout=args.timeout,
+            get_ratio=args.get_ratio,
+            min_user_account_id=1,
+            max_user_account_id=args.accounts,
+            max_txn_id=args.accounts,
+            to_public_address=load_test.DEFAULT_TO_PUBLIC_ADDRESS,
+            transaction_amount_in_wei=1000,
+        )
+        load_report, created_at = await load_test.run_with_created_at(load_args)
+        reconciliation = await _wait_for_reconciliation(df, created_at, args.drain_timeout)
+    finally:
+        if sampler_task is not None:
+            sampler_task.cancel()
+        _stop_services(processes)
+        await df.aclose()
+
+    return {
+        "config": {
+            "accounts": args.accounts,
+            "concurrency": args.concurrency,
+            "duration_seconds": args.duration,
+            "get_ratio": args.get_ratio,
+            "reconcile_mode": args.reconcile_mode,
+            "balance_mode": args.balance_mode,
+            "api_workers": args.api_workers,
+            "celery_concurrency": args.celery_concurrency,
+            "chain_latency_ms": args.chain_latency_ms,
+            "block_time_seconds": args.block_time,
+        },
+        "load": load_report,
+        "queues": sampler.report(),
+        "reconciliation": reconciliation,
+        "workdir": workdir,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the service end to end with a local chain stub.")
+    parser.add_argument("--dragonfly-url", default="redis://localhost:6380/15", help="flushed before the run")
+    parser.add_argument("--workdir", default=None, help="directory for the database and logs (default: a temp dir)")
+    parser.add_argument("--output", default=None, help="also write the JSON report to this file")
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30.0, help="load duration in seconds")
+    parser.add_argument("--timeout", type=float, default=30.0, help="per-request timeout in seconds")
+    parser.add_argument("--get-ratio", type=float, default=0.8, help="fraction of requests that are GETs")
+    parser.add_argument("--drain-timeout", type=float, default=60.0, help="seconds to wait for reconciliation")
+    # The per-transaction tasks retry after 100 seconds at the earliest, so the lag is long in task mode.
+    parser.add_argument("--reconcile-mode", choices=["task", "batch"], default="batch")
+    parser.add_argument("--balance-mode", choices=["sql", "dragonfly"], default="sql")
+    parser.add_argument("--api-port", type=int, default=8100)
+    parser.add_argument("--api-workers", type=int, default=1)
+    parser.add_argument("--celery-concurrency", type=int, default=4)
+    parser.add_argument("--chain-port", type=int, default=8545)
+    parser.add_argument("--chain-latency-ms", type=float, default=20.0)
+    parser.add_argument("--block-time", type=float, default=0.2, help="seconds between blocks of the chain stub")
+    return parser.parse_args()
+
+
+def main(args: argparse.Namespace):
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,169 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+from eth_account import Account
+from eth_utils import keccak
+
+# A local stand-in for an Ethereum JSON-RPC node, for benchmarks and local runs without Sepolia.
+#
+# It accepts any signed transaction without checking balances, mines it in the next block,
+# and produces blocks at a fixed interval. Every request can be delayed to simulate a remote node provider.
+# Only the methods used by this service are implemented, and JSON-RPC batch requests are supported.
+#
+#   python chain_stub.py --port 8545 --latency-ms 50 --block-time 0.2
+#   DF_WEB3_PROVIDER_URI=http://localhost:8545 uvicorn main:api_app
+
+GAS_USED = 21000
+EFFECTIVE_GAS_PRICE = 1500000000
+ZERO_HASH = "0x" + "00" * 32
+
+
+class Chain:
+    def __init__(self, chain_id: int, block_time: float):
+        self.chain_id = chain_id
+        self.block_time = block_time
+        self.started_at = time.monotonic()
+        self.__lock = threading.Lock()
+        self.__transactions: Dict[str, dict] = {}
+        self.__transaction_counts: Dict[str, int] = {}
+
+    def block_number(self) -> int:
+        return int((time.monotonic() - self.started_at) / self.block_time)
+
+    def send_raw_transaction(self, raw_transaction: str) -> str:
+        raw = bytes.fromhex(raw_transaction.removeprefix("0x"))
+        tx_hash = "0x" + keccak(raw).hex()
+        sender = Account.recover_transaction(raw)
+        with self.__lock:
+            if tx_hash not in self.__transactions:
+                self.__transactions[tx_hash] = {
+                    "from": sender,
+                    "blockNumber": self.block_number() + 1,
+                    "nonce": self.__transaction_counts.get(sender, 0),
+                }
+                self.__transaction_counts[sender] = self.__transaction_counts.get(sender, 0) + 1
+        return tx_hash
+
+    def transaction_count(self, address: str) -> int:
+        with self.__lock:
+            return self.__transaction_counts.get(address, 0)
+
+    def mined_transaction(self, tx_hash: str) -> Optional[dict]:
+        with self.__lock:
+            txn = self.__transactions.get(tx_hash)
+        if txn is None or txn["blockNumber"] > self.block_number():
+            return None
+        return txn
+
+    def receipt(self, tx_hash: str) -> Optional[dict]:
+        txn = self.mined_transaction(tx_hash)
+        if txn is None:
+            return None
+        return {
+            "transactionHash": tx_hash,
+            "transactionIndex": "0x0",
+            "blockHash": ZERO_HASH,
+            "blockNumber": hex(txn["blockNumber"]),
+            "from": txn["from"],
+            "to": None,
+            "cumulativeGasUsed": hex(GAS_USED),
+            "gasUsed": hex(GAS_USED),
+            "effectiveGasPrice": hex(EFFECTIVE_GAS_PRICE),
+            "contractAddress": None,
+            "logs": [],
+            "logsBloom": "0x" + "00" * 256,
+            "status": "0x1",
+            "type": "0x2",
+        }
+
+    def transaction(self, tx_hash: str) -> Optional[dict]:
+        txn = self.mined_transaction(tx_hash)
+        if txn is None:
+            return None
+        return {
+            "hash": tx_hash,
+            "nonce": hex(txn["nonce"]),
+            "blockHash": ZERO_HASH,
+            "blockNumber": hex(txn["blockNumber"]),
+            "transactionIndex": "0x0",
+            "from": txn["from"],
+            "to": None,
+            "value": "0x0",
+            "gas": hex(GAS_USED),
+            "gasPrice": hex(EFFECTIVE_GAS_PRICE),
+            "input": "0x",
+            "type": "0x2",
+        }
+
+    def call(self, method: str, params: list):
+        if method == "eth_chainId":
+            return hex(self.chain_id)
+        if method == "net_version":
+            return str(self.chain_id)
+        if method == "eth_blockNumber":
+            return hex(self.block_number())
+        if method == "eth_getTransactionCount":
+            return hex(self.transaction_count(params[0]))
+        if method == "eth_sendRawTransaction":
+            return self.send_raw_transaction(params[0])
+        if method == "eth_getTransactionReceipt":
+            return self.receipt(params[0])
+        if method == "eth_getTransactionByHash":
+            return self.transaction(params[0])
+        raise ValueError(f"method '{method}' is not supported")
+
+
+def _handle_call(chain: Chain, request: dict) -> dict:
+    try:
+        result = chain.call(request["method"], request.get("params", []))
+        return {"jsonrpc": "2.0", "id": request.get("id"), "result": result}
+    except Exception as e:
+        return {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": -32000, "message": str(e)}}
+
+
+def make_handler(chain: Chain, latency_seconds: float):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if latency_seconds > 0:
+                time.sleep(latency_seconds)
+            if isinstance(body, list):
+                response = [_handle_call(chain, request) for request in body]
+            else:
+                response = _handle_call(chain, body)
+            data = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *_args):
+            pass
+
+    return Handler
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for an Ethereum JSON-RPC node.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8545)
+    parser.add_argument("--chain-id", type=int, default=11155111)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay added to every request")
+    parser.add_argument("--block-time", type=float, default=1.0, help="seconds between blocks")
+    return parser.parse_args()
+
+
+def main(args: argparse.Namespace):
+    chain = Chain(args.chain_id, args.block_time)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(chain, args.latency_ms / 1000))
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,227 @@
+import dataclasses
+import functools
+import re
+import struct
+from abc import ABC, abstractmethod
+from typing import Dict, Final, Optional, Union
+
+import msgpack
+from eth_utils import to_checksum_address
+
+import models
+import utils
+
+# Cache codecs for transactions.
+#
+# A codec decides how a transaction is laid out in Dragonfly: the key, the data type, and the encoding.
+# The commands are queued in pipelines (sync or async), so that reads and writes of many entries can be batched.
+#
+# A cache read results in one of the three cases below:
+#   - None: cache miss.
+#   - CACHE_EMPTY: the transaction is known not to exist (an empty value is cached to prevent cache penetrations).
+#   - TransactionResponse: cache hit.
+#
+# Empty values are only written if the key does not exist. In the 'dragonfly' balance mode, a new transaction
+# is only in the cache until the write-behind worker inserts it, and a concurrent read that finds no row
+# must not replace it with an empty value.
+CACHE_EMPTY: Final[object] = object()
+
+DecodedTransaction = Union[None, object, utils.TransactionResponse]
+
+
+class TransactionCacheCodec(ABC):
+    name: str = ""
+
+    @abstractmethod
+    def key(self, txn_id: int) -> str:
+        ...
+
+    @abstractmethod
+    def queue_read(self, pipe, txn_id: int):
+        ...
+
+    @abstractmethod
+    def queue_write(self, pipe, txn: utils.TransactionResponse, expiration: int):
+        ...
+
+    @abstractmethod
+    def queue_write_empty(self, pipe, txn_id: int, expiration: int):
+        ...
+
+    @abstractmethod
+    def decode(self, raw) -> DecodedTransaction:
+        ...
+
+    async def async_read(self, df, txn_id: int) -> DecodedTransaction:
+        pipe = df.pipeline(transaction=False)
+        self.queue_read(pipe, txn_id)
+        raw, = await pipe.execute()
+        return self.decode(raw)
+
+    async def async_write(self, df, txn: utils.TransactionResponse, expiration: int):
+        pipe = df.pipeline(transaction=False)
+        self.queue_write(pipe, txn, expiration)
+        await pipe.execute()
+
+    async def async_write_empty(self, df, txn_id: int, expiration: int):
+        pipe = df.pipeline(transaction=False)
+        self.queue_write_empty(pipe, txn_id, expiration)
+        await pipe.execute()
+
+
+# A hash with one field per column, and decimal strings as values.
+# Readable with 'HGETALL', but takes much more memory than the packed codec.
+class HashTransactionCodec(TransactionCacheCodec):
+    name = "hash"
+
+    def key(self, txn_id: int) -> str:
+        return utils.txn_cache_key(txn_id)
+
+    def queue_read(self, pipe, txn_id: int):
+        pipe.hgetall(self.key(txn_id))
+
+    def queue_write(self, pipe, txn: utils.TransactionResponse, expiration: int):
+        utils.queue_hset_and_expire(pipe, self.key(txn.id), dataclasses.asdict(txn), expiration)
+
+    # The expiration is only set on a new empty value, since every cached transaction already has one.
+    def queue_write_empty(self, pipe, txn_id: int, expiration: int):
+        pipe.hsetnx(self.key(txn_id), "id", txn_id)
+        pipe.expire(self.key(txn_id), expiration, nx=True)
+
+    def decode(self, raw: Dict[bytes, bytes]) -> DecodedTransaction:
+        # Empty cache value with only the ID.
+        if len(raw) == 1:
+            return CACHE_EMPTY
+        elif len(raw) > 1:
+            return utils.txn_dict_to_response(raw)
+        return None
+
+
+# A single string value with fixed-width binary fields (131 bytes per transaction):
+#
+#   version:                           1 byte
+#   flags:                             1 byte (whether each address is in the checksum format)
+#   id:                                8 bytes, unsigned
+#   transaction_hash:                  32 bytes
+#   from_public_address:               20 bytes
+#   to_public_address:                 20 bytes
+#   transaction_amount_in_wei:         16 bytes, unsigned
+#   transaction_fee_total_in_wei:      16 bytes, unsigned
+#   transaction_fee_blockchain_in_wei: 16 bytes, unsigned
+#   status:                            1 byte
+#
+# An empty value (the transaction does not exist) is a single version byte of 0.
+# Addresses are decoded either in lowercase or in the EIP-55 checksum format, as flagged.
+# Checksum addresses are memoized, since most 'from' addresses are one of the few system accounts.
+#
+# A transaction that would not decode to the same values (e.g., an address without the '0x' prefix,
+# in any other case, or not 20 bytes of hex) is encoded with msgpack instead, after a version byte of 2.
+# New transactions are normalized on creation, so this only happens for older or malformed records.
+class PackedTransactionCodec(TransactionCacheCodec):
+    name = "packed"
+
+    VERSION_EMPTY: Final[int] = 0
+    VERSION_1: Final[int] = 1
+    VERSION_MSGPACK: Final[int] = 2
+    FLAG_FROM_CHECKSUM: Final[int] = 0b01
+    FLAG_TO_CHECKSUM: Final[int] = 0b10
+    WEI_BYTES: Final[int] = 16
+
+    __layout = struct.Struct(">BBQ32s20s20s16s16s16sB")
+    __empty = bytes([VERSION_EMPTY])
+    __statuses = {status.value: status for status in models.UserAccountTransactionStatus}
+    __hash_pattern = re.compile(r"0x[0-9a-f]{64}")
+    __address_pattern = re.compile(r"0x[0-9a-fA-F]{40}")
+
+    def key(self, txn_id: int) -> str:
+        return f"user_account_transaction_packed:{txn_id}"
+
+    def queue_read(self, pipe, txn_id: int):
+        pipe.get(self.key(txn_id))
+
+    def queue_write(self, pipe, txn: utils.TransactionResponse, expiration: int):
+        pipe.set(self.key(txn.id), self.encode(txn), ex=expiration)
+
+    def queue_write_empty(self, pipe, txn_id: int, expiration: int):
+        pipe.set(self.key(txn_id), self.__empty, ex=expiration, nx=True)
+
+    def encode(self, txn: utils.TransactionResponse) -> bytes:
+        if not self.__is_packable(txn):
+            return bytes([self.VERSION_MSGPACK]) + msgpack.packb(dataclasses.astuple(txn))
+        flags = 0
+        if self.__is_checksum_address(txn.from_public_address):
+            flags |= self.FLAG_FROM_CHECKSUM
+        if self.__is_checksum_address(txn.to_public_address):
+            flags |= self.FLAG_TO_CHECKSUM
+        return self.__layout.pack(
+            self.VERSION_1,
+            flags,
+            txn.id,
+            bytes.fromhex(txn.transaction_hash.removeprefix("0x")),
+            bytes.fromhex(txn.from_public_address.removeprefix("0x")),
+            bytes.fromhex(txn.to_public_address.removeprefix("0x")),
+            txn.transaction_amount_in_wei.to_bytes(self.WEI_BYTES, "big"),
+            txn.transaction_fee_total_in_wei.to_bytes(self.WEI_BYTES, "big"),
+            txn.transaction_fee_blockchain_in_wei.to_bytes(self.WEI_BYTES, "big"),
+            models.UserAccountTransactionStatus[txn.status].value,
+        )
+
+    def decode(self, raw: Optional[bytes]) -> DecodedTransaction:
+        if raw is None:
+            return None
+        if raw == self.__empty:
+            return CACHE_EMPTY
+        if raw[0] == self.VERSION_MSGPACK:
+            return utils.TransactionResponse(*msgpack.unpackb(raw[1:]))
+        (
+            _version, flags, txn_id, transaction_hash, from_public_address, to_public_address,
+            transaction_amount_in_wei, transaction_fee_total_in_wei, transaction_fee_blockchain_in_wei, status,
+        ) = self.__layout.unpack(raw)
+        return utils.TransactionResponse(
+            id=txn_id,
+            transaction_hash="0x" + transaction_hash.hex(),
+            from_public_address=self.__decode_address(from_public_address, flags & self.FLAG_FROM_CHECKSUM),
+            to_public_address=self.__decode_address(to_public_address, flags & self.FLAG_TO_CHECKSUM),
+            transaction_amount_in_wei=int.from_bytes(transaction_amount_in_wei, "big"),
+            transaction_fee_total_in_wei=int.from_bytes(transaction_fee_total_in_wei, "big"),
+            transaction_fee_blockchain_in_wei=int.from_bytes(transaction_fee_blockchain_in_wei, "big"),
+            status=self.__statuses[status].name,
+        )
+
+    def __is_packable(self, txn: utils.TransactionResponse) -> bool:
+        return (
+            self.__hash_pattern.fullmatch(txn.transaction_hash) is not None
+            and self.__is_packable_address(txn.from_public_address)
+            and self.__is_packable_address(txn.to_public_address)
+            and max(txn.transaction_amount_in_wei, txn.transaction_fee_total_in_wei,
+                    txn.transaction_fee_blockchain_in_wei) < 1 << (8 * self.WEI_BYTES)
+            and min(txn.transaction_amount_in_wei, txn.transaction_fee_total_in_wei,
+                    txn.transaction_fee_blockchain_in_wei) >= 0
+        )
+
+    # Only the lowercase and the checksum formats are decoded to the same string.
+    def __is_packable_address(self, address: str) -> bool:
+        if self.__address_pattern.fullmatch(address) is None:
+            return False
+        return not self.__is_checksum_address(address) or _to_checksum_address(bytes.fromhex(address[2:])) == address
+
+    @staticmethod
+    def __is_checksum_address(address: str) -> bool:
+        return address != address.lower()
+
+    @staticmethod
+    def __decode_address(address: bytes, checksum: int) -> str:
+        if checksum:
+            return _to_checksum_address(address)
+        return "0x" + address.hex()
+
+
+@functools.lru_cache(maxsize=4096)
+def _to_checksum_address(address: bytes) -> str:
+    return to_checksum_address(address)
+
+
+CODECS: Final[Dict[str, TransactionCacheCodec]] = {
+    HashTransactionCodec.name: HashTransactionCodec(),
+    PackedTransactionCodec.name: PackedTransactionCodec(),
+}
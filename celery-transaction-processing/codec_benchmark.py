@@ -0,0 +1,152 @@
+import argparse
+import json
+import random
+import time
+from typing import List
+
+from eth_utils import to_checksum_address
+from redis import Redis as Dragonfly
+
+import utils
+from codec import CODECS, TransactionCacheCodec
+
+# Compare the transaction cache codecs by memory per key and encode/decode time.
+#
+# Memory is measured in two ways:
+#   - 'MEMORY USAGE' of a sample of keys, extrapolated to '--count' keys.
+#   - With '--populate', '--count' keys are actually written and the growth of 'used_memory' is reported,
+#     which includes the per-key overhead of the dictionary and the expiration table.
+# Encode/decode time is measured in-process, so it excludes the network round trip.
+#
+#   python codec_benchmark.py --count 10000000 --populate
+#
+# The benchmark writes keys in the codec key spaces starting at 'SYNTHETIC_TXN_ID_START',
+# and deletes them afterward. Do not run it against a production Dragonfly instance.
+
+SYNTHETIC_TXN_ID_START = 2_000_000_000
+WRITE_BATCH_SIZE = 10000
+# Transactions are sent from a few system accounts, to many recipients.
+SYSTEM_ACCOUNT_COUNT = 8
+
+
+def _random_address(checksum: bool) -> str:
+    address = "0x" + random.randbytes(20).hex()
+    return to_checksum_address(address) if checksum else address
+
+
+SYSTEM_ACCOUNT_ADDRESSES = [_random_address(checksum=True) for _ in range(SYSTEM_ACCOUNT_COUNT)]
+
+
+def _synthetic_txn(txn_id: int) -> utils.TransactionResponse:
+    return utils.TransactionResponse(
+        id=txn_id,
+        transaction_hash="0x" + random.randbytes(32).hex(),
+        from_public_address=random.choice(SYSTEM_ACCOUNT_ADDRESSES),
+        to_public_address=_random_address(checksum=False),
+        transaction_amount_in_wei=random.randrange(10 ** 18),
+        transaction_fee_total_in_wei=utils.TOTAL_TRANSACTION_FEE_IN_WEI,
+        transaction_fee_blockchain_in_wei=random.randrange(10 ** 15),
+        status=random.choice(["PENDING", "SUCCESSFUL", "FAILED"]),
+    )
+
+
+# Encode and decode through a pipeline stand-in that records the raw values, as Dragonfly would return them.
+class _RecordingPipeline:
+    def __init__(self):
+        self.values = []
+
+    def set(self, _key, value, ex=None):
+        self.values.append(value)
+
+    def hset(self, _key, mapping):
+        self.values.append({str(k).encode(): str(v).encode() for k, v in mapping.items()})
+
+    def expire(self, _key, _expiration):
+        pass
+
+
+def _time_codec(codec: TransactionCacheCodec, txns: List[utils.TransactionResponse]) -> dict:
+    pipe = _RecordingPipeline()
+    start = time.perf_counter()
+    for txn in txns:
+        codec.queue_write(pipe, txn, utils.CACHE_TERMINAL_EXPIRATION_SECONDS)
+    encode_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoded = [codec.decode(raw) for raw in pipe.values]
+    decode_seconds = time.perf_counter() - start
+
+    assert decoded == txns, f"codec '{codec.name}' does not round-trip"
+    return {
+        "encode_us_per_op": round(encode_seconds / len(txns) * 1e6, 3),
+        "decode_us_per_op": round(decode_seconds / len(txns) * 1e6, 3),
+    }
+
+
+def _write(df: Dragonfly, codec: TransactionCacheCodec, start_id: int, count: int):
+    for batch_start in range(start_id, start_id + count, WRITE_BATCH_SIZE):
+        pipe = df.pipeline(transaction=False)
+        for txn_id in range(batch_start, min(batch_start + WRITE_BATCH_SIZE, start_id + count)):
+            codec.queue_write(pipe, _synthetic_txn(txn_id), utils.CACHE_TERMINAL_EXPIRATION_SECONDS)
+        pipe.execute()
+
+
+def _delete(df: Dragonfly, codec: TransactionCacheCodec, start_id: int, count: int):
+    for batch_start in range(start_id, start_id + count, WRITE_BATCH_SIZE):
+        batch_end = min(batch_start + WRITE_BATCH_SIZE, start_id + count)
+        df.delete(*[codec.key(txn_id) for txn_id in range(batch_start, batch_end)])
+
+
+def _used_memory(df: Dragonfly) -> int:
+    return int(df.info("memory")["used_memory"])
+
+
+def run_codec(df: Dragonfly, codec: TransactionCacheCodec, args: argparse.Namespace) -> dict:
+    txns = [_synthetic_txn(SYNTHETIC_TXN_ID_START + i) for i in range(args.timing_ops)]
+    result = {"codec": codec.name, **_time_codec(codec, txns)}
+
+    _write(df, codec, SYNTHETIC_TXN_ID_START, args.sample)
+    pipe = df.pipeline(transaction=False)
+    for txn_id in range(SYNTHETIC_TXN_ID_START, SYNTHETIC_TXN_ID_START + args.sample):
+        pipe.memory_usage(codec.key(txn_id))
+    usages = pipe.execute()
+    _delete(df, codec, SYNTHETIC_TXN_ID_START, args.sample)
+
+    memory_usage_per_key = sum(usages) / len(usages)
+    result["memory_usage_bytes_per_key"] = round(memory_usage_per_key, 1)
+    result["memory_usage_extrapolated_mib"] = round(memory_usage_per_key * args.count / 2 ** 20, 1)
+
+    if args.populate:
+        used_memory_before = _used_memory(df)
+        start = time.perf_counter()
+        _write(df, codec, SYNTHETIC_TXN_ID_START, args.count)
+        result["populate_seconds"] = round(time.perf_counter() - start, 1)
+        used_memory = _used_memory(df) - used_memory_before
+        result["used_memory_bytes_per_key"] = round(used_memory / args.count, 1)
+        result["used_memory_total_mib"] = round(used_memory / 2 ** 20, 1)
+        _delete(df, codec, SYNTHETIC_TXN_ID_START, args.count)
+
+    return result
+
+
+def main(args: argparse.Namespace):
+    df = Dragonfly.from_url(args.dragonfly_url)
+    codecs = sorted(CODECS) if args.codec == "all" else [args.codec]
+    results = [run_codec(df, CODECS[name], args) for name in codecs]
+    df.close()
+    print(json.dumps({"count": args.count, "results": results}, indent=2))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare the memory and CPU cost of the transaction cache codecs.")
+    parser.add_argument("--dragonfly-url", default="redis://localhost:6380/0")
+    parser.add_argument("--codec", choices=["all", *sorted(CODECS)], default="all")
+    parser.add_argument("--count", type=int, default=10_000_000, help="number of cached transactions to estimate")
+    parser.add_argument("--sample", type=int, default=10000, help="number of keys measured with 'MEMORY USAGE'")
+    parser.add_argument("--timing-ops", type=int, default=100000, help="number of encode/decode operations timed")
+    parser.add_argument("--populate", action="store_true", help="write '--count' keys and measure 'used_memory'")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -1,13 +1,57 @@
 import os
-from typing import Final
-
-from redis import Redis as Dragonfly, ConnectionPool as DragonflyConnectionPool
+from typing import Final, List
+
+import aiohttp
+import requests
+from eth_account import Account
+from redis import Redis as Dragonfly, Connection as DragonflyConnection, SSLConnection as DragonflySSLConnection
+from redis.asyncio import Redis as AsyncDragonfly
+from redis.asyncio.connection import (
+    BlockingConnectionPool as AsyncDragonflyBlockingConnectionPool,
+    Connection as AsyncDragonflyConnection,
+    SSLConnection as AsyncDragonflySSLConnection,
+)
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import Session
 from sqlalchemy.orm import sessionmaker
-from web3 import Web3
+from web3 import Web3, AsyncWeb3
 
+import pools
 import utils
+from balance import BalanceLedger
+from codec import CODECS, TransactionCacheCodec
+from locks import LockManager
+from nonce import NonceAllocator
+from singleflight import SingleFlight
+from status_stream import STREAM_READ_BLOCK_MILLISECONDS, TransactionStatusHub
+
+
+def _env_int(name: str, default: int, minimum: int) -> int:
+    try:
+        value = int(os.environ.get(name, default))
+    except ValueError:
+        raise ValueError(f'{name} environment variable must be an integer')
+    if value < minimum:
+        raise ValueError(f'{name} environment variable must be at least {minimum}')
+    return value
+
+
+def _env_float(name: str, default: float, allow_zero: bool = False) -> float:
+    try:
+        value = float(os.environ.get(name, default))
+    except ValueError:
+        raise ValueError(f'{name} environment variable must be a number')
+    if value < 0 or (value == 0 and not allow_zero):
+        raise ValueError(f'{name} environment variable must be positive')
+    return value
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name, 'true' if default else 'false').lower()
+    if value not in ('true', 'false'):
+        raise ValueError(f'{name} environment variable must be one of: true, false')
+    return value == 'true'
 
 
 class _Constants:
@@ -54,12 +98,22 @@ class _Constants:
         return _Constants.__database_url
 
     # Web3 related constants.
+    # Multiple system (sender) accounts can be configured as comma-separated private keys.
+    # Transactions are then sent from these accounts in a round-robin manner.
     SYSTEM_ACCOUNT_PRIVATE_KEY_ENV: Final[str] = 'DF_SYSTEM_ACCOUNT_PRIVATE_KEY'
+    SYSTEM_ACCOUNT_PRIVATE_KEYS_ENV: Final[str] = 'DF_SYSTEM_ACCOUNT_PRIVATE_KEYS'
     WEB3_PROVIDER_URL_KEY: Final[str] = 'DF_WEB3_PROVIDER_URI'
 
     __system_account_private_key = ''
-    if SYSTEM_ACCOUNT_PRIVATE_KEY_ENV in os.environ:
+    __system_account_private_keys = []
+    if SYSTEM_ACCOUNT_PRIVATE_KEYS_ENV in os.environ:
+        __system_account_private_keys = [
+            v.strip() for v in os.environ[SYSTEM_ACCOUNT_PRIVATE_KEYS_ENV].split(',') if v.strip()
+        ]
+        __system_account_private_key = __system_account_private_keys[0]
+    elif SYSTEM_ACCOUNT_PRIVATE_KEY_ENV in os.environ:
         __system_account_private_key = os.environ[SYSTEM_ACCOUNT_PRIVATE_KEY_ENV]
+        __system_account_private_keys = [__system_account_private_key]
     else:
         raise ValueError(f'{SYSTEM_ACCOUNT_PRIVATE_KEY_ENV} environment variable is not set')
 
@@ -73,10 +127,133 @@ class _Constants:
     def get_system_account_private_key() -> str:
         return _Constants.__system_account_private_key
 
+    @staticmethod
+    def get_system_account_private_keys() -> List[str]:
+        return _Constants.__system_account_private_keys
+
     @staticmethod
     def get_web3_provider_url() -> str:
         return _Constants.__web3_provider_url
 
+    # Reconciliation mode.
+    # 'task' enqueues one Celery task per transaction, which retries itself with backoff while the transaction is pending.
+    # 'batch' adds transaction IDs to a Dragonfly sorted set, which a periodic Celery task sweeps in batches.
+    RECONCILE_MODE_TASK: Final[str] = 'task'
+    RECONCILE_MODE_BATCH: Final[str] = 'batch'
+    RECONCILE_MODE_ENV: Final[str] = 'DF_RECONCILE_MODE'
+
+    __reconcile_mode = RECONCILE_MODE_TASK
+    if RECONCILE_MODE_ENV in os.environ:
+        __reconcile_mode = os.environ[RECONCILE_MODE_ENV]
+    if __reconcile_mode not in (RECONCILE_MODE_TASK, RECONCILE_MODE_BATCH):
+        raise ValueError(f'{RECONCILE_MODE_ENV} environment variable must be one of: task, batch')
+
+    @staticmethod
+    def get_reconcile_mode() -> str:
+        return _Constants.__reconcile_mode
+
+    # Encoding of the cached transactions.
+    # 'packed' stores each transaction as a compact binary string, and 'hash' stores it as a hash of strings.
+    TRANSACTION_CACHE_CODEC_PACKED: Final[str] = 'packed'
+    TRANSACTION_CACHE_CODEC_HASH: Final[str] = 'hash'
+    TRANSACTION_CACHE_CODEC_ENV: Final[str] = 'DF_TRANSACTION_CACHE_CODEC'
+
+    __transaction_cache_codec = TRANSACTION_CACHE_CODEC_PACKED
+    if TRANSACTION_CACHE_CODEC_ENV in os.environ:
+        __transaction_cache_codec = os.environ[TRANSACTION_CACHE_CODEC_ENV]
+    if __transaction_cache_codec not in (TRANSACTION_CACHE_CODEC_PACKED, TRANSACTION_CACHE_CODEC_HASH):
+        raise ValueError(f'{TRANSACTION_CACHE_CODEC_ENV} environment variable must be one of: packed, hash')
+
+    @staticmethod
+    def get_transaction_cache_codec() -> str:
+        return _Constants.__transaction_cache_codec
+
+    # Where the available balances are debited.
+    # 'sql' locks the user account in Dragonfly and debits the balance in the database for each transaction.
+    # 'dragonfly' debits the balance in Dragonfly atomically, and a write-behind worker persists it to the database.
+    BALANCE_MODE_SQL: Final[str] = 'sql'
+    BALANCE_MODE_DRAGONFLY: Final[str] = 'dragonfly'
+    BALANCE_MODE_ENV: Final[str] = 'DF_BALANCE_MODE'
+
+    __balance_mode = BALANCE_MODE_SQL
+    if BALANCE_MODE_ENV in os.environ:
+        __balance_mode = os.environ[BALANCE_MODE_ENV]
+    if __balance_mode not in (BALANCE_MODE_SQL, BALANCE_MODE_DRAGONFLY):
+        raise ValueError(f'{BALANCE_MODE_ENV} environment variable must be one of: sql, dragonfly')
+
+    @staticmethod
+    def get_balance_mode() -> str:
+        return _Constants.__balance_mode
+
+    # Connection pools of each process (API server or Celery worker).
+    # Checkouts wait up to the pool timeout for a free connection when a pool is exhausted, and then fail.
+    # See 'pools.py' for the metrics to size the pools with.
+    DRAGONFLY_MAX_CONNECTIONS_ENV: Final[str] = 'DF_DRAGONFLY_MAX_CONNECTIONS'
+    DRAGONFLY_POOL_TIMEOUT_SECONDS_ENV: Final[str] = 'DF_DRAGONFLY_POOL_TIMEOUT_SECONDS'
+    DRAGONFLY_SOCKET_TIMEOUT_SECONDS_ENV: Final[str] = 'DF_DRAGONFLY_SOCKET_TIMEOUT_SECONDS'
+    DRAGONFLY_SOCKET_CONNECT_TIMEOUT_SECONDS_ENV: Final[str] = 'DF_DRAGONFLY_SOCKET_CONNECT_TIMEOUT_SECONDS'
+    # Idle connections are checked with a PING before use after this interval, to detect dropped connections.
+    DRAGONFLY_HEALTH_CHECK_INTERVAL_SECONDS_ENV: Final[str] = 'DF_DRAGONFLY_HEALTH_CHECK_INTERVAL_SECONDS'
+
+    __dragonfly_pool_config = pools.DragonflyPoolConfig(
+        max_connections=_env_int(DRAGONFLY_MAX_CONNECTIONS_ENV, 50, minimum=1),
+        timeout_seconds=_env_float(DRAGONFLY_POOL_TIMEOUT_SECONDS_ENV, 5.0),
+        socket_timeout_seconds=_env_float(DRAGONFLY_SOCKET_TIMEOUT_SECONDS_ENV, 5.0),
+        socket_connect_timeout_seconds=_env_float(DRAGONFLY_SOCKET_CONNECT_TIMEOUT_SECONDS_ENV, 2.0),
+        health_check_interval_seconds=_env_int(DRAGONFLY_HEALTH_CHECK_INTERVAL_SECONDS_ENV, 30, minimum=0),
+    )
+
+    DATABASE_POOL_SIZE_ENV: Final[str] = 'DF_DATABASE_POOL_SIZE'
+    DATABASE_MAX_OVERFLOW_ENV: Final[str] = 'DF_DATABASE_MAX_OVERFLOW'
+    DATABASE_POOL_TIMEOUT_SECONDS_ENV: Final[str] = 'DF_DATABASE_POOL_TIMEOUT_SECONDS'
+    # Connections older than this are replaced on checkout, before the database server or a proxy drops them.
+    DATABASE_POOL_RECYCLE_SECONDS_ENV: Final[str] = 'DF_DATABASE_POOL_RECYCLE_SECONDS'
+    DATABASE_POOL_PRE_PING_ENV: Final[str] = 'DF_DATABASE_POOL_PRE_PING'
+
+    __database_pool_config = pools.DatabasePoolConfig(
+        pool_size=_env_int(DATABASE_POOL_SIZE_ENV, 5, minimum=1),
+        max_overflow=_env_int(DATABASE_MAX_OVERFLOW_ENV, 10, minimum=0),
+        timeout_seconds=_env_float(DATABASE_POOL_TIMEOUT_SECONDS_ENV, 30.0),
+        recycle_seconds=_env_int(DATABASE_POOL_RECYCLE_SECONDS_ENV, 1800, minimum=-1),
+        pre_ping=_env_bool(DATABASE_POOL_PRE_PING_ENV, False),
+    )
+
+    WEB3_MAX_CONNECTIONS_ENV: Final[str] = 'DF_WEB3_MAX_CONNECTIONS'
+    WEB3_TIMEOUT_SECONDS_ENV: Final[str] = 'DF_WEB3_TIMEOUT_SECONDS'
+
+    __web3_pool_config = pools.HTTPPoolConfig(
+        max_connections=_env_int(WEB3_MAX_CONNECTIONS_ENV, 20, minimum=1),
+        timeout_seconds=_env_float(WEB3_TIMEOUT_SECONDS_ENV, 10.0),
+    )
+
+    @staticmethod
+    def get_dragonfly_pool_config() -> pools.DragonflyPoolConfig:
+        return _Constants.__dragonfly_pool_config
+
+    @staticmethod
+    def get_database_pool_config() -> pools.DatabasePoolConfig:
+        return _Constants.__database_pool_config
+
+    @staticmethod
+    def get_web3_pool_config() -> pools.HTTPPoolConfig:
+        return _Constants.__web3_pool_config
+
+    # How long a transaction request waits for the lock of its user account, held by another request.
+    # With the default of 0, concurrent transactions of the same user account are rejected with 409 right away.
+    # A waiting request blocks on a Dragonfly connection, so the wait must be shorter than the socket timeout.
+    ACCOUNT_LOCK_WAIT_SECONDS_ENV: Final[str] = 'DF_ACCOUNT_LOCK_WAIT_SECONDS'
+
+    __account_lock_wait_seconds = _env_float(ACCOUNT_LOCK_WAIT_SECONDS_ENV, 0.0, allow_zero=True)
+    if __account_lock_wait_seconds >= __dragonfly_pool_config.socket_timeout_seconds:
+        raise ValueError(
+            f'{ACCOUNT_LOCK_WAIT_SECONDS_ENV} environment variable must be less than '
+            f'{DRAGONFLY_SOCKET_TIMEOUT_SECONDS_ENV}'
+        )
+
+    @staticmethod
+    def get_account_lock_wait_seconds() -> float:
+        return _Constants.__account_lock_wait_seconds
+
 
 __constants_instance = _Constants()
 
@@ -85,11 +262,47 @@ def get_constants():
     return __constants_instance
 
 
+def _database_engine_kwargs(pool_class: type, stats: pools.PoolStats) -> dict:
+    config = get_constants().get_database_pool_config()
+    return {
+        "poolclass": pools.bind(pool_class, stats),
+        "pool_size": config.pool_size,
+        "max_overflow": config.max_overflow,
+        "pool_timeout": config.timeout_seconds,
+        "pool_recycle": config.recycle_seconds,
+        "pool_pre_ping": config.pre_ping,
+    }
+
+
+def _dragonfly_pool_kwargs(url: utils.DragonflyURLParsed, connection_class: type) -> dict:
+    config = get_constants().get_dragonfly_pool_config()
+    return {
+        "host": url.host,
+        "port": url.port,
+        "db": url.db,
+        "username": url.username,
+        "password": url.password,
+        "connection_class": connection_class,
+        "max_connections": config.max_connections,
+        "timeout": config.timeout_seconds,
+        "socket_timeout": config.socket_timeout_seconds,
+        "socket_connect_timeout": config.socket_connect_timeout_seconds,
+        "health_check_interval": config.health_check_interval_seconds,
+    }
+
+
+# The synchronous clients are used by Celery tasks, which run in worker processes without an event loop.
+# The asynchronous clients are used by the FastAPI handlers, so that a slow database, Dragonfly, or RPC node
+# call suspends only the request waiting for it instead of blocking the whole event loop.
 class _Deps:
     # Database client/session.
+    __engine_pool_stats = pools.PoolStats('database', get_constants().get_database_pool_config().pool_size)
     __engine = create_engine(
-        get_constants().get_database_url(), connect_args={"check_same_thread": False}
+        get_constants().get_database_url(),
+        connect_args={"check_same_thread": False},
+        **_database_engine_kwargs(pools.InstrumentedQueuePool, __engine_pool_stats),
     )
+    pools.instrument_engine(__engine, __engine_pool_stats)
     __session_local = sessionmaker(autocommit=False, autoflush=False, bind=__engine)
 
     @staticmethod
@@ -102,11 +315,14 @@ class _Deps:
 
     # Dragonfly client.
     __dragonfly_url = utils.parse_dragonfly_url(get_constants().get_dragonfly_url())
-    __dragonfly_conn_pool = DragonflyConnectionPool(
-        host=__dragonfly_url.host,
-        port=__dragonfly_url.port,
-        db=__dragonfly_url.db,
+    __dragonfly_pool_stats = pools.PoolStats('dragonfly', get_constants().get_dragonfly_pool_config().max_connections)
+    __dragonfly_conn_pool = pools.bind(pools.InstrumentedDragonflyConnectionPool, __dragonfly_pool_stats)(
+        **_dragonfly_pool_kwargs(
+            __dragonfly_url,
+            DragonflySSLConnection if __dragonfly_url.ssl else DragonflyConnection,
+        ),
     )
+    __dragonfly_pool_stats.set_occupancy(__dragonfly_conn_pool.occupancy)
     __dragonfly_client = Dragonfly(connection_pool=__dragonfly_conn_pool)
 
     @staticmethod
@@ -114,12 +330,139 @@ class _Deps:
         return _Deps.__dragonfly_client
 
     # Web3 client.
-    __web3_provider = Web3(Web3.HTTPProvider(get_constants().get_web3_provider_url()))
+    # The HTTP session is shared with the JSON-RPC batch requests of 'eth.py'.
+    __web3_pool_stats = pools.PoolStats('web3', get_constants().get_web3_pool_config().max_connections)
+    __web3_session = pools.create_http_session(__web3_pool_stats, get_constants().get_web3_pool_config())
+    __web3_provider = Web3(Web3.HTTPProvider(
+        get_constants().get_web3_provider_url(),
+        request_kwargs={"timeout": get_constants().get_web3_pool_config().timeout_seconds},
+        session=__web3_session,
+    ))
 
     @staticmethod
     def get_web3() -> Web3:
         return _Deps.__web3_provider
 
+    @staticmethod
+    def get_web3_session() -> requests.Session:
+        return _Deps.__web3_session
+
+    # Async database client/session.
+    __async_engine_pool_stats = pools.PoolStats(
+        'async_database', get_constants().get_database_pool_config().pool_size
+    )
+    __async_engine = create_async_engine(
+        utils.to_async_database_url(get_constants().get_database_url()),
+        **_database_engine_kwargs(pools.InstrumentedAsyncAdaptedQueuePool, __async_engine_pool_stats),
+    )
+    pools.instrument_engine(__async_engine.sync_engine, __async_engine_pool_stats)
+    __async_session_local = async_sessionmaker(bind=__async_engine, autoflush=False, expire_on_commit=False)
+
+    @staticmethod
+    async def get_async_db_session() -> AsyncSession:
+        async with _Deps.__async_session_local() as db:
+            yield db
+
+    # A new async database session, which is not bound to a request, to be used in 'async with'.
+    @staticmethod
+    def new_async_db_session() -> AsyncSession:
+        return _Deps.__async_session_local()
+
+    # Async Dragonfly client.
+    __async_dragonfly_pool_stats = pools.PoolStats(
+        'async_dragonfly', get_constants().get_dragonfly_pool_config().max_connections
+    )
+    __async_dragonfly_conn_pool = pools.bind(
+        pools.InstrumentedAsyncDragonflyConnectionPool, __async_dragonfly_pool_stats
+    )(
+        **_dragonfly_pool_kwargs(
+            __dragonfly_url,
+            AsyncDragonflySSLConnection if __dragonfly_url.ssl else AsyncDragonflyConnection,
+        ),
+    )
+    __async_dragonfly_pool_stats.set_occupancy(__async_dragonfly_conn_pool.occupancy)
+    __async_dragonfly_client = AsyncDragonfly(connection_pool=__async_dragonfly_conn_pool)
+
+    @staticmethod
+    def get_async_dragonfly() -> AsyncDragonfly:
+        return _Deps.__async_dragonfly_client
+
+    # Async Web3 client.
+    __async_web3_pool_stats = pools.PoolStats('async_web3', get_constants().get_web3_pool_config().max_connections)
+    __async_web3_provider = AsyncWeb3(AsyncWeb3.AsyncHTTPProvider(
+        get_constants().get_web3_provider_url(),
+        request_kwargs={"timeout": aiohttp.ClientTimeout(total=get_constants().get_web3_pool_config().timeout_seconds)},
+    ))
+
+    @staticmethod
+    def get_async_web3() -> AsyncWeb3:
+        return _Deps.__async_web3_provider
+
+    # Install the pooled HTTP session of the async Web3 client.
+    # It must be called in the event loop of the API server, since an aiohttp session is bound to its event loop.
+    @staticmethod
+    async def open_async_web3_session():
+        session = pools.create_aiohttp_session(_Deps.__async_web3_pool_stats, get_constants().get_web3_pool_config())
+        await _Deps.__async_web3_provider.provider.cache_async_session(session)
+
+    # Nonce allocator for the system accounts.
+    __nonce_allocator = NonceAllocator(
+        __async_dragonfly_client,
+        __async_web3_provider,
+        [Account.from_key(v) for v in get_constants().get_system_account_private_keys()],
+    )
+
+    @staticmethod
+    def get_nonce_allocator() -> NonceAllocator:
+        return _Deps.__nonce_allocator
+
+    # Transaction status hub, which fans out status updates to the connected clients.
+    # Its reader blocks on XREAD for up to 'STREAM_READ_BLOCK_MILLISECONDS' when the stream is idle,
+    # so it has a connection of its own, with a socket timeout of the block time plus the usual socket timeout.
+    __status_hub_dragonfly_client = AsyncDragonfly(connection_pool=AsyncDragonflyBlockingConnectionPool(**{
+        **_dragonfly_pool_kwargs(
+            __dragonfly_url,
+            AsyncDragonflySSLConnection if __dragonfly_url.ssl else AsyncDragonflyConnection,
+        ),
+        "max_connections": 1,
+        "socket_timeout": (
+            STREAM_READ_BLOCK_MILLISECONDS / 1000 + get_constants().get_dragonfly_pool_config().socket_timeout_seconds
+        ),
+    }))
+    __transaction_status_hub = TransactionStatusHub(__status_hub_dragonfly_client)
+
+    @staticmethod
+    def get_transaction_status_hub() -> TransactionStatusHub:
+        return _Deps.__transaction_status_hub
+
+    # Coalesces concurrent cache rebuilds.
+    __single_flight = SingleFlight(__async_dragonfly_client)
+
+    @staticmethod
+    def get_single_flight() -> SingleFlight:
+        return _Deps.__single_flight
+
+    # Codec of the transaction cache entries.
+    __transaction_cache_codec = CODECS[get_constants().get_transaction_cache_codec()]
+
+    @staticmethod
+    def get_transaction_cache_codec() -> TransactionCacheCodec:
+        return _Deps.__transaction_cache_codec
+
+    # Locks of the user accounts, used in the 'sql' balance mode.
+    __lock_manager = LockManager(__async_dragonfly_client)
+
+    @staticmethod
+    def get_lock_manager() -> LockManager:
+        return _Deps.__lock_manager
+
+    # Available balances in Dragonfly, used in the 'dragonfly' balance mode.
+    __balance_ledger = BalanceLedger(__async_dragonfly_client)
+
+    @staticmethod
+    def get_balance_ledger() -> BalanceLedger:
+        return _Deps.__balance_ledger
+
 
 __deps_instance = _Deps()
 
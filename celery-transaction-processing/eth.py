@@ -1,11 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
 
 from eth_typing import HexStr
 from web3.types import TxReceipt
 
-from deps import get_deps
+import metrics
+from deps import get_deps, get_constants
 from models import UserAccountTransactionStatus
 
+# Maximum number of calls in a single JSON-RPC batch request.
+# Node providers limit the batch size, i.e., Infura accepts up to 1000 calls per batch.
+RPC_BATCH_SIZE = 100
+
+# Chain data cache.
+#
+# The block height changes roughly every 12 seconds on Ethereum, so it is shared by all workers through Dragonfly
+# with a short TTL, and kept in-process (L1) for an even shorter period.
+# Receipts and gas prices of mined transactions do not change once the transactions are past the confirmation depth,
+# so they are stored in Dragonfly without expiration, and the most recently used ones are also kept in-process.
+BLOCK_NUMBER_CACHE_KEY = "eth_block_number"
+BLOCK_NUMBER_CACHE_MILLISECONDS = 2000
+BLOCK_NUMBER_L1_CACHE_SECONDS = 1.0
+RECEIPT_L1_CACHE_MAX_SIZE = 10000
+
+cache_counters = metrics.Counters('eth_cache')
+
+
+def finalized_receipt_cache_key(tx_hash: str) -> str:
+    return f"eth_finalized_receipt:{tx_hash}"
+
+
+def gas_price_cache_key(tx_hash: str) -> str:
+    return f"eth_gas_price:{tx_hash}"
+
+
+class _LocalCache:
+    def __init__(self, max_size: int):
+        self.__max_size = max_size
+        self.__lock = threading.Lock()
+        self.__entries: OrderedDict = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self.__entries[key]
+                return None
+            self.__entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None):
+        expires_at = time.monotonic() + ttl_seconds if ttl_seconds is not None else None
+        with self.__lock:
+            self.__entries[key] = (value, expires_at)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+
+
+__l1_cache = _LocalCache(RECEIPT_L1_CACHE_MAX_SIZE)
+
 
 @dataclass
 class TransactionStatusResponse:
@@ -20,16 +80,163 @@ def get_transaction_status(
         tx_hash: str,
         number_of_blocks_to_wait: int = 10
 ) -> TransactionStatusResponse:
-    receipt = get_deps().get_web3().eth.get_transaction_receipt(HexStr(tx_hash))
-    gas_price = get_deps().get_web3().eth.get_transaction(HexStr(tx_hash)).gasPrice
-    current_block_number = get_deps().get_web3().eth.get_block_number()
+    current_block_number = get_block_number()
+    receipt = __get_finalized_receipt(tx_hash)
+    if receipt is None:
+        cache_counters.incr('receipt_miss')
+        receipt = get_deps().get_web3().eth.get_transaction_receipt(HexStr(tx_hash))
+        receipt = {
+            'blockNumber': receipt['blockNumber'],
+            'gasUsed': receipt['gasUsed'],
+            'status': receipt['status'],
+            'gasPrice': __get_gas_price(tx_hash),
+        }
+        __set_finalized_receipt_if_final(tx_hash, receipt, current_block_number, number_of_blocks_to_wait)
+    return __to_status_response(tx_hash, receipt, current_block_number, number_of_blocks_to_wait)
+
+
+def get_block_number() -> int:
+    block_number = __l1_cache.get(BLOCK_NUMBER_CACHE_KEY)
+    if block_number is not None:
+        cache_counters.incr('block_number_l1_hit')
+        return block_number
+
+    df = get_deps().get_dragonfly()
+    cached = df.get(BLOCK_NUMBER_CACHE_KEY)
+    if cached is not None:
+        cache_counters.incr('block_number_l2_hit')
+        block_number = int(cached)
+    else:
+        cache_counters.incr('block_number_miss')
+        block_number = get_deps().get_web3().eth.get_block_number()
+        df.set(BLOCK_NUMBER_CACHE_KEY, block_number, px=BLOCK_NUMBER_CACHE_MILLISECONDS)
+    __l1_cache.set(BLOCK_NUMBER_CACHE_KEY, block_number, BLOCK_NUMBER_L1_CACHE_SECONDS)
+    return block_number
+
+
+# Get the status of many transactions against a single block height.
+# Finalized receipts are read from the cache. The rest are fetched with JSON-RPC batch requests,
+# so N transactions cost at most N / RPC_BATCH_SIZE round trips.
+# Receipts of EIP-1559 transactions carry 'effectiveGasPrice', so the transactions themselves are not fetched.
+# Transactions without a receipt (not mined, or not found on chain yet) are reported as PENDING.
+def get_transaction_statuses(
+        tx_hashes: List[str],
+        current_block_number: int,
+        number_of_blocks_to_wait: int = 10,
+) -> Dict[str, TransactionStatusResponse]:
+    receipts = __get_finalized_receipts(tx_hashes)
+    missing_tx_hashes = [tx_hash for tx_hash in tx_hashes if tx_hash not in receipts]
+    cache_counters.incr('receipt_miss', len(missing_tx_hashes))
+    for i in range(0, len(missing_tx_hashes), RPC_BATCH_SIZE):
+        fetched_receipts = __get_transaction_receipts_batch(missing_tx_hashes[i:i + RPC_BATCH_SIZE])
+        for tx_hash, receipt in fetched_receipts.items():
+            __set_finalized_receipt_if_final(tx_hash, receipt, current_block_number, number_of_blocks_to_wait)
+        receipts.update(fetched_receipts)
+
+    return {
+        tx_hash: __to_status_response(tx_hash, receipts.get(tx_hash), current_block_number, number_of_blocks_to_wait)
+        for tx_hash in tx_hashes
+    }
+
+
+def __to_status_response(
+        tx_hash: str,
+        receipt: Optional[dict],
+        current_block_number: int,
+        number_of_blocks_to_wait: int,
+) -> TransactionStatusResponse:
     return TransactionStatusResponse(
         tx_hash=tx_hash,
-        tx_block_number=receipt['blockNumber'],
+        tx_block_number=receipt['blockNumber'] if receipt else 0,
         current_block_number=current_block_number,
-        transaction_fee_blockchain_in_wei=receipt['gasUsed'] * gas_price,
-        status=__calculate_transaction_status(receipt, current_block_number, number_of_blocks_to_wait)
+        transaction_fee_blockchain_in_wei=receipt['gasUsed'] * receipt['gasPrice'] if receipt else 0,
+        status=__calculate_transaction_status(receipt, current_block_number, number_of_blocks_to_wait),
+    )
+
+
+def __get_gas_price(tx_hash: str) -> int:
+    df = get_deps().get_dragonfly()
+    cached = df.get(gas_price_cache_key(tx_hash))
+    if cached is not None:
+        cache_counters.incr('gas_price_hit')
+        return int(cached)
+    cache_counters.incr('gas_price_miss')
+    txn = get_deps().get_web3().eth.get_transaction(HexStr(tx_hash))
+    # The gas price is only final once the transaction is mined.
+    if txn.blockNumber is not None:
+        df.set(gas_price_cache_key(tx_hash), txn.gasPrice)
+    return txn.gasPrice
+
+
+def __get_finalized_receipt(tx_hash: str) -> Optional[dict]:
+    return __get_finalized_receipts([tx_hash]).get(tx_hash)
+
+
+def __get_finalized_receipts(tx_hashes: List[str]) -> Dict[str, dict]:
+    receipts = {}
+    l1_missing_tx_hashes = []
+    for tx_hash in tx_hashes:
+        receipt = __l1_cache.get(finalized_receipt_cache_key(tx_hash))
+        if receipt is not None:
+            receipts[tx_hash] = receipt
+        else:
+            l1_missing_tx_hashes.append(tx_hash)
+    cache_counters.incr('receipt_l1_hit', len(receipts))
+    if not l1_missing_tx_hashes:
+        return receipts
+
+    pipe = get_deps().get_dragonfly().pipeline(transaction=False)
+    for tx_hash in l1_missing_tx_hashes:
+        pipe.hgetall(finalized_receipt_cache_key(tx_hash))
+    for tx_hash, cached in zip(l1_missing_tx_hashes, pipe.execute()):
+        if not cached:
+            continue
+        receipt = {k.decode(): int(v) for k, v in cached.items()}
+        receipts[tx_hash] = receipt
+        __l1_cache.set(finalized_receipt_cache_key(tx_hash), receipt)
+        cache_counters.incr('receipt_l2_hit')
+    return receipts
+
+
+def __set_finalized_receipt_if_final(
+        tx_hash: str,
+        receipt: dict,
+        current_block_number: int,
+        number_of_blocks_to_wait: int,
+):
+    if receipt['blockNumber'] + number_of_blocks_to_wait > current_block_number:
+        return
+    get_deps().get_dragonfly().hset(finalized_receipt_cache_key(tx_hash), mapping=receipt)
+    __l1_cache.set(finalized_receipt_cache_key(tx_hash), receipt)
+
+
+def __get_transaction_receipts_batch(tx_hashes: List[str]) -> Dict[str, dict]:
+    payload = [
+        {'jsonrpc': '2.0', 'id': i, 'method': 'eth_getTransactionReceipt', 'params': [tx_hash]}
+        for i, tx_hash in enumerate(tx_hashes)
+    ]
+    resp = get_deps().get_web3_session().post(
+        get_constants().get_web3_provider_url(),
+        json=payload,
+        timeout=get_constants().get_web3_pool_config().timeout_seconds,
     )
+    resp.raise_for_status()
+    results = resp.json()
+    if not isinstance(results, list):
+        raise ValueError(f"JSON-RPC batch request failed: {results}")
+    receipts = {}
+    for result in results:
+        # A failed call is treated as a missing receipt, so the transaction is checked again in the next sweep.
+        raw_receipt = result.get('result')
+        if raw_receipt is None:
+            continue
+        receipts[tx_hashes[result['id']]] = {
+            'blockNumber': int(raw_receipt['blockNumber'], 16),
+            'gasUsed': int(raw_receipt['gasUsed'], 16),
+            'status': int(raw_receipt['status'], 16),
+            'gasPrice': int(raw_receipt['effectiveGasPrice'], 16),
+        }
+    return receipts
 
 
 def __calculate_transaction_status(
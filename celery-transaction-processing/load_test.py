@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import httpx
+
+# A load generator for the transaction API.
+# It keeps a fixed number of concurrent clients busy for a fixed duration,
+# sending a mix of 'POST /transactions' and 'GET /transactions/{id}' requests,
+# and reports requests per second and latency percentiles for each endpoint.
+#
+# Run it against the same deployment before and after a change to compare the numbers, i.e.:
+#   python load_test.py --base-url http://localhost:8000 --concurrency 64 --duration 30
+
+DEFAULT_TO_PUBLIC_ADDRESS = "0x000000000000000000000000000000000000dEaD"
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class _Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.status_codes: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.created_txn_ids: List[int] = []
+        # Unix timestamps at which the transactions were created, to measure the reconciliation lag.
+        self.created_at: Dict[int, float] = {}
+
+    def record(self, endpoint: str, latency: float, status_code: int):
+        self.latencies[endpoint].append(latency)
+        self.status_codes[endpoint][status_code] += 1
+
+    def report(self, elapsed: float) -> dict:
+        endpoints = {}
+        total = 0
+        for endpoint, values in self.latencies.items():
+            values.sort()
+            total += len(values)
+            endpoints[endpoint] = {
+                "requests": len(values),
+                "requests_per_second": round(len(values) / elapsed, 2),
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p95_ms": round(percentile(values, 95) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+                "status_codes": dict(self.status_codes[endpoint]),
+                "errors": self.errors[endpoint],
+            }
+        return {
+            "elapsed_seconds": round(elapsed, 2),
+            "requests": total,
+            "requests_per_second": round(total / elapsed, 2),
+            "endpoints": endpoints,
+        }
+
+
+async def _create_transaction(client: httpx.AsyncClient, recorder: _Recorder, args: argparse.Namespace):
+    body = {
+        "user_account_id": random.randint(args.min_user_account_id, args.max_user_account_id),
+        "to_public_address": args.to_public_address,
+        "transaction_amount_in_wei": args.transaction_amount_in_wei,
+    }
+    start = time.perf_counter()
+    try:
+        resp = await client.post("/transactions", json=body)
+    except httpx.HTTPError:
+        recorder.errors["POST /transactions"] += 1
+        return
+    recorder.record("POST /transactions", time.perf_counter() - start, resp.status_code)
+    if resp.status_code == 200:
+        txn_id = resp.json()["id"]
+        recorder.created_txn_ids.append(txn_id)
+        recorder.created_at[txn_id] = time.time()
+
+
+async def _get_transaction(client: httpx.AsyncClient, recorder: _Recorder, args: argparse.Namespace):
+    if recorder.created_txn_ids:
+        txn_id = random.choice(recorder.created_txn_ids)
+    else:
+        txn_id = random.randint(1, args.max_txn_id)
+    start = time.perf_counter()
+    try:
+        resp = await client.get(f"/transactions/{txn_id}")
+    except httpx.HTTPError:
+        recorder.errors["GET /transactions/{id}"] += 1
+        return
+    recorder.record("GET /transactions/{id}", time.perf_counter() - start, resp.status_code)
+
+
+async def _client_loop(client: httpx.AsyncClient, recorder: _Recorder, args: argparse.Namespace, deadline: float):
+    while time.perf_counter() < deadline:
+        if random.random() < args.get_ratio:
+            await _get_transaction(client, recorder, args)
+        else:
+            await _create_transaction(client, recorder, args)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    report, _ = await run_with_created_at(args)
+    return report
+
+
+# Run the load test, and also return the creation timestamps of the created transactions.
+async def run_with_created_at(args: argparse.Namespace) -> Tuple[dict, Dict[int, float]]:
+    recorder = _Recorder()
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout) as client:
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*[_client_loop(client, recorder, args, deadline) for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - start
+    return recorder.report(elapsed), recorder.created_at
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test the transaction API.")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30.0, help="test duration in seconds")
+    parser.add_argument("--timeout", type=float, default=30.0, help="per-request timeout in seconds")
+    parser.add_argument("--get-ratio", type=float, default=0.8, help="fraction of requests that are GETs")
+    parser.add_argument("--min-user-account-id", type=int, default=1)
+    parser.add_argument("--max-user-account-id", type=int, default=1000)
+    parser.add_argument("--max-txn-id", type=int, default=1000, help="GET ID range before any POST succeeds")
+    parser.add_argument("--to-public-address", default=DEFAULT_TO_PUBLIC_ADDRESS)
+    parser.add_argument("--transaction-amount-in-wei", type=int, default=1000)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    print(json.dumps(asyncio.run(run(parse_args())), indent=2))
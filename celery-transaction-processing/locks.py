@@ -0,0 +1,116 @@
+import time
+import uuid
+from typing import Dict, Final, Optional
+
+from redis.asyncio import Redis as AsyncDragonfly
+
+import metrics
+
+# Histogram buckets of the lock hold and wait times.
+LOCK_DURATION_BUCKETS_MS: Final[tuple] = (10, 100, 1000, 10000)
+
+counters = metrics.Counters('locks')
+
+
+# The lock and its wakeup list share the hash tag '{name}', so that both are in the same slot in a cluster,
+# while the locks of different names are spread across the shards.
+def lock_key(name: str) -> str:
+    return f"lock:{{{name}}}"
+
+
+def lock_wakeup_key(name: str) -> str:
+    return f"lock_wakeup:{{{name}}}"
+
+
+# Locks in Dragonfly, owned by a random token of the holder.
+#
+# - A lock is acquired with 'SET NX PX', and expires after 'ttl_milliseconds' in case the holder crashes.
+#   Only the holder can release it, so a holder that outlived the expiration cannot release the lock of another.
+# - A caller may wait up to 'wait_seconds' for a lock held by another. Instead of polling, it blocks on the wakeup list
+#   of the lock with BLPOP, to which the release pushes a single element, so that one waiter retries at a time.
+#   A waiter also retries when the lock would expire, since an expired lock is not released.
+#
+# A waiter holds a Dragonfly connection while it blocks, so the number of concurrent waiters is bounded
+# by the connection pool, and the wait must be shorter than the socket timeout.
+class LockManager:
+    # KEYS[1]: the lock
+    # ARGV[1]: the token of the caller
+    # ARGV[2]: the expiration in milliseconds
+    #
+    # Returns 0 if the lock is acquired. Otherwise, the remaining milliseconds of the lock (see PTTL).
+    __ACQUIRE_SCRIPT: Final[str] = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 0
+end
+return redis.call('PTTL', KEYS[1])
+"""
+    # KEYS[1]: the lock
+    # KEYS[2]: the wakeup list
+    # ARGV[1]: the token of the caller
+    # ARGV[2]: the expiration of the wakeup in milliseconds
+    #
+    # Release the lock only if it is still owned by the caller, and wake up a waiter.
+    # The wakeup list holds at most one element, which expires if no one is waiting.
+    __RELEASE_SCRIPT: Final[str] = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+redis.call('RPUSH', KEYS[2], 1)
+redis.call('PEXPIRE', KEYS[2], ARGV[2])
+return 1
+"""
+    # The shortest BLPOP timeout, since a timeout of 0 blocks indefinitely.
+    __MIN_WAIT_SECONDS: Final[float] = 0.001
+
+    def __init__(self, df: AsyncDragonfly):
+        self.df = df
+        self.__acquire_script = df.register_script(self.__ACQUIRE_SCRIPT)
+        self.__release_script = df.register_script(self.__RELEASE_SCRIPT)
+        self.__acquired_at: Dict[str, float] = {}
+
+    # Acquire the lock of 'name', waiting up to 'wait_seconds' if it is held by another.
+    # Returns the token to release the lock with, or None if the lock is not acquired in time.
+    async def acquire(self, name: str, ttl_milliseconds: int, wait_seconds: float = 0) -> Optional[str]:
+        token = uuid.uuid4().hex
+        started_at = time.perf_counter()
+        deadline = started_at + wait_seconds
+        waited = False
+        while True:
+            remaining_milliseconds = int(await self.__acquire_script(
+                keys=[lock_key(name)], args=[token, ttl_milliseconds],
+            ))
+            now = time.perf_counter()
+            if remaining_milliseconds == 0:
+                break
+            if now + self.__MIN_WAIT_SECONDS >= deadline:
+                counters.incr('wait_timeouts' if waited else 'rejected')
+                return None
+            # The lock has expired since the 'SET NX'.
+            if remaining_milliseconds == -2:
+                continue
+            waited = True
+            # Wait until a release, or until the lock expires (if it has an expiration).
+            timeout = deadline - now
+            if remaining_milliseconds > 0:
+                timeout = max(min(timeout, remaining_milliseconds / 1000), self.__MIN_WAIT_SECONDS)
+            await self.df.blpop([lock_wakeup_key(name)], timeout=timeout)
+
+        counters.incr('acquired')
+        if waited:
+            counters.incr('acquired_after_wait')
+            counters.incr(metrics.duration_bucket('wait', now - started_at, LOCK_DURATION_BUCKETS_MS))
+        self.__acquired_at[token] = now
+        return token
+
+    # Release the lock of 'name' acquired with 'token'.
+    # Returns False if the lock is no longer held with the token, i.e., it has expired.
+    async def release(self, name: str, token: str, wakeup_milliseconds: int = 1000) -> bool:
+        acquired_at = self.__acquired_at.pop(token, None)
+        if acquired_at is not None:
+            counters.incr(metrics.duration_bucket('hold', time.perf_counter() - acquired_at, LOCK_DURATION_BUCKETS_MS))
+        released = bool(await self.__release_script(
+            keys=[lock_key(name), lock_wakeup_key(name)], args=[token, wakeup_milliseconds],
+        ))
+        counters.incr('released' if released else 'expired_before_release')
+        return released
@@ -1,41 +1,115 @@
-from eth_account import Account
+import asyncio
+from typing import List, Optional, Tuple
+
+from eth_account.datastructures import SignedTransaction
 from eth_account.signers.local import LocalAccount
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from hexbytes import HexBytes
-from redis import Redis as Dragonfly
-from sqlalchemy.orm import Session
-from web3 import Web3
+from redis.asyncio import Redis as AsyncDragonfly
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from web3 import AsyncWeb3
 
+import metrics
 import models
+import pools
 import utils
+from balance import BalanceLedger
+from codec import CACHE_EMPTY
 from deps import get_deps, get_constants
-from tasks import reconcile_transaction
+from locks import LockManager
+from nonce import NonceAllocator
+from status_stream import TransactionStatusHub
+
+# Imported for the counters of the Celery tasks, so that 'GET /metrics' reports their totals too.
+import tasks  # noqa: F401
 
 api_app = FastAPI()
 
+METRICS_FLUSH_INTERVAL_SECONDS = 10
+
+
+# Flush the in-process counters to Dragonfly periodically, so that the totals cover all the API server processes.
+async def _flush_metrics_periodically():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL_SECONDS)
+        for counters in metrics.registered_counters():
+            try:
+                await counters.async_flush(get_deps().get_async_dragonfly())
+            except Exception as e:
+                print(f"Failed to flush metrics '{counters.name}': {e}")
+
+
+@api_app.on_event("startup")
+async def start_metrics_flush():
+    api_app.state.metrics_flush_task = asyncio.create_task(_flush_metrics_periodically())
+
+
+@api_app.on_event("startup")
+async def open_async_web3_session():
+    await get_deps().open_async_web3_session()
+
+
+# Counters of this process, the totals across all the processes (API servers and Celery workers),
+# and the current occupancy of the connection pools of this process.
+@api_app.get("/metrics")
+async def get_metrics(
+        df: AsyncDragonfly = Depends(get_deps().get_async_dragonfly),
+) -> dict:
+    registered_counters = metrics.registered_counters()
+    pipe = df.pipeline(transaction=False)
+    for counters in registered_counters:
+        pipe.hgetall(metrics.metrics_key(counters.name))
+    totals = await pipe.execute()
+    return {
+        "process": {counters.name: counters.snapshot() for counters in registered_counters},
+        "totals": {
+            counters.name: {k.decode(): int(v) for k, v in total.items()}
+            for counters, total in zip(registered_counters, totals)
+        },
+        "pools": {stats.name: stats.occupancy() for stats in pools.registered_pools()},
+    }
+
 
 @api_app.post("/transactions")
 async def create_transaction(
         req: utils.TransactionRequest,
-        db: Session = Depends(get_deps().get_db_session),
-        df: Dragonfly = Depends(get_deps().get_dragonfly),
-        w3: Web3 = Depends(get_deps().get_web3),
+        db: AsyncSession = Depends(get_deps().get_async_db_session),
+        df: AsyncDragonfly = Depends(get_deps().get_async_dragonfly),
+        w3: AsyncWeb3 = Depends(get_deps().get_async_web3),
+        nonces: NonceAllocator = Depends(get_deps().get_nonce_allocator),
+        ledger: BalanceLedger = Depends(get_deps().get_balance_ledger),
+        locks: LockManager = Depends(get_deps().get_lock_manager),
 ) -> utils.TransactionResponse:
-    # Try to acquire a lock on the user account.
-    lock_key = utils.user_account_lock_key(req.user_account_id)
-    locked = df.set(
-        name=lock_key, value=utils.LOCK_VALUE,
-        nx=True, ex=utils.LOCK_EXPIRATION_SECONDS,
-    )
+    if get_constants().get_balance_mode() == get_constants().BALANCE_MODE_DRAGONFLY:
+        return await _create_transaction_with_ledger(req, db, df, w3, nonces, ledger)
 
-    if not locked:
+    # Lock the user account while the transaction is created, waiting for a concurrent request if configured.
+    lock_name = utils.user_account_lock_name(req.user_account_id)
+    lock_token = await locks.acquire(
+        lock_name, utils.LOCK_EXPIRATION_MILLISECONDS, get_constants().get_account_lock_wait_seconds(),
+    )
+    if lock_token is None:
         raise HTTPException(
             status_code=409,
-            detail="User account is locked since a transaction is submitted very recently. Please try again later.",
+            detail="User account is locked by another transaction in progress. Please try again later.",
         )
+    try:
+        return await _create_transaction_with_lock(req, db, w3, nonces)
+    finally:
+        await locks.release(lock_name, lock_token)
 
+
+# Create a transaction in the 'sql' balance mode, while holding the lock of the user account.
+async def _create_transaction_with_lock(
+        req: utils.TransactionRequest,
+        db: AsyncSession,
+        w3: AsyncWeb3,
+        nonces: NonceAllocator,
+) -> utils.TransactionResponse:
     # Read the user account from the database first.
-    user_account = db.query(models.UserAccount).get(req.user_account_id)
+    user_account = await db.get(models.UserAccount, req.user_account_id)
     if user_account is None:
         raise HTTPException(status_code=404, detail="User account not found")
 
@@ -43,28 +117,108 @@ async def create_transaction(
     if user_account.available_balance_in_wei < req.transaction_amount_in_wei:
         raise HTTPException(status_code=400, detail="Insufficient balance")
 
-    # Construct a web3 transaction object without sending it.
-    # Assume that the system account has enough balance to pay for the whole transaction.
-    sys_account_private_key = get_constants().get_system_account_private_key()
-    account: LocalAccount = Account.from_key(sys_account_private_key)
+    account, nonce, txn_signed = await _sign_transaction(req, w3, nonces)
+
+    # Create a new transaction record and update the user account balance within a database transaction.
+    # The outbox entry is committed along with them, and the outbox relay ('tasks.relay_transaction_outbox')
+    # caches the transaction and starts its reconciliation, even if this process crashes after the commit.
+    # If the commit fails, the allocated nonce is never used, so it is released.
+    txn = _new_pending_transaction(req, account, txn_signed)
+    db.add(txn)
+    db.add(models.UserAccountTransactionOutbox(user_account_transaction=txn))
+    user_account.available_balance_in_wei -= txn.transaction_amount_in_wei + txn.transaction_fee_total_in_wei
+    try:
+        await db.commit()
+    except Exception:
+        await nonces.release(account.address, nonce)
+        raise
+    await db.refresh(txn)
+
+    await _send_transaction(txn_signed, account, nonce, w3, nonces)
+
+    # Return the transaction response.
+    return utils.txn_to_response(txn)
+
+
+# Create a transaction in the 'dragonfly' balance mode.
+# The balance is debited and the transaction is enqueued atomically in Dragonfly, without the lock or a database commit.
+# The write-behind worker inserts the transaction into the database and then starts its reconciliation.
+async def _create_transaction_with_ledger(
+        req: utils.TransactionRequest,
+        db: AsyncSession,
+        df: AsyncDragonfly,
+        w3: AsyncWeb3,
+        nonces: NonceAllocator,
+        ledger: BalanceLedger,
+) -> utils.TransactionResponse:
+    # Check the balance before allocating a nonce, so that most rejected requests do not waste one.
+    available_balance_in_wei = await ledger.get_available_balance(db, req.user_account_id)
+    if available_balance_in_wei is None:
+        raise HTTPException(status_code=404, detail="User account not found")
+    if available_balance_in_wei < req.transaction_amount_in_wei + utils.TOTAL_TRANSACTION_FEE_IN_WEI:
+        raise HTTPException(status_code=400, detail="Insufficient balance")
+
+    account, nonce, txn_signed = await _sign_transaction(req, w3, nonces)
+
+    # The balance may have changed since the check above, so the debit checks it again atomically.
+    # If the debit fails, the allocated nonce is never used, so it is released.
+    txn = _new_pending_transaction(req, account, txn_signed)
+    try:
+        txn_id = await ledger.debit(db, txn, txn.transaction_amount_in_wei + txn.transaction_fee_total_in_wei)
+    except Exception:
+        await nonces.release(account.address, nonce)
+        raise
+    if txn_id is None:
+        await nonces.release(account.address, nonce)
+        raise HTTPException(status_code=400, detail="Insufficient balance")
+    txn.id = txn_id
+
+    await _send_transaction(txn_signed, account, nonce, w3, nonces)
+
+    # Cache the transaction in Dragonfly, so that it can be read before it is persisted.
+    txn_response = utils.txn_to_response(txn)
+    await get_deps().get_transaction_cache_codec().async_write(
+        df, txn_response, utils.txn_cache_expiration(txn.status),
+    )
+    return txn_response
+
+
+# Construct a web3 transaction object and sign it without sending it.
+# Assume that the system account has enough balance to pay for the whole transaction.
+# The system account is picked in a round-robin manner, and the nonce is allocated from Dragonfly.
+# The caller must finish the allocated nonce, either by sending the transaction or by releasing the nonce.
+async def _sign_transaction(
+        req: utils.TransactionRequest,
+        w3: AsyncWeb3,
+        nonces: NonceAllocator,
+) -> Tuple[LocalAccount, int, SignedTransaction]:
+    account: LocalAccount = await nonces.next_account()
+    nonce = await nonces.allocate(account.address)
     txn_raw = {
         'chainId': utils.SEPOLIA_CHAIN_ID,
         'from': account.address,
         'to': HexBytes(req.to_public_address),
         'value': req.transaction_amount_in_wei,
-        'nonce': w3.eth.get_transaction_count(account.address),
+        'nonce': nonce,
         'gas': 200000,
         'maxFeePerGas': 2000000000,
         'maxPriorityFeePerGas': 1000000000,
     }
-    txn_signed = w3.eth.account.sign_transaction(txn_raw, sys_account_private_key)
-    txn_hash_predicted = txn_signed.hash
+    try:
+        return account, nonce, w3.eth.account.sign_transaction(txn_raw, account.key)
+    except Exception:
+        await nonces.release(account.address, nonce)
+        raise
 
-    # Create a new transaction record and update the user account balance within a database transaction.
-    total_amount_in_wei = req.transaction_amount_in_wei + utils.TOTAL_TRANSACTION_FEE_IN_WEI
-    txn = models.UserAccountTransaction(
+
+def _new_pending_transaction(
+        req: utils.TransactionRequest,
+        account: LocalAccount,
+        txn_signed: SignedTransaction,
+) -> models.UserAccountTransaction:
+    return models.UserAccountTransaction(
         user_account_id=req.user_account_id,
-        transaction_hash=txn_hash_predicted.hex(),
+        transaction_hash=txn_signed.hash.hex(),
         from_public_address=account.address,
         to_public_address=req.to_public_address,
         transaction_amount_in_wei=req.transaction_amount_in_wei,
@@ -72,57 +226,183 @@ async def create_transaction(
         transaction_fee_blockchain_in_wei=0,
         status=models.UserAccountTransactionStatus.PENDING,
     )
-    db.add(txn)
-    user_account.available_balance_in_wei -= total_amount_in_wei
-    db.commit()
-    db.refresh(txn)
-
-    # Send the transaction to the blockchain.
-    txn_hash_actual = w3.eth.send_raw_transaction(txn_signed.rawTransaction)
-    if txn_hash_actual != txn_hash_predicted:
-        print(f"Transaction hash mismatch! Predicted: {txn_hash_predicted.hex()}. Actual: {txn_hash_actual.hex()}")
+
+
+# Send the transaction to the blockchain.
+# If sending fails, the allocated nonce may never be used, so it is released unless the chain has seen it.
+async def _send_transaction(
+        txn_signed: SignedTransaction,
+        account: LocalAccount,
+        nonce: int,
+        w3: AsyncWeb3,
+        nonces: NonceAllocator,
+):
+    try:
+        txn_hash_actual = await w3.eth.send_raw_transaction(txn_signed.rawTransaction)
+    except Exception:
+        await nonces.release(account.address, nonce, sent=True)
+        raise
+    await nonces.complete(account.address, nonce)
+    if txn_hash_actual != txn_signed.hash:
+        print(f"Transaction hash mismatch! Predicted: {txn_signed.hash.hex()}. Actual: {txn_hash_actual.hex()}")
         raise HTTPException(status_code=500, detail="Transaction hash mismatch")
 
-    # Cache the transaction in Dragonfly.
-    cache_key = utils.txn_cache_key(txn.id)
-    mapping = utils.txn_to_dict(txn)
-    utils.hset_and_expire(df, cache_key, mapping, utils.CACHE_NORMAL_EXPIRATION_SECONDS)
 
-    # Start the transaction reconciliation task.
-    reconcile_transaction.delay(txn.id)
+# Read many transactions at once.
+# All the cache entries are read in one pipeline, all the cache misses are read from the database in one query,
+# and the cache is backfilled (including empty values for the missing transactions) in one pipeline.
+@api_app.post("/transactions:batchGet")
+async def batch_get_transactions(
+        req: utils.TransactionBatchGetRequest,
+        db: AsyncSession = Depends(get_deps().get_async_db_session),
+        df: AsyncDragonfly = Depends(get_deps().get_async_dragonfly),
+) -> utils.TransactionBatchGetResponse:
+    txn_ids = list(dict.fromkeys(req.ids))
+    if len(txn_ids) > utils.TXN_BATCH_GET_MAX_IDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {utils.TXN_BATCH_GET_MAX_IDS} transactions can be read in a batch",
+        )
 
-    # Return the transaction response.
-    return utils.txn_to_response(txn)
+    # Try to read the transactions from Dragonfly first.
+    codec = get_deps().get_transaction_cache_codec()
+    pipe = df.pipeline(transaction=False)
+    for txn_id in txn_ids:
+        codec.queue_read(pipe, txn_id)
+    cached_txns = await pipe.execute()
+
+    found_txns = {}
+    not_found_txn_ids = set()
+    missed_txn_ids = []
+    for txn_id, cached_txn in zip(txn_ids, cached_txns):
+        cached_txn = codec.decode(cached_txn)
+        if cached_txn is CACHE_EMPTY:
+            not_found_txn_ids.add(txn_id)
+        elif cached_txn is not None:
+            found_txns[txn_id] = cached_txn
+        else:
+            missed_txn_ids.append(txn_id)
+
+    # Read the cache misses from the database, and backfill the cache.
+    if missed_txn_ids:
+        result = await db.execute(
+            select(models.UserAccountTransaction).where(models.UserAccountTransaction.id.in_(missed_txn_ids))
+        )
+        txns = result.scalars().all()
+        pipe = df.pipeline(transaction=False)
+        for txn in txns:
+            found_txns[txn.id] = utils.txn_to_response(txn)
+            codec.queue_write(pipe, found_txns[txn.id], utils.txn_cache_expiration(txn.status))
+        for txn_id in missed_txn_ids:
+            if txn_id in found_txns:
+                continue
+            not_found_txn_ids.add(txn_id)
+            codec.queue_write_empty(pipe, txn_id, utils.CACHE_EMPTY_EXPIRATION_SECONDS)
+        await pipe.execute()
+
+    return utils.TransactionBatchGetResponse(
+        transactions=[found_txns[txn_id] for txn_id in txn_ids if txn_id in found_txns],
+        not_found_ids=[txn_id for txn_id in txn_ids if txn_id in not_found_txn_ids],
+    )
+
+
+# Stream status updates of one or many transactions with Server-Sent Events, instead of polling.
+# The current state of each transaction is sent first, followed by an event for every status change.
+# The stream ends once all the watched transactions reach a terminal state (or are not found).
+#
+#   curl -N 'http://localhost:8000/transactions/events?ids=1&ids=2'
+@api_app.get("/transactions/events")
+async def stream_transaction_events(
+        request: Request,
+        ids: List[int] = Query(..., max_length=utils.TXN_EVENTS_MAX_IDS),
+        df: AsyncDragonfly = Depends(get_deps().get_async_dragonfly),
+        hub: TransactionStatusHub = Depends(get_deps().get_transaction_status_hub),
+) -> StreamingResponse:
+    txn_ids = set(ids)
+
+    # Subscribe before reading the current states, so that no update in between is missed.
+    queue = await hub.subscribe(txn_ids)
+    initial_events = []
+    try:
+        for txn_id in txn_ids:
+            txn = await _read_transaction(txn_id, df)
+            if txn is None:
+                initial_events.append(("not_found", {"id": txn_id}))
+            else:
+                initial_events.append(("status", utils.txn_response_to_status_update(txn)))
+    except Exception:
+        hub.unsubscribe(txn_ids, queue)
+        raise
+
+    async def event_generator():
+        watching = set(txn_ids)
+        try:
+            for event, data in initial_events:
+                if event == "not_found" or data["status"] != models.UserAccountTransactionStatus.PENDING.name:
+                    watching.discard(data["id"])
+                yield utils.sse_event(event, data)
+            while watching:
+                if await request.is_disconnected():
+                    break
+                try:
+                    update = await asyncio.wait_for(queue.get(), timeout=utils.TXN_EVENTS_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Comment lines keep the connection alive through proxies.
+                    yield ": keep-alive\n\n"
+                    continue
+                data = utils.stream_entry_to_status_update(update)
+                if data["id"] not in watching:
+                    continue
+                if data["status"] != models.UserAccountTransactionStatus.PENDING.name:
+                    watching.discard(data["id"])
+                yield utils.sse_event("status", data)
+        finally:
+            hub.unsubscribe(txn_ids, queue)
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream")
 
 
 @api_app.get("/transactions/{txn_id}")
 async def get_transaction(
         txn_id: int,
-        db: Session = Depends(get_deps().get_db_session),
-        df: Dragonfly = Depends(get_deps().get_dragonfly),
+        df: AsyncDragonfly = Depends(get_deps().get_async_dragonfly),
 ) -> utils.TransactionResponse:
-    cache_key = utils.txn_cache_key(txn_id)
+    txn = await _read_transaction(txn_id, df)
+    if txn is None:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+    return txn
 
-    # Try to read the transaction from Dragonfly first.
-    cached_txn = df.hgetall(cache_key)
 
-    # Empty cache value with only the ID.
-    if len(cached_txn) == 1:
-        raise HTTPException(status_code=404, detail="Transaction not found")
-    # Cache hit.
-    elif len(cached_txn) > 1:
-        return utils.txn_dict_to_response(cached_txn)
+async def _read_transaction(
+        txn_id: int,
+        df: AsyncDragonfly,
+) -> Optional[utils.TransactionResponse]:
+    codec = get_deps().get_transaction_cache_codec()
+    cache_key = codec.key(txn_id)
 
-    # Cache miss, read from the database.
-    txn = db.query(models.UserAccountTransaction).get(txn_id)
+    async def read_cache():
+        return await codec.async_read(df, txn_id)
 
-    # If the transaction is not found, cache an empty value with only the ID and return a 404.
-    # Caching an empty value is important to prevent cache penetrations.
-    if txn is None:
-        utils.hset_and_expire(df, cache_key, {"id": txn_id}, utils.CACHE_EMPTY_EXPIRATION_SECONDS)
-        raise HTTPException(status_code=404, detail="Transaction not found")
+    # The rebuild may outlive this request, if other requests are waiting for it, so it uses its own database session.
+    async def rebuild():
+        async with get_deps().new_async_db_session() as db:
+            txn = await db.get(models.UserAccountTransaction, txn_id)
 
-    # Cache the transaction in Dragonfly and return the response.
-    mapping = utils.txn_to_dict(txn)
-    utils.hset_and_expire(df, cache_key, mapping, utils.CACHE_NORMAL_EXPIRATION_SECONDS)
-    return utils.txn_to_response(txn)
+        # If the transaction is not found, cache an empty value.
+        # Caching an empty value is important to prevent cache penetrations.
+        if txn is None:
+            await codec.async_write_empty(df, txn_id, utils.CACHE_EMPTY_EXPIRATION_SECONDS)
+            return CACHE_EMPTY
+
+        # Cache the transaction in Dragonfly.
+        txn_response = utils.txn_to_response(txn)
+        await codec.async_write(df, txn_response, utils.txn_cache_expiration(txn.status))
+        return txn_response
+
+    # Try to read the transaction from Dragonfly first.
+    # On a cache miss, read from the database. Concurrent misses of the same transaction,
+    # within this process or across processes, share a single database read.
+    txn = await read_cache()
+    if txn is None:
+        txn = await get_deps().get_single_flight().load(cache_key, read_cache, rebuild)
+    return None if txn is CACHE_EMPTY else txn
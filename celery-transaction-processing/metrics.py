@@ -0,0 +1,87 @@
+import threading
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from redis import Redis as Dragonfly
+from redis.asyncio import Redis as AsyncDragonfly
+
+
+def metrics_key(name: str) -> str:
+    return f"metrics:{name}"
+
+
+# Counters are incremented in-process and flushed to a Dragonfly hash periodically.
+# Since HINCRBY is atomic, every process (API servers, Celery workers) can flush into the same hash,
+# and the hash holds the totals across all processes: 'HGETALL metrics:{name}'.
+class Counters:
+    def __init__(self, name: str):
+        self.name = name
+        self.__lock = threading.Lock()
+        self.__values: Dict[str, int] = defaultdict(int)
+        self.__unflushed: Dict[str, int] = defaultdict(int)
+        _registry.append(self)
+
+    def incr(self, field: str, amount: int = 1):
+        with self.__lock:
+            self.__values[field] += amount
+            self.__unflushed[field] += amount
+
+    # Returns the counters of this process since it started.
+    def snapshot(self) -> Dict[str, int]:
+        with self.__lock:
+            return dict(self.__values)
+
+    def flush(self, df: Dragonfly):
+        unflushed = self.__take_unflushed()
+        if not unflushed:
+            return
+        try:
+            self.__queue_flush(df, unflushed).execute()
+        except Exception:
+            self.__restore_unflushed(unflushed)
+            raise
+
+    async def async_flush(self, df: AsyncDragonfly):
+        unflushed = self.__take_unflushed()
+        if not unflushed:
+            return
+        try:
+            await self.__queue_flush(df, unflushed).execute()
+        except Exception:
+            self.__restore_unflushed(unflushed)
+            raise
+
+    def __take_unflushed(self) -> Dict[str, int]:
+        with self.__lock:
+            unflushed, self.__unflushed = self.__unflushed, defaultdict(int)
+        return unflushed
+
+    def __queue_flush(self, df, unflushed: Dict[str, int]):
+        pipe = df.pipeline(transaction=False)
+        for field, amount in unflushed.items():
+            pipe.hincrby(metrics_key(self.name), field, amount)
+        return pipe
+
+    # Keep the increments of a failed flush, so they are flushed next time.
+    def __restore_unflushed(self, unflushed: Dict[str, int]):
+        with self.__lock:
+            for field, amount in unflushed.items():
+                self.__unflushed[field] += amount
+
+
+# Returns the histogram counter field of a duration, i.e., '{prefix}_le_10ms' for 5 ms with the buckets (1, 10, 100).
+# Durations above the last bucket fall in '{prefix}_gt_{last}ms'.
+def duration_bucket(prefix: str, seconds: float, buckets_ms: Tuple[int, ...]) -> str:
+    milliseconds = seconds * 1000
+    for bucket in buckets_ms:
+        if milliseconds <= bucket:
+            return f'{prefix}_le_{bucket}ms'
+    return f'{prefix}_gt_{buckets_ms[-1]}ms'
+
+
+_registry: List[Counters] = []
+
+
+# Returns all the counters created in this process.
+def registered_counters() -> List[Counters]:
+    return list(_registry)
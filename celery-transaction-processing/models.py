@@ -37,3 +37,15 @@ class UserAccountTransaction(Base):
     status = Column(Enum(UserAccountTransactionStatus), nullable=False)
 
     user_account = relationship("UserAccount", back_populates="user_account_transactions")
+
+
+# Transactions whose reconciliation is not started yet.
+# An entry is inserted in the same database transaction as the transaction itself,
+# and deleted by the outbox relay ('tasks.relay_transaction_outbox') after it starts the reconciliation.
+class UserAccountTransactionOutbox(Base):
+    __tablename__ = "user_account_transaction_outbox"
+
+    id = Column(Integer, primary_key=True)
+    user_account_transaction_id = Column(Integer, ForeignKey("user_account_transactions.id"), nullable=False)
+
+    user_account_transaction = relationship("UserAccountTransaction")
@@ -21,3 +21,11 @@ CREATE TABLE user_account_transactions
 );
 
 CREATE INDEX idx_user_account_id ON user_account_transactions (user_account_id);
+
+CREATE TABLE user_account_transaction_outbox
+(
+    id                          INTEGER PRIMARY KEY,
+    user_account_transaction_id INTEGER NOT NULL,
+
+    FOREIGN KEY (user_account_transaction_id) REFERENCES user_account_transactions (id)
+);
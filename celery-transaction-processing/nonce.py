@@ -0,0 +1,146 @@
+from typing import Final, List
+
+from eth_account.signers.local import LocalAccount
+from redis.asyncio import Redis as AsyncDragonfly
+from web3 import AsyncWeb3
+
+# Check the allocated nonce against the chain every N allocations.
+NONCE_GAP_CHECK_INTERVAL: Final[int] = 100
+# If the next allocated nonce is ahead of the chain (including pending transactions) by more than this,
+# some allocated nonces were never used, and the transactions after them are stuck. Thus, we resync.
+NONCE_MAX_GAP: Final[int] = 256
+# Allocations that are neither completed nor released within this period (e.g., the process crashed) are forgotten.
+NONCE_IN_FLIGHT_EXPIRATION_MILLISECONDS: Final[int] = 60_000
+
+ROUND_ROBIN_KEY: Final[str] = "system_account_round_robin"
+
+
+def nonce_key(address: str) -> str:
+    return f"system_account_nonce:{address}"
+
+
+def nonce_in_flight_key(address: str) -> str:
+    return f"system_account_nonce_in_flight:{address}"
+
+
+# Hands out nonces for the system (sender) accounts with an atomic INCR in Dragonfly,
+# instead of calling 'eth_getTransactionCount' for every transaction.
+# Multiple API server processes share the same counters, so concurrent transactions never race for the same nonce.
+#
+# The counter holds the next nonce to allocate. It is seeded from the chain once, and resynced on errors or gaps.
+# Allocated nonces that are not sent yet are counted as in flight, and the counter is never moved back
+# while any of them are outstanding, since their nonces would be handed out again.
+# The in-flight counter expires, so that a crashed process does not block resyncs forever.
+class NonceAllocator:
+    # INCR only if the counter exists, since INCR on a missing key would start from 0 instead of the chain.
+    # Returns the allocated nonce, which is the counter value before the increment.
+    __ALLOCATE_SCRIPT: Final[str] = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+redis.call('INCR', KEYS[2])
+redis.call('PEXPIRE', KEYS[2], ARGV[1])
+return redis.call('INCR', KEYS[1]) - 1
+"""
+
+    # Finish an allocation, without letting the in-flight counter go below 0 after it expired.
+    __COMPLETE_SCRIPT: Final[str] = """
+if tonumber(redis.call('GET', KEYS[1]) or '0') > 0 then
+    redis.call('DECR', KEYS[1])
+end
+"""
+
+    # Finish an allocation whose nonce is unused, and give the nonce back if it is the last one allocated
+    # and the chain has not seen it (ARGV[2] is the transaction count on chain, or 0 if never sent).
+    # Returns 1 if the nonce is released, and 0 if other nonces were allocated after it.
+    __RELEASE_SCRIPT: Final[str] = """
+if tonumber(redis.call('GET', KEYS[2]) or '0') > 0 then
+    redis.call('DECR', KEYS[2])
+end
+local nonce = tonumber(ARGV[1])
+if tonumber(redis.call('GET', KEYS[1])) == nonce + 1 and nonce >= tonumber(ARGV[2]) then
+    redis.call('SET', KEYS[1], nonce)
+    return 1
+end
+return 0
+"""
+
+    # Move the counter to the transaction count on chain (ARGV[1]).
+    # Moving forward is always safe, but moving back is only safe when no allocations are outstanding.
+    # Returns 1 if the counter is set, and 0 otherwise.
+    __RESYNC_SCRIPT: Final[str] = """
+local current = tonumber(redis.call('GET', KEYS[1]))
+local count = tonumber(ARGV[1])
+if current == nil or count > current then
+    redis.call('SET', KEYS[1], count)
+    return 1
+end
+if current > count and tonumber(redis.call('GET', KEYS[2]) or '0') == 0 then
+    redis.call('SET', KEYS[1], count)
+    return 1
+end
+return 0
+"""
+
+    def __init__(self, df: AsyncDragonfly, w3: AsyncWeb3, accounts: List[LocalAccount]):
+        if not accounts:
+            raise ValueError("At least one system account is required")
+        self.df = df
+        self.w3 = w3
+        self.accounts = accounts
+        self.__allocate_script = df.register_script(self.__ALLOCATE_SCRIPT)
+        self.__complete_script = df.register_script(self.__COMPLETE_SCRIPT)
+        self.__release_script = df.register_script(self.__RELEASE_SCRIPT)
+        self.__resync_script = df.register_script(self.__RESYNC_SCRIPT)
+
+    # Pick the next system account in a round-robin manner across all API server processes.
+    async def next_account(self) -> LocalAccount:
+        if len(self.accounts) == 1:
+            return self.accounts[0]
+        index = await self.df.incr(ROUND_ROBIN_KEY) - 1
+        return self.accounts[index % len(self.accounts)]
+
+    # Every allocated nonce must be finished by either 'complete' or 'release'.
+    async def allocate(self, address: str) -> int:
+        keys = [nonce_key(address), nonce_in_flight_key(address)]
+        nonce = await self.__allocate_script(keys=keys, args=[NONCE_IN_FLIGHT_EXPIRATION_MILLISECONDS])
+        if nonce is None:
+            await self.__seed(address)
+            nonce = await self.__allocate_script(keys=keys, args=[NONCE_IN_FLIGHT_EXPIRATION_MILLISECONDS])
+        return int(nonce)
+
+    # Finish the allocation once the transaction is sent.
+    async def complete(self, address: str, nonce: int):
+        await self.__complete_script(keys=[nonce_in_flight_key(address)])
+        if nonce > 0 and nonce % NONCE_GAP_CHECK_INTERVAL == 0:
+            await self.__resync_if_gap(address, nonce)
+
+    # Finish the allocation when the transaction is not sent (e.g., the debit fails), or sending fails ('sent=True').
+    # The nonce is given back if no other nonce was allocated after it. Otherwise, it leaves a gap,
+    # and the counter is resynced with the chain (which only moves it back when no allocations are outstanding).
+    # If sending fails, the transaction may still have reached the chain, so the chain is checked first.
+    async def release(self, address: str, nonce: int, sent: bool = False):
+        count = await self.__get_transaction_count(address) if sent else 0
+        keys = [nonce_key(address), nonce_in_flight_key(address)]
+        if await self.__release_script(keys=keys, args=[nonce, count]) == 1:
+            return
+        if not sent:
+            count = await self.__get_transaction_count(address)
+        await self.__resync_script(keys=keys, args=[count])
+
+    # Resync the counter with the transaction count on chain, including pending transactions.
+    async def resync(self, address: str):
+        count = await self.__get_transaction_count(address)
+        await self.__resync_script(keys=[nonce_key(address), nonce_in_flight_key(address)], args=[count])
+
+    async def __get_transaction_count(self, address: str) -> int:
+        return await self.w3.eth.get_transaction_count(address, 'pending')
+
+    async def __seed(self, address: str):
+        count = await self.__get_transaction_count(address)
+        await self.df.set(nonce_key(address), count, nx=True)
+
+    async def __resync_if_gap(self, address: str, sent_nonce: int):
+        count = await self.__get_transaction_count(address)
+        if sent_nonce - count > NONCE_MAX_GAP:
+            await self.__resync_script(keys=[nonce_key(address), nonce_in_flight_key(address)], args=[count])
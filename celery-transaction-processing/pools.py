@@ -0,0 +1,355 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Callable, Dict, Final, List, Optional, Type, TypeVar
+
+import aiohttp
+import requests
+from redis import BlockingConnectionPool as DragonflyBlockingConnectionPool
+from redis.asyncio import BlockingConnectionPool as AsyncDragonflyBlockingConnectionPool
+from requests.adapters import HTTPAdapter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+
+import metrics
+
+# Connection pools of the Dragonfly, database, and Web3 HTTP clients, instrumented for sizing.
+#
+# Each pool counts, in the 'pool_{name}' counters (flushed to Dragonfly like the other counters):
+#   - checkouts, and the total checkout latency in microseconds (including connecting a new connection).
+#   - checkout_le_{n}ms / checkout_gt_{n}ms: a histogram of the checkout latency.
+#   - waits, and the total wait in microseconds: checkouts that found the pool exhausted and had to wait.
+#   - hold_us_total: how long connections are held, i.e., the pool size needed is roughly
+#     'hold_us_total / elapsed time' at the peak.
+#   - errors and timeouts of checkouts.
+# The occupancy of the pools in this process is read on demand (see 'PoolStats.occupancy').
+CHECKOUT_LATENCY_BUCKETS_MS: Final[tuple] = (1, 10, 100, 1000)
+
+
+@dataclass(frozen=True)
+class DragonflyPoolConfig:
+    max_connections: int
+    timeout_seconds: float
+    socket_timeout_seconds: float
+    socket_connect_timeout_seconds: float
+    health_check_interval_seconds: int
+
+
+@dataclass(frozen=True)
+class DatabasePoolConfig:
+    pool_size: int
+    max_overflow: int
+    timeout_seconds: float
+    recycle_seconds: int
+    pre_ping: bool
+
+
+@dataclass(frozen=True)
+class HTTPPoolConfig:
+    max_connections: int
+    timeout_seconds: float
+
+
+class PoolStats:
+    def __init__(self, name: str, max_size: int):
+        self.name = name
+        self.max_size = max_size
+        self.counters = metrics.Counters(f'pool_{name}')
+        self.__occupancy: Callable[[], Dict[str, int]] = dict
+        _registry.append(self)
+
+    def set_occupancy(self, occupancy: Callable[[], Dict[str, int]]):
+        self.__occupancy = occupancy
+
+    # Returns the current occupancy of the pool in this process.
+    def occupancy(self) -> Dict[str, int]:
+        return {"max_size": self.max_size, **self.__occupancy()}
+
+    def record_checkout(self, seconds: float, waited: bool):
+        microseconds = int(seconds * 1e6)
+        self.counters.incr('checkouts')
+        self.counters.incr('checkout_us_total', microseconds)
+        self.counters.incr(metrics.duration_bucket('checkout', seconds, CHECKOUT_LATENCY_BUCKETS_MS))
+        if waited:
+            self.counters.incr('waits')
+            self.counters.incr('wait_us_total', microseconds)
+
+    def record_hold(self, seconds: float):
+        self.counters.incr('hold_us_total', int(seconds * 1e6))
+
+    def record_error(self, timeout: bool = False):
+        self.counters.incr('timeouts' if timeout else 'errors')
+
+
+_registry: List[PoolStats] = []
+
+
+# Returns all the pools created in this process.
+def registered_pools() -> List[PoolStats]:
+    return list(_registry)
+
+
+def flush(df):
+    for stats in registered_pools():
+        stats.counters.flush(df)
+
+
+PoolClass = TypeVar('PoolClass', bound=type)
+
+
+# The pool classes below read their stats (and settings) from class attributes, since the pools are constructed
+# by the libraries (from URLs, per host, or on 'Engine.dispose'), which do not pass extra arguments through.
+def bind(pool_class: Type[PoolClass], stats: PoolStats, **attributes) -> Type[PoolClass]:
+    return type(pool_class.__name__, (pool_class,), {'stats': stats, **attributes})
+
+
+def _timed_out(started_at: float, timeout: Optional[float]) -> bool:
+    return timeout is not None and time.perf_counter() - started_at >= timeout
+
+
+# Dragonfly.
+#
+# The blocking pools wait up to 'timeout' seconds for a connection when all 'max_connections' are in use,
+# instead of raising right away as the default pools do.
+class InstrumentedDragonflyConnectionPool(DragonflyBlockingConnectionPool):
+    stats: PoolStats
+
+    def get_connection(self, command_name, *keys, **options):
+        # The queue holds a placeholder for every connection not created yet, so it is empty only when exhausted.
+        waited = self.pool.empty()
+        started_at = time.perf_counter()
+        try:
+            connection = super().get_connection(command_name, *keys, **options)
+        except Exception:
+            self.stats.record_error(timeout=waited and _timed_out(started_at, self.timeout))
+            raise
+        connection.pool_checked_out_at = time.perf_counter()
+        self.stats.record_checkout(connection.pool_checked_out_at - started_at, waited)
+        return connection
+
+    def release(self, connection):
+        checked_out_at = getattr(connection, 'pool_checked_out_at', None)
+        if checked_out_at is not None:
+            self.stats.record_hold(time.perf_counter() - checked_out_at)
+            connection.pool_checked_out_at = None
+        super().release(connection)
+
+    def occupancy(self) -> Dict[str, int]:
+        return {
+            "in_use": self.max_connections - self.pool.qsize(),
+            "connections": len(self._connections),
+        }
+
+
+class InstrumentedAsyncDragonflyConnectionPool(AsyncDragonflyBlockingConnectionPool):
+    stats: PoolStats
+
+    async def get_connection(self, command_name, *keys, **options):
+        waited = not self.can_get_connection()
+        started_at = time.perf_counter()
+        try:
+            connection = await super().get_connection(command_name, *keys, **options)
+        except Exception:
+            self.stats.record_error(timeout=waited and _timed_out(started_at, self.timeout))
+            raise
+        connection.pool_checked_out_at = time.perf_counter()
+        self.stats.record_checkout(connection.pool_checked_out_at - started_at, waited)
+        return connection
+
+    async def release(self, connection):
+        checked_out_at = getattr(connection, 'pool_checked_out_at', None)
+        if checked_out_at is not None:
+            self.stats.record_hold(time.perf_counter() - checked_out_at)
+            connection.pool_checked_out_at = None
+        await super().release(connection)
+
+    def occupancy(self) -> Dict[str, int]:
+        in_use = len(self._in_use_connections)
+        return {"in_use": in_use, "connections": in_use + len(self._available_connections)}
+
+
+# Database.
+#
+# The checkout latency is measured around 'QueuePool._do_get', which waits for a connection
+# (up to 'pool_timeout' seconds) and connects new ones. The hold time is measured with the pool events,
+# which are kept when the engine recreates its pool.
+class _InstrumentedQueuePoolMixin:
+    stats: PoolStats
+
+    def _do_get(self):
+        waited = self.checkedin() == 0 and -1 < self._max_overflow <= self.overflow()
+        started_at = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.stats.record_error(timeout=True)
+            raise
+        except Exception:
+            self.stats.record_error()
+            raise
+        self.stats.record_checkout(time.perf_counter() - started_at, waited)
+        return connection
+
+
+class InstrumentedQueuePool(_InstrumentedQueuePoolMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncAdaptedQueuePool(_InstrumentedQueuePoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def instrument_engine(engine: Engine, stats: PoolStats):
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(_dbapi_connection, connection_record, _connection_proxy):
+        connection_record.info['pool_checked_out_at'] = time.perf_counter()
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(_dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop('pool_checked_out_at', None)
+        if checked_out_at is not None:
+            stats.record_hold(time.perf_counter() - checked_out_at)
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(_dbapi_connection, _connection_record):
+        stats.counters.incr('connects')
+
+    # 'engine.pool' is replaced on 'Engine.dispose', so it is looked up on every read.
+    stats.set_occupancy(lambda: {
+        "in_use": engine.pool.checkedout(),
+        "idle": engine.pool.checkedin(),
+        "overflow": max(engine.pool.overflow(), 0),
+    })
+
+
+# Web3 HTTP (sync).
+#
+# A requests session with a single blocking connection pool per host: requests wait for a free connection
+# instead of opening extra connections that are discarded afterwards, which the default adapter does.
+class _InstrumentedHTTPConnectionPoolMixin:
+    stats: PoolStats
+    # requests does not pass a pool timeout, which would make the requests wait for a connection indefinitely.
+    checkout_timeout: Optional[float] = None
+
+    def _get_conn(self, timeout=None):
+        waited = self.pool is not None and self.pool.empty()
+        started_at = time.perf_counter()
+        try:
+            connection = super()._get_conn(self.checkout_timeout if timeout is None else timeout)
+        except EmptyPoolError:
+            self.stats.record_error(timeout=True)
+            raise
+        except Exception:
+            self.stats.record_error()
+            raise
+        connection.pool_checked_out_at = time.perf_counter()
+        self.stats.record_checkout(connection.pool_checked_out_at - started_at, waited)
+        return connection
+
+    def _put_conn(self, connection):
+        checked_out_at = getattr(connection, 'pool_checked_out_at', None)
+        if checked_out_at is not None:
+            self.stats.record_hold(time.perf_counter() - checked_out_at)
+            connection.pool_checked_out_at = None
+        super()._put_conn(connection)
+
+
+class InstrumentedHTTPConnectionPool(_InstrumentedHTTPConnectionPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class InstrumentedHTTPSConnectionPool(_InstrumentedHTTPConnectionPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _InstrumentedHTTPAdapter(HTTPAdapter):
+    def __init__(self, stats: PoolStats, checkout_timeout: float, **kwargs):
+        self.stats = stats
+        self.checkout_timeout = checkout_timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': bind(InstrumentedHTTPConnectionPool, self.stats, checkout_timeout=self.checkout_timeout),
+            'https': bind(InstrumentedHTTPSConnectionPool, self.stats, checkout_timeout=self.checkout_timeout),
+        }
+
+    def occupancy(self) -> Dict[str, int]:
+        in_use = connections = 0
+        for key in self.poolmanager.pools.keys():
+            pool = self.poolmanager.pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            in_use += pool.pool.maxsize - pool.pool.qsize()
+            connections += pool.num_connections
+        return {"in_use": in_use, "connections": connections}
+
+
+def create_http_session(stats: PoolStats, config: HTTPPoolConfig) -> requests.Session:
+    adapter = _InstrumentedHTTPAdapter(
+        stats,
+        config.timeout_seconds,
+        pool_connections=1,
+        pool_maxsize=config.max_connections,
+        pool_block=True,
+    )
+    stats.set_occupancy(adapter.occupancy)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Web3 HTTP (async).
+#
+# aiohttp queues requests in the connector when 'limit' connections are in use, and reports it through the tracing
+# signals. The checkout latency is from the start of a request until it has a connection (reused or new),
+# and the hold time is until the response headers are received.
+# The session must be created in the event loop that uses it.
+def create_aiohttp_session(stats: PoolStats, config: HTTPPoolConfig) -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(limit=config.max_connections)
+    in_flight = {"in_use": 0}
+
+    async def on_request_start(_session, context: SimpleNamespace, _params):
+        in_flight["in_use"] += 1
+        context.started_at = time.perf_counter()
+        context.waited = False
+        context.checked_out_at = None
+
+    async def on_connection_queued_start(_session, context: SimpleNamespace, _params):
+        context.waited = True
+
+    async def on_connection_checked_out(_session, context: SimpleNamespace, _params):
+        context.checked_out_at = time.perf_counter()
+        stats.record_checkout(context.checked_out_at - context.started_at, context.waited)
+
+    async def on_request_end(_session, context: SimpleNamespace, _params):
+        in_flight["in_use"] -= 1
+        if context.checked_out_at is not None:
+            stats.record_hold(time.perf_counter() - context.checked_out_at)
+
+    async def on_request_exception(_session, context: SimpleNamespace, params):
+        in_flight["in_use"] -= 1
+        if context.checked_out_at is not None:
+            stats.record_hold(time.perf_counter() - context.checked_out_at)
+        else:
+            stats.record_error(timeout=isinstance(params.exception, asyncio.TimeoutError))
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_queued_start.append(on_connection_queued_start)
+    trace_config.on_connection_create_end.append(on_connection_checked_out)
+    trace_config.on_connection_reuseconn.append(on_connection_checked_out)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+
+    stats.set_occupancy(lambda: dict(in_flight))
+    # The Web3 provider expects errors to be raised on HTTP error statuses, as its default session does.
+    return aiohttp.ClientSession(connector=connector, raise_for_status=True, trace_configs=[trace_config])
+
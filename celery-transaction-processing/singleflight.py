@@ -0,0 +1,94 @@
+import asyncio
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Final, Optional
+
+from redis.asyncio import Redis as AsyncDragonfly
+
+import metrics
+
+# How long a process holds the lease to rebuild a cache entry.
+LEASE_MILLISECONDS: Final[int] = 500
+# How often the processes without the lease check whether the cache entry is rebuilt.
+LEASE_WAIT_INTERVAL_SECONDS: Final[float] = 0.01
+
+counters = metrics.Counters('singleflight')
+
+
+def lease_key(cache_key: str) -> str:
+    return f"lease:{cache_key}"
+
+
+# Coalesces concurrent rebuilds of the same cache entry, so that an expired popular entry
+# does not send every concurrent request to the database (thundering herd).
+#
+# - Within a process, concurrent callers of the same key share one in-flight rebuild.
+#   The rebuild runs in its own task, which every caller awaits through 'asyncio.shield',
+#   so cancelling the caller that started it (e.g., the client disconnected) does not fail the other callers.
+# - Across processes, a short lease in Dragonfly (SET NX PX) lets only one process rebuild the entry.
+#   The other processes wait for the entry to appear in the cache, until the lease expires.
+#   If the leaseholder fails to rebuild in time, the waiting process rebuilds the entry itself.
+class SingleFlight:
+    # Delete the lease only if it is still owned by the caller.
+    __RELEASE_SCRIPT: Final[str] = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+    def __init__(self, df: AsyncDragonfly):
+        self.df = df
+        self.__in_flight: Dict[str, asyncio.Task] = {}
+        self.__release_script = df.register_script(self.__RELEASE_SCRIPT)
+
+    # Load the value of 'cache_key'.
+    # 'read_cache' returns the cached value, or None on a cache miss.
+    # 'rebuild' reads the value from the source of truth, writes it to the cache, and returns it.
+    async def load(
+            self,
+            cache_key: str,
+            read_cache: Callable[[], Awaitable[Optional[Any]]],
+            rebuild: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        in_flight = self.__in_flight.get(cache_key)
+        if in_flight is not None:
+            counters.incr('coalesced_in_process')
+        else:
+            in_flight = asyncio.create_task(self.__load_with_lease(cache_key, read_cache, rebuild))
+            self.__in_flight[cache_key] = in_flight
+            in_flight.add_done_callback(lambda task: self.__done(cache_key, task))
+        return await asyncio.shield(in_flight)
+
+    def __done(self, cache_key: str, task: asyncio.Task):
+        if self.__in_flight.get(cache_key) is task:
+            del self.__in_flight[cache_key]
+        # Mark the exception as retrieved, in case all the callers have been cancelled.
+        if not task.cancelled():
+            task.exception()
+
+    async def __load_with_lease(
+            self,
+            cache_key: str,
+            read_cache: Callable[[], Awaitable[Optional[Any]]],
+            rebuild: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        token = uuid.uuid4().hex
+        acquired = await self.df.set(lease_key(cache_key), token, nx=True, px=LEASE_MILLISECONDS)
+        if not acquired:
+            # Another process is rebuilding the entry. Wait for it to appear in the cache.
+            deadline = time.monotonic() + LEASE_MILLISECONDS / 1000
+            while time.monotonic() < deadline:
+                await asyncio.sleep(LEASE_WAIT_INTERVAL_SECONDS)
+                value = await read_cache()
+                if value is not None:
+                    counters.incr('coalesced_lease')
+                    return value
+            counters.incr('lease_wait_timeout')
+
+        try:
+            counters.incr('rebuild')
+            return await rebuild()
+        finally:
+            if acquired:
+                await self.__release_script(keys=[lease_key(cache_key)], args=[token])
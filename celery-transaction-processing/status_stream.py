@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Set
+
+from redis.asyncio import Redis as AsyncDragonfly
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+# How long a single XREAD call blocks waiting for new entries.
+STREAM_READ_BLOCK_MILLISECONDS = 5000
+STREAM_READ_COUNT = 1000
+SUBSCRIBER_QUEUE_MAX_SIZE = 1000
+
+
+# Fans out transaction status updates from the Dragonfly stream to the connected clients.
+#
+# Each API server process runs a single reader task, no matter how many clients are connected.
+# The reader task blocks on XREAD and dispatches each entry to the subscribers watching that transaction ID.
+# Thus, one Dragonfly connection serves all the status watchers of a process.
+class TransactionStatusHub:
+    def __init__(self, df: AsyncDragonfly):
+        self.df = df
+        self.__subscribers: Dict[int, Set[asyncio.Queue]] = defaultdict(set)
+        self.__reader_task: Optional[asyncio.Task] = None
+
+    async def subscribe(self, txn_ids: Iterable[int]) -> asyncio.Queue:
+        await self.__ensure_reader_started()
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_MAX_SIZE)
+        for txn_id in txn_ids:
+            self.__subscribers[txn_id].add(queue)
+        return queue
+
+    def unsubscribe(self, txn_ids: Iterable[int], queue: asyncio.Queue):
+        for txn_id in txn_ids:
+            queues = self.__subscribers.get(txn_id)
+            if queues is None:
+                continue
+            queues.discard(queue)
+            if not queues:
+                del self.__subscribers[txn_id]
+
+    def __reader_running(self) -> bool:
+        return self.__reader_task is not None and not self.__reader_task.done()
+
+    async def __ensure_reader_started(self):
+        if self.__reader_running():
+            return
+        # Read after the last entry in the stream instead of '$', so that the updates between this subscription
+        # and the first XREAD call are not missed.
+        # Subscribers read the current state of their transactions right after subscribing.
+        # The entry IDs are assigned by the Dragonfly server clock, so the local clock must not be used here.
+        last_entries = await self.df.xrevrange(utils.TXN_STATUS_STREAM_KEY, count=1)
+        start_id = last_entries[0][0] if last_entries else "0-0"
+        # Another subscriber may have started the reader while waiting for the last entry.
+        if not self.__reader_running():
+            self.__reader_task = asyncio.create_task(self.__read_loop(start_id))
+
+    async def __read_loop(self, start_id: str):
+        last_id = start_id
+        while True:
+            try:
+                result = await self.df.xread(
+                    {utils.TXN_STATUS_STREAM_KEY: last_id},
+                    count=STREAM_READ_COUNT,
+                    block=STREAM_READ_BLOCK_MILLISECONDS,
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f'failed to read transaction status stream: {e}')
+                await asyncio.sleep(1)
+                continue
+            for _, entries in result:
+                for entry_id, fields in entries:
+                    last_id = entry_id
+                    self.__dispatch(fields)
+
+    def __dispatch(self, fields: dict):
+        update = {k.decode(): v.decode() for k, v in fields.items()}
+        txn_id = int(update["id"])
+        for queue in self.__subscribers.get(txn_id, ()):
+            try:
+                queue.put_nowait(update)
+            except asyncio.QueueFull:
+                # A slow client is dropped from the update, but will get the terminal state on reconnection.
+                logger.warning(f'subscriber queue is full, dropping update of transaction {txn_id}')
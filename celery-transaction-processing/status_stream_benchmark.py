@@ -0,0 +1,175 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Dict, List, Optional
+
+import httpx
+from redis.asyncio import Redis as AsyncDragonfly
+
+import utils
+from codec import CODECS, TransactionCacheCodec
+from load_test import percentile
+
+# Compare the server load of polling 'GET /transactions/{id}' against streaming 'GET /transactions/events'.
+#
+# The benchmark writes synthetic PENDING transactions to the cache (so no database rows or chain are needed),
+# lets the clients watch them, and settles them over a time window in the same way the reconciliation does:
+# updating the cache and appending to the status stream.
+# It reports the number of requests, the response bytes, the notification delays,
+# and the CPU time used by the API server process if '--server-pid' is given (Linux only).
+#
+#   python status_stream_benchmark.py --clients 100 --ids-per-client 10 --server-pid $(pgrep -f 'uvicorn main')
+
+SYNTHETIC_TXN_ID_START = 1_000_000_000
+
+
+def read_process_cpu_seconds(pid: Optional[int]) -> Optional[float]:
+    if pid is None:
+        return None
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime are the 14th and 15th fields of the original line.
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class _Stats:
+    def __init__(self):
+        self.requests = 0
+        self.response_bytes = 0
+        self.observed_at: Dict[int, float] = {}
+
+
+def _synthetic_txn(txn_id: int, status: str) -> utils.TransactionResponse:
+    return utils.TransactionResponse(
+        id=txn_id,
+        transaction_hash="0x" + "00" * 32,
+        from_public_address="0x" + "00" * 20,
+        to_public_address="0x" + "00" * 20,
+        transaction_amount_in_wei=1000,
+        transaction_fee_total_in_wei=utils.TOTAL_TRANSACTION_FEE_IN_WEI,
+        transaction_fee_blockchain_in_wei=0,
+        status=status,
+    )
+
+
+async def _seed_pending(df: AsyncDragonfly, codec: TransactionCacheCodec, txn_ids: List[int]):
+    pipe = df.pipeline(transaction=False)
+    for txn_id in txn_ids:
+        codec.queue_write(pipe, _synthetic_txn(txn_id, "PENDING"), 3600)
+    await pipe.execute()
+
+
+async def _settle(
+        df: AsyncDragonfly,
+        codec: TransactionCacheCodec,
+        txn_ids: List[int],
+        delay: float,
+        window: float,
+) -> Dict[int, float]:
+    schedule = sorted((delay + random.random() * window, txn_id) for txn_id in txn_ids)
+    start = time.perf_counter()
+    settled_at = {}
+    for at, txn_id in schedule:
+        await asyncio.sleep(max(0.0, at - (time.perf_counter() - start)))
+        pipe = df.pipeline(transaction=False)
+        codec.queue_write(pipe, _synthetic_txn(txn_id, "SUCCESSFUL"), 3600)
+        pipe.xadd(
+            utils.TXN_STATUS_STREAM_KEY,
+            {"id": txn_id, "status": "SUCCESSFUL", "transaction_fee_blockchain_in_wei": 0},
+            maxlen=utils.TXN_STATUS_STREAM_MAX_LEN, approximate=True,
+        )
+        settled_at[txn_id] = time.perf_counter()
+        await pipe.execute()
+    return settled_at
+
+
+async def _poll_client(client: httpx.AsyncClient, txn_ids: List[int], interval: float, stats: _Stats):
+    watching = set(txn_ids)
+    while watching:
+        for txn_id in list(watching):
+            resp = await client.get(f"/transactions/{txn_id}")
+            stats.requests += 1
+            stats.response_bytes += len(resp.content)
+            if resp.status_code == 200 and resp.json()["status"] != "PENDING":
+                stats.observed_at[txn_id] = time.perf_counter()
+                watching.discard(txn_id)
+        await asyncio.sleep(interval)
+
+
+async def _sse_client(client: httpx.AsyncClient, txn_ids: List[int], stats: _Stats):
+    stats.requests += 1
+    async with client.stream("GET", "/transactions/events", params={"ids": txn_ids}) as resp:
+        async for line in resp.aiter_lines():
+            stats.response_bytes += len(line) + 1
+            if not line.startswith("data: "):
+                continue
+            data = json.loads(line[len("data: "):])
+            if data.get("status", "PENDING") != "PENDING":
+                stats.observed_at[data["id"]] = time.perf_counter()
+
+
+async def run_mode(mode: str, args: argparse.Namespace, df: AsyncDragonfly) -> dict:
+    txn_ids = list(range(SYNTHETIC_TXN_ID_START, SYNTHETIC_TXN_ID_START + args.clients * args.ids_per_client))
+    codec = CODECS[args.cache_codec]
+    await _seed_pending(df, codec, txn_ids)
+    stats = _Stats()
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=None) as client:
+        cpu_before = read_process_cpu_seconds(args.server_pid)
+        start = time.perf_counter()
+        settle_task = asyncio.create_task(_settle(df, codec, txn_ids, args.settle_after, args.settle_window))
+        chunks = [txn_ids[i:i + args.ids_per_client] for i in range(0, len(txn_ids), args.ids_per_client)]
+        if mode == "poll":
+            clients = [_poll_client(client, chunk, args.poll_interval, stats) for chunk in chunks]
+        else:
+            clients = [_sse_client(client, chunk, stats) for chunk in chunks]
+        await asyncio.gather(*clients)
+        settled_at = await settle_task
+        elapsed = time.perf_counter() - start
+        cpu_after = read_process_cpu_seconds(args.server_pid)
+
+    delays = sorted(stats.observed_at[txn_id] - settled_at[txn_id] for txn_id in txn_ids)
+    return {
+        "mode": mode,
+        "elapsed_seconds": round(elapsed, 2),
+        "transactions": len(txn_ids),
+        "requests": stats.requests,
+        "requests_per_transaction": round(stats.requests / len(txn_ids), 2),
+        "response_bytes": stats.response_bytes,
+        "server_cpu_seconds": round(cpu_after - cpu_before, 3) if cpu_before is not None else None,
+        "notification_delay_p50_ms": round(percentile(delays, 50) * 1000, 2),
+        "notification_delay_p99_ms": round(percentile(delays, 99) * 1000, 2),
+    }
+
+
+async def main(args: argparse.Namespace):
+    df = AsyncDragonfly.from_url(args.dragonfly_url)
+    modes = ["poll", "sse"] if args.mode == "both" else [args.mode]
+    results = [await run_mode(mode, args, df) for mode in modes]
+    await df.aclose()
+    print(json.dumps(results, indent=2))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare transaction status polling with streaming.")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--dragonfly-url", default="redis://localhost:6380/0")
+    parser.add_argument("--mode", choices=["poll", "sse", "both"], default="both")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--ids-per-client", type=int, default=10)
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between polling rounds")
+    parser.add_argument("--settle-after", type=float, default=5.0, help="seconds before the first settlement")
+    parser.add_argument("--settle-window", type=float, default=20.0, help="seconds over which all settle")
+    parser.add_argument("--server-pid", type=int, default=None)
+    parser.add_argument(
+        "--cache-codec", choices=sorted(CODECS), default="packed",
+        help="must match 'DF_TRANSACTION_CACHE_CODEC' of the API server",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
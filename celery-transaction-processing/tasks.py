@@ -1,11 +1,22 @@
-from typing import Final
+import os
+import socket
+import time
+import uuid
+from typing import Final, List
 
 from celery import Celery
 from celery.utils.log import get_task_logger
+from kombu import Queue
+from redis import Redis as Dragonfly
+from sqlalchemy.orm import joinedload
 from web3 import exceptions as web3_exceptions
 
+import balance
 import eth
+import metrics
 import models
+import pools
+import utils
 from deps import get_deps, get_constants
 
 logger = get_task_logger(__name__)
@@ -32,11 +43,35 @@ app = Celery(
     broker=get_constants().get_celery_broker_url(),
     backend=get_constants().get_celery_backend_url(),
 )
+# Periodic tasks are added below, depending on the reconciliation and balance modes.
+app.conf.beat_schedule = {}
 
 TASK_MAX_RETRIES: Final[int] = 32
 TASK_RETRY_BACKOFF: Final[int] = 100
 TASK_RETRY_BACKOFF_MAX: Final[int] = 1600
 
+# Reconciliation tasks are routed to separate queues (lanes), so that the first check of a fresh transaction
+# never waits behind the retries of transactions that have been pending for a long time.
+# Each lane can be served by dedicated workers with their own concurrency and prefetch settings, i.e.:
+#   celery -A tasks worker -Q reconcile_first --concurrency 16 --prefetch-multiplier 4
+#   celery -A tasks worker -Q reconcile_retry_short,reconcile_retry_long,celery --concurrency 4 --prefetch-multiplier 1
+# A worker without '-Q' consumes all the queues.
+RECONCILE_QUEUE_FIRST: Final[str] = 'reconcile_first'
+RECONCILE_QUEUE_RETRY_SHORT: Final[str] = 'reconcile_retry_short'
+RECONCILE_QUEUE_RETRY_LONG: Final[str] = 'reconcile_retry_long'
+# Retries scheduled with a delay up to this are short retries, and the rest are long-tail retries.
+RECONCILE_RETRY_SHORT_MAX_DELAY_SECONDS: Final[int] = 400
+
+app.conf.task_queues = [
+    Queue(app.conf.task_default_queue),
+    Queue(RECONCILE_QUEUE_FIRST),
+    Queue(RECONCILE_QUEUE_RETRY_SHORT),
+    Queue(RECONCILE_QUEUE_RETRY_LONG),
+]
+app.conf.task_routes = {
+    'tasks.reconcile_transaction': {'queue': RECONCILE_QUEUE_FIRST},
+}
+
 
 # Define a Celery task to reconcile a transaction.
 # We check the transaction status from the blockchain and update the database accordingly.
@@ -49,15 +84,18 @@ TASK_RETRY_BACKOFF_MAX: Final[int] = 1600
 #
 # The maximum backoff delay is set to 1600 seconds.
 # Thus, the retry delays in this configuration are [100, 200, 400, 800, 1600, 1600, ...] seconds up to 32 retries.
-@app.task(
-    bind=True,
-    autoretry_for=(TaskRetryException,),
-    max_retries=TASK_MAX_RETRIES,
-    retry_backoff=TASK_RETRY_BACKOFF,
-    retry_backoff_max=TASK_RETRY_BACKOFF_MAX,
-    retry_jitter=False,
-)
-def reconcile_transaction(_self, txn_id: str):
+#
+# Retries are not sent as ETA messages, which workers would prefetch and hold in memory until they are due.
+# Instead, they are scheduled in a Dragonfly sorted set, and published to the retry lanes once they are due.
+@app.task
+def reconcile_transaction(txn_id: str, retries: int = 0):
+    try:
+        _reconcile_transaction(txn_id)
+    except TaskRetryException as e:
+        _schedule_reconcile_retry(txn_id, retries, e.message)
+
+
+def _reconcile_transaction(txn_id: str):
     db_gen = get_deps().get_db_session()
     db = next(db_gen)
     try:
@@ -78,13 +116,417 @@ def reconcile_transaction(_self, txn_id: str):
 
         # Update the transaction status and the user account balance within a database transaction.
         if status_response.status == models.UserAccountTransactionStatus.SUCCESSFUL:
-            total_amount_in_wei = txn.transaction_amount_in_wei + txn.transaction_fee_total_in_wei
-            txn.status = status_response.status
-            txn.transaction_fee_blockchain_in_wei = status_response.transaction_fee_blockchain_in_wei
-            account.current_balance_in_wei -= total_amount_in_wei
+            _settle_successful_transaction(txn, account, status_response)
             db.commit()
+            _write_through_transactions(get_deps().get_dragonfly(), [txn])
     except web3_exceptions.TransactionNotFound as e:
         logger.info(f'TransactionNotFoundOnChainYet: {e}')
         raise TaskRetryException('TransactionNotFoundOnChainYet')
     finally:
+        db_gen.close()
+        eth.cache_counters.flush(get_deps().get_dragonfly())
+        pools.flush(get_deps().get_dragonfly())
         logger.info('transaction reconciliation attempted')
+
+
+# Update the cached transactions after their status changes, and notify the subscribers through a Dragonfly stream.
+# Clients reading the cache see the new status right away, instead of stale data until the cache entry expires.
+def _write_through_transactions(df: Dragonfly, txns: List[models.UserAccountTransaction]):
+    if not txns:
+        return
+    codec = get_deps().get_transaction_cache_codec()
+    pipe = df.pipeline(transaction=False)
+    for txn in txns:
+        codec.queue_write(pipe, utils.txn_to_response(txn), utils.txn_cache_expiration(txn.status))
+        pipe.xadd(
+            utils.TXN_STATUS_STREAM_KEY, utils.txn_to_status_update(txn),
+            maxlen=utils.TXN_STATUS_STREAM_MAX_LEN, approximate=True,
+        )
+    pipe.execute()
+
+
+def _settle_successful_transaction(
+        txn: models.UserAccountTransaction,
+        account: models.UserAccount,
+        status_response: eth.TransactionStatusResponse,
+):
+    total_amount_in_wei = txn.transaction_amount_in_wei + txn.transaction_fee_total_in_wei
+    txn.status = status_response.status
+    txn.transaction_fee_blockchain_in_wei = status_response.transaction_fee_blockchain_in_wei
+    account.current_balance_in_wei -= total_amount_in_wei
+
+
+# Batch reconciliation.
+#
+# Instead of one task (and up to 32 retry messages) per transaction, a periodic task sweeps the pending transactions.
+# Each sweep claims due transaction IDs from a Dragonfly sorted set, reads the block height once,
+# fetches receipts with batched JSON-RPC calls, and settles all the confirmed transactions in one database transaction.
+# Transactions that are still pending are checked again after 'RECONCILE_PENDING_RECHECK_SECONDS'.
+#
+# Run the Celery beat scheduler alongside the workers to trigger the sweeps:
+#   DF_RECONCILE_MODE=batch celery -A tasks beat --loglevel=INFO
+RECONCILE_SWEEP_INTERVAL_SECONDS: Final[float] = 5.0
+RECONCILE_BATCH_SIZE: Final[int] = 1000
+RECONCILE_PENDING_RECHECK_SECONDS: Final[int] = 12
+# A claimed transaction is hidden from other sweeps for this long.
+# If a sweep crashes, its claimed transactions become due again after the claim expires.
+RECONCILE_CLAIM_SECONDS: Final[int] = 60
+
+# Atomically read the due members of a sorted set and push their scores into the future,
+# so that overlapping sweeps never process the same transaction twice.
+#
+# KEYS[1]: the pending transaction sorted set
+# ARGV[1]: the current Unix timestamp
+# ARGV[2]: the claim expiration Unix timestamp
+# ARGV[3]: the maximum number of members to claim
+__claim_due_members_script = get_deps().get_dragonfly().register_script("""
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, member in ipairs(members) do
+    redis.call('ZADD', KEYS[1], 'XX', ARGV[2], member)
+end
+return members
+""")
+
+reconcile_counters = metrics.Counters('reconciliation')
+
+if get_constants().get_reconcile_mode() == get_constants().RECONCILE_MODE_BATCH:
+    app.conf.beat_schedule['reconcile-pending-transactions'] = {
+        'task': 'tasks.reconcile_pending_transactions',
+        'schedule': RECONCILE_SWEEP_INTERVAL_SECONDS,
+    }
+
+
+@app.task
+def reconcile_pending_transactions():
+    df = get_deps().get_dragonfly()
+    started_at = time.time()
+    claimed = __claim_due_members_script(
+        keys=[utils.PENDING_TXN_KEY],
+        args=[started_at, started_at + RECONCILE_CLAIM_SECONDS, RECONCILE_BATCH_SIZE],
+    )
+    txn_ids = [int(v) for v in claimed]
+    reconcile_counters.incr('sweeps')
+    if not txn_ids:
+        reconcile_counters.flush(df)
+        return
+
+    db_gen = get_deps().get_db_session()
+    db = next(db_gen)
+    try:
+        txns = db.query(models.UserAccountTransaction) \
+            .filter(models.UserAccountTransaction.id.in_(txn_ids)) \
+            .all()
+        pending_txns = [txn for txn in txns if txn.status == models.UserAccountTransactionStatus.PENDING]
+
+        # Transactions that are missing from the database or already reconciled are dropped from the set.
+        done_txn_ids = set(txn_ids) - {txn.id for txn in pending_txns}
+        still_pending_txn_ids = []
+        settled_txns = []
+        failed_count = 0
+
+        if pending_txns:
+            account_ids = {txn.user_account_id for txn in pending_txns}
+            accounts = db.query(models.UserAccount) \
+                .filter(models.UserAccount.id.in_(account_ids)) \
+                .all()
+            accounts_by_id = {account.id: account for account in accounts}
+
+            # Check the transaction statuses from the blockchain.
+            current_block_number = eth.get_block_number()
+            status_responses = eth.get_transaction_statuses(
+                [txn.transaction_hash for txn in pending_txns],
+                current_block_number,
+            )
+
+            # Update the transaction statuses and the user account balances within a single database transaction.
+            for txn in pending_txns:
+                status_response = status_responses[txn.transaction_hash]
+                if status_response.status == models.UserAccountTransactionStatus.SUCCESSFUL:
+                    _settle_successful_transaction(txn, accounts_by_id[txn.user_account_id], status_response)
+                    done_txn_ids.add(txn.id)
+                    settled_txns.append(txn)
+                elif status_response.status == models.UserAccountTransactionStatus.FAILED:
+                    logger.info(f'TransactionFailedOnChain: {txn.id}')
+                    done_txn_ids.add(txn.id)
+                    failed_count += 1
+                else:
+                    still_pending_txn_ids.append(txn.id)
+            db.commit()
+            _write_through_transactions(df, settled_txns)
+
+        # Remove the reconciled transactions from the set and schedule the next check for the pending ones.
+        pipe = df.pipeline(transaction=False)
+        if done_txn_ids:
+            pipe.zrem(utils.PENDING_TXN_KEY, *done_txn_ids)
+        if still_pending_txn_ids:
+            recheck_at = time.time() + RECONCILE_PENDING_RECHECK_SECONDS
+            pipe.zadd(utils.PENDING_TXN_KEY, {txn_id: recheck_at for txn_id in still_pending_txn_ids}, xx=True)
+        pipe.execute()
+
+        reconcile_counters.incr('claimed', len(txn_ids))
+        reconcile_counters.incr('settled_successful', len(settled_txns))
+        reconcile_counters.incr('settled_failed', failed_count)
+        reconcile_counters.incr('still_pending', len(still_pending_txn_ids))
+        reconcile_counters.incr('sweep_milliseconds', int((time.time() - started_at) * 1000))
+        logger.info(
+            f'reconciliation sweep: claimed={len(txn_ids)}, settled={len(settled_txns)}, '
+            f'failed={failed_count}, pending={len(still_pending_txn_ids)}'
+        )
+    finally:
+        db_gen.close()
+        reconcile_counters.flush(df)
+        eth.cache_counters.flush(df)
+        pools.flush(df)
+
+
+# Retry delay queue of the per-transaction reconciliation.
+#
+# A retry is a member '{txn_id}:{retries}' of a Dragonfly sorted set, scored by the Unix timestamp at which it is due.
+# A periodic task claims the due members, publishes them to the retry lanes, and then removes them from the set.
+# If the task crashes before removing them, the claim expires and they are published again,
+# which is harmless since a reconciled transaction is never reconciled twice.
+#
+# Run the Celery beat scheduler alongside the workers to publish the due retries:
+#   celery -A tasks beat --loglevel=INFO
+RECONCILE_RETRY_DELAY_QUEUE_KEY: Final[str] = "reconcile_transaction_retries"
+RECONCILE_RETRY_PUBLISH_INTERVAL_SECONDS: Final[float] = 1.0
+RECONCILE_RETRY_PUBLISH_BATCH_SIZE: Final[int] = 1000
+
+retry_counters = metrics.Counters('reconciliation_retries')
+
+if get_constants().get_reconcile_mode() == get_constants().RECONCILE_MODE_TASK:
+    app.conf.beat_schedule['publish-due-reconcile-retries'] = {
+        'task': 'tasks.publish_due_reconcile_retries',
+        'schedule': RECONCILE_RETRY_PUBLISH_INTERVAL_SECONDS,
+    }
+
+
+def reconcile_retry_delay(retries: int) -> int:
+    return min(TASK_RETRY_BACKOFF * 2 ** retries, TASK_RETRY_BACKOFF_MAX)
+
+
+def reconcile_retry_queue(retries: int) -> str:
+    if reconcile_retry_delay(retries) <= RECONCILE_RETRY_SHORT_MAX_DELAY_SECONDS:
+        return RECONCILE_QUEUE_RETRY_SHORT
+    return RECONCILE_QUEUE_RETRY_LONG
+
+
+def _schedule_reconcile_retry(txn_id: str, retries: int, reason: str):
+    if retries >= TASK_MAX_RETRIES:
+        logger.warning(f'reconciliation of transaction {txn_id} gave up after {retries} retries: {reason}')
+        retry_counters.incr('gave_up')
+        retry_counters.flush(get_deps().get_dragonfly())
+        return
+    due_at = time.time() + reconcile_retry_delay(retries)
+    get_deps().get_dragonfly().zadd(RECONCILE_RETRY_DELAY_QUEUE_KEY, {f'{txn_id}:{retries}': due_at})
+    logger.info(f'reconciliation of transaction {txn_id} is scheduled for retry {retries + 1}: {reason}')
+
+
+@app.task
+def publish_due_reconcile_retries():
+    df = get_deps().get_dragonfly()
+    now = time.time()
+    claimed = __claim_due_members_script(
+        keys=[RECONCILE_RETRY_DELAY_QUEUE_KEY],
+        args=[now, now + RECONCILE_CLAIM_SECONDS, RECONCILE_RETRY_PUBLISH_BATCH_SIZE],
+    )
+    if not claimed:
+        return
+    for member in claimed:
+        txn_id, retries = member.decode().split(':')
+        reconcile_transaction.apply_async(
+            args=[int(txn_id), int(retries) + 1],
+            queue=reconcile_retry_queue(int(retries)),
+        )
+    df.zrem(RECONCILE_RETRY_DELAY_QUEUE_KEY, *claimed)
+    retry_counters.incr('published', len(claimed))
+    retry_counters.flush(df)
+
+
+# Execute the pipeline, and start the reconciliation of the new transactions.
+# In the batch mode, the transactions are added to the pending set in the same pipeline.
+# Otherwise, the reconciliation tasks are published through a single broker connection,
+# instead of acquiring a connection from the pool for each message.
+def _execute_and_start_reconciliations(pipe, txn_ids: List[int]):
+    if get_constants().get_reconcile_mode() == get_constants().RECONCILE_MODE_BATCH:
+        if txn_ids:
+            pipe.zadd(utils.PENDING_TXN_KEY, {txn_id: time.time() for txn_id in txn_ids})
+        pipe.execute()
+        return
+    pipe.execute()
+    if not txn_ids:
+        return
+    with app.producer_or_acquire() as producer:
+        for txn_id in txn_ids:
+            reconcile_transaction.apply_async(args=[txn_id], producer=producer)
+
+
+# Write-behind persistence of the 'dragonfly' balance mode.
+#
+# The API servers debit the available balances in Dragonfly and enqueue the transactions to a stream.
+# A periodic task reads the stream with a consumer group, inserts the transactions and applies the debits
+# to the database in one database transaction per batch, and then starts the reconciliation of the transactions.
+# An entry is acknowledged only after the database commit, and the entries of a crashed worker are reclaimed
+# after 'WRITE_BEHIND_CLAIM_IDLE_MILLISECONDS'. Transactions that already exist in the database are skipped,
+# so persisting the same entry twice does not debit the balance twice, but their reconciliation is started again.
+#
+# Run the Celery beat scheduler alongside the workers to trigger the persistence:
+#   DF_BALANCE_MODE=dragonfly celery -A tasks beat --loglevel=INFO
+WRITE_BEHIND_INTERVAL_SECONDS: Final[float] = 1.0
+WRITE_BEHIND_BATCH_SIZE: Final[int] = 1000
+WRITE_BEHIND_CLAIM_IDLE_MILLISECONDS: Final[int] = 60000
+
+write_behind_counters = metrics.Counters('write_behind')
+
+if get_constants().get_balance_mode() == get_constants().BALANCE_MODE_DRAGONFLY:
+    app.conf.beat_schedule['persist-debited-transactions'] = {
+        'task': 'tasks.persist_debited_transactions',
+        'schedule': WRITE_BEHIND_INTERVAL_SECONDS,
+    }
+
+
+@app.task
+def persist_debited_transactions():
+    df = get_deps().get_dragonfly()
+    balance.ensure_write_behind_group(df)
+    consumer = f'{socket.gethostname()}-{os.getpid()}'
+
+    # Reclaim the entries of crashed workers first, then read the new entries.
+    _, entries, *_ = df.xautoclaim(
+        balance.TXN_WRITE_BEHIND_STREAM_KEY, balance.TXN_WRITE_BEHIND_GROUP, consumer,
+        min_idle_time=WRITE_BEHIND_CLAIM_IDLE_MILLISECONDS, start_id='0-0', count=WRITE_BEHIND_BATCH_SIZE,
+    )
+    entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+    if not entries:
+        result = df.xreadgroup(
+            balance.TXN_WRITE_BEHIND_GROUP, consumer,
+            {balance.TXN_WRITE_BEHIND_STREAM_KEY: '>'}, count=WRITE_BEHIND_BATCH_SIZE,
+        )
+        entries = result[0][1] if result else []
+    if not entries:
+        return
+
+    db_gen = get_deps().get_db_session()
+    db = next(db_gen)
+    try:
+        txns = [balance.stream_entry_to_txn(fields) for _, fields in entries]
+        existing_txn_ids = {
+            txn_id for txn_id, in db.query(models.UserAccountTransaction.id)
+            .filter(models.UserAccountTransaction.id.in_([txn.id for txn in txns]))
+        }
+        new_txns = [txn for txn in txns if txn.id not in existing_txn_ids]
+        new_txn_ids = [txn.id for txn in new_txns]
+
+        # Insert the new transactions and apply their debits within a single database transaction.
+        if new_txns:
+            account_ids = {txn.user_account_id for txn in new_txns}
+            accounts = db.query(models.UserAccount) \
+                .filter(models.UserAccount.id.in_(account_ids)) \
+                .all()
+            accounts_by_id = {account.id: account for account in accounts}
+            for txn in new_txns:
+                db.add(txn)
+                accounts_by_id[txn.user_account_id].available_balance_in_wei -= \
+                    txn.transaction_amount_in_wei + txn.transaction_fee_total_in_wei
+            db.commit()
+
+        # Acknowledge and delete the persisted entries, and start the reconciliation of all the transactions.
+        # The duplicates are included, since a worker may have crashed after the commit but before this point,
+        # and the reconciliation is idempotent.
+        # The new transactions are cached again, in case their cache entries have expired before the insert
+        # and a read cached an empty value meanwhile. Their reconciliation has not started, so they are still pending.
+        entry_ids = [entry_id for entry_id, _ in entries]
+        codec = get_deps().get_transaction_cache_codec()
+        pipe = df.pipeline(transaction=False)
+        for txn in new_txns:
+            codec.queue_write(pipe, utils.txn_to_response(txn), utils.txn_cache_expiration(txn.status))
+        pipe.xack(balance.TXN_WRITE_BEHIND_STREAM_KEY, balance.TXN_WRITE_BEHIND_GROUP, *entry_ids)
+        pipe.xdel(balance.TXN_WRITE_BEHIND_STREAM_KEY, *entry_ids)
+        _execute_and_start_reconciliations(pipe, [txn.id for txn in txns])
+
+        write_behind_counters.incr('persisted', len(new_txn_ids))
+        write_behind_counters.incr('duplicates', len(txns) - len(new_txn_ids))
+        logger.info(f'write-behind: persisted={len(new_txn_ids)}, duplicates={len(txns) - len(new_txn_ids)}')
+    finally:
+        db_gen.close()
+        write_behind_counters.flush(df)
+        pools.flush(df)
+
+
+# Transaction outbox of the 'sql' balance mode.
+#
+# The API servers insert an outbox entry in the same database transaction as each new transaction,
+# instead of caching the transaction and starting its reconciliation after the commit. Thus, the request
+# does not wait for these round trips, and a crash right after the commit does not leave a transaction unreconciled.
+# A periodic task drains the outbox in batches: it caches the transactions in one pipeline,
+# starts their reconciliation, and then deletes the entries.
+# A crash before the deletion relays the entries again, so a reconciliation may be started twice (at least once).
+# Only one relay runs at a time, under a lease in Dragonfly.
+#
+# Run the Celery beat scheduler alongside the workers to trigger the relay:
+#   celery -A tasks beat --loglevel=INFO
+OUTBOX_RELAY_INTERVAL_SECONDS: Final[float] = 1.0
+OUTBOX_RELAY_BATCH_SIZE: Final[int] = 1000
+# The maximum number of batches relayed in a run, so that a large backlog does not hold the lease for too long.
+OUTBOX_RELAY_MAX_BATCHES: Final[int] = 10
+OUTBOX_RELAY_LEASE_KEY: Final[str] = 'lease:user_account_transaction_outbox_relay'
+OUTBOX_RELAY_LEASE_SECONDS: Final[int] = 60
+
+outbox_counters = metrics.Counters('transaction_outbox')
+
+if get_constants().get_balance_mode() == get_constants().BALANCE_MODE_SQL:
+    app.conf.beat_schedule['relay-transaction-outbox'] = {
+        'task': 'tasks.relay_transaction_outbox',
+        'schedule': OUTBOX_RELAY_INTERVAL_SECONDS,
+    }
+
+# Delete the lease only if it is still owned by the caller.
+# KEYS[1]: the lease
+# ARGV[1]: the token of the caller
+__release_lease_script = get_deps().get_dragonfly().register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+@app.task
+def relay_transaction_outbox():
+    df = get_deps().get_dragonfly()
+    token = uuid.uuid4().hex
+    if not df.set(OUTBOX_RELAY_LEASE_KEY, token, nx=True, ex=OUTBOX_RELAY_LEASE_SECONDS):
+        return
+
+    db_gen = get_deps().get_db_session()
+    db = next(db_gen)
+    try:
+        for _ in range(OUTBOX_RELAY_MAX_BATCHES):
+            entries = db.query(models.UserAccountTransactionOutbox) \
+                .options(joinedload(models.UserAccountTransactionOutbox.user_account_transaction)) \
+                .order_by(models.UserAccountTransactionOutbox.id) \
+                .limit(OUTBOX_RELAY_BATCH_SIZE) \
+                .all()
+            if not entries:
+                break
+
+            codec = get_deps().get_transaction_cache_codec()
+            pipe = df.pipeline(transaction=False)
+            for entry in entries:
+                txn = entry.user_account_transaction
+                codec.queue_write(pipe, utils.txn_to_response(txn), utils.txn_cache_expiration(txn.status))
+            _execute_and_start_reconciliations(pipe, [entry.user_account_transaction_id for entry in entries])
+
+            db.query(models.UserAccountTransactionOutbox) \
+                .filter(models.UserAccountTransactionOutbox.id.in_([entry.id for entry in entries])) \
+                .delete(synchronize_session=False)
+            db.commit()
+            outbox_counters.incr('relayed', len(entries))
+            outbox_counters.incr('batches')
+            if len(entries) < OUTBOX_RELAY_BATCH_SIZE:
+                break
+    finally:
+        db_gen.close()
+        __release_lease_script(keys=[OUTBOX_RELAY_LEASE_KEY], args=[token])
+        outbox_counters.flush(df)
+        pools.flush(df)
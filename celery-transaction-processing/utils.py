@@ -1,17 +1,39 @@
+import json
 from dataclasses import dataclass
-from typing import Final
-from urllib.parse import urlparse
+from typing import Final, List, Optional
+from urllib.parse import unquote, urlparse
 
+from eth_utils import is_address, to_checksum_address
 from redis import Redis as Dragonfly
 
 import models
 
 CACHE_NORMAL_EXPIRATION_SECONDS: Final[int] = 60
 CACHE_EMPTY_EXPIRATION_SECONDS: Final[int] = 30
+# Transactions in terminal states (SUCCESSFUL, FAILED) never change again, so they can be cached much longer.
+# Pending transactions are updated in the cache by the reconciliation (write-through),
+# so the short expiration only bounds how long a missed update can be served.
+CACHE_TERMINAL_EXPIRATION_SECONDS: Final[int] = 24 * 60 * 60
+
+# Status changes of transactions are appended to a Dragonfly stream, so that clients can stop polling.
+# The stream is capped (approximately) at the maximum length below.
+TXN_STATUS_STREAM_KEY: Final[str] = "user_account_transaction_status_updates"
+TXN_STATUS_STREAM_MAX_LEN: Final[int] = 100000
+
+# Maximum number of transactions in a single batch get request.
+TXN_BATCH_GET_MAX_IDS: Final[int] = 500
+
+# Server-Sent Events of transaction status updates.
+TXN_EVENTS_MAX_IDS: Final[int] = 1000
+TXN_EVENTS_HEARTBEAT_SECONDS: Final[int] = 15
 
 # We use a lock to prevent concurrent transactions for the same user account.
-LOCK_EXPIRATION_SECONDS: Final[int] = 10
-LOCK_VALUE: Final[str] = "locked"
+# The lock is released when the request finishes, and expires after this in case the process crashes.
+LOCK_EXPIRATION_MILLISECONDS: Final[int] = 10000
+
+# In the batch reconciliation mode, pending transaction IDs are kept in a sorted set.
+# The score of each member is the Unix timestamp (in seconds) at which the transaction should be checked next.
+PENDING_TXN_KEY: Final[str] = "pending_user_account_transactions"
 
 # This chain ID is for the Ethereum Sepolia testnet.
 # Thus, the 'DF_WEB3_PROVIDER_URI' environment variable should be set to the Sepolia testnet,
@@ -26,12 +48,19 @@ SEPOLIA_CHAIN_ID: Final[int] = 11155111
 TOTAL_TRANSACTION_FEE_IN_WEI: Final[int] = 8000000000000000
 
 
+# The 'to' address is validated (20 bytes of hex, with a valid checksum if in mixed case),
+# and normalized to the checksum format, so that it is stored and cached in one format.
 @dataclass
 class TransactionRequest:
     user_account_id: int
     to_public_address: str
     transaction_amount_in_wei: int
 
+    def __post_init__(self):
+        if not is_address(self.to_public_address):
+            raise ValueError("to_public_address must be a 20-byte hex address")
+        self.to_public_address = to_checksum_address(self.to_public_address)
+
 
 @dataclass
 class TransactionResponse:
@@ -45,8 +74,20 @@ class TransactionResponse:
     status: str
 
 
-def user_account_lock_key(user_account_id: int) -> str:
-    return f"user_account_lock:{user_account_id}"
+@dataclass
+class TransactionBatchGetRequest:
+    ids: List[int]
+
+
+@dataclass
+class TransactionBatchGetResponse:
+    transactions: List[TransactionResponse]
+    not_found_ids: List[int]
+
+
+# The lock name is the hash tag of the lock keys (see 'locks.py').
+def user_account_lock_name(user_account_id: int) -> str:
+    return f"user_account:{user_account_id}"
 
 
 def txn_cache_key(txn_id: int) -> str:
@@ -79,16 +120,50 @@ def txn_to_dict(txn: models.UserAccountTransaction) -> dict:
     }
 
 
+def txn_cache_expiration(status: models.UserAccountTransactionStatus) -> int:
+    if status == models.UserAccountTransactionStatus.PENDING:
+        return CACHE_NORMAL_EXPIRATION_SECONDS
+    return CACHE_TERMINAL_EXPIRATION_SECONDS
+
+
+def txn_to_status_update(txn: models.UserAccountTransaction) -> dict:
+    return {
+        "id": txn.id,
+        "status": txn.status.name,
+        "transaction_fee_blockchain_in_wei": txn.transaction_fee_blockchain_in_wei,
+    }
+
+
+def txn_response_to_status_update(txn: TransactionResponse) -> dict:
+    return {
+        "id": txn.id,
+        "status": txn.status,
+        "transaction_fee_blockchain_in_wei": txn.transaction_fee_blockchain_in_wei,
+    }
+
+
+def stream_entry_to_status_update(entry: dict) -> dict:
+    return {
+        "id": int(entry["id"]),
+        "status": entry["status"],
+        "transaction_fee_blockchain_in_wei": int(entry["transaction_fee_blockchain_in_wei"]),
+    }
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 def txn_dict_to_response(txn: dict) -> TransactionResponse:
     return TransactionResponse(
-        id=txn[b"id"],
-        transaction_hash=txn[b"transaction_hash"],
-        from_public_address=txn[b"from_public_address"],
-        to_public_address=txn[b"to_public_address"],
-        transaction_amount_in_wei=txn[b"transaction_amount_in_wei"],
-        transaction_fee_total_in_wei=txn[b"transaction_fee_total_in_wei"],
-        transaction_fee_blockchain_in_wei=txn[b"transaction_fee_blockchain_in_wei"],
-        status=txn[b"status"],
+        id=int(txn[b"id"]),
+        transaction_hash=txn[b"transaction_hash"].decode(),
+        from_public_address=txn[b"from_public_address"].decode(),
+        to_public_address=txn[b"to_public_address"].decode(),
+        transaction_amount_in_wei=int(txn[b"transaction_amount_in_wei"]),
+        transaction_fee_total_in_wei=int(txn[b"transaction_fee_total_in_wei"]),
+        transaction_fee_blockchain_in_wei=int(txn[b"transaction_fee_blockchain_in_wei"]),
+        status=txn[b"status"].decode(),
     )
 
 
@@ -97,12 +172,18 @@ class DragonflyURLParsed:
     host: str
     port: int
     db: int
+    username: Optional[str] = None
+    password: Optional[str] = None
+    # Whether to connect with TLS ('rediss://').
+    ssl: bool = False
 
 
 def parse_dragonfly_url(dragonfly_url) -> DragonflyURLParsed:
     result = urlparse(dragonfly_url)
     host = result.hostname
     port = result.port
+    username = unquote(result.username) if result.username else None
+    password = unquote(result.password) if result.password else None
     db = 0
     if result.path:
         try:
@@ -113,7 +194,35 @@ def parse_dragonfly_url(dragonfly_url) -> DragonflyURLParsed:
     if port is None:
         port = 6379
 
-    return DragonflyURLParsed(host=host, port=port, db=db)
+    return DragonflyURLParsed(
+        host=host,
+        port=port,
+        db=db,
+        username=username,
+        password=password,
+        ssl=result.scheme == "rediss",
+    )
+
+
+# Map a synchronous database URL to the asyncio driver of the same database.
+# For example, 'sqlite:///./data.db' becomes 'sqlite+aiosqlite:///./data.db'.
+ASYNC_DATABASE_DRIVERS: Final[dict] = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+
+def to_async_database_url(database_url: str) -> str:
+    scheme, sep, rest = database_url.partition("://")
+    if not sep:
+        raise ValueError("Invalid database URL")
+    # The URL already specifies a driver, i.e., 'postgresql+asyncpg://...'.
+    if "+" in scheme:
+        return database_url
+    if scheme not in ASYNC_DATABASE_DRIVERS:
+        raise ValueError(f"No asyncio driver is configured for database '{scheme}'")
+    return f"{ASYNC_DATABASE_DRIVERS[scheme]}://{rest}"
 
 
 def hset_and_expire(
@@ -123,6 +232,17 @@ def hset_and_expire(
         expiration: int,
 ):
     pipe = df.pipeline()
+    queue_hset_and_expire(pipe, key, mapping, expiration)
+    pipe.execute()
+
+
+# Queue the commands of 'hset_and_expire' in an existing pipeline (sync or async),
+# so that many cache entries can be written in a single round trip.
+def queue_hset_and_expire(
+        pipe,
+        key: str,
+        mapping: dict,
+        expiration: int,
+):
     pipe.hset(key, mapping=mapping)
     pipe.expire(key, expiration)
-    pipe.execute()
@@ -0,0 +1,160 @@
+import argparse
+import json
+import random
+import statistics
+import time
+from typing import Callable, List, Optional
+
+from redis import Redis as Dragonfly
+from redis.exceptions import ResponseError
+
+import service
+
+# A comparison of the chat cache layouts: the legacy sorted set of prefixed contents, and the stream of msgpack entries.
+#
+# For each '--sizes' entry, a chat session with that many chat history entries is written in both layouts,
+# where '--duplicate-ratio' of the entries repeat a short message (e.g., "yes"). The report is printed as JSON:
+#   - Memory usage of the key (MEMORY USAGE), and the number of entries actually stored.
+#   - p50/p95 latencies of reading the whole chat session and the last '--window-size' entries.
+#     Both layouts are read with a single command, without the TTL refresh of the service, to compare the layouts only.
+#
+# The selected Dragonfly database is flushed before the run, so use a database that nothing else uses:
+#   python cache_layout_benchmark.py --dragonfly-url redis://localhost:6379/15 --sizes 100 1000 10000
+
+HUMAN_MESSAGE_PREFIX = "H:"
+AI_MESSAGE_PREFIX = "A:"
+DUPLICATE_CONTENT = "yes"
+WRITE_BATCH_SIZE = 1000
+
+
+def _percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def _chat_histories(size: int, content_length: int, duplicate_ratio: float) -> List[service.ChatHistoryResponse]:
+    rng = random.Random(size)
+    chat_histories = []
+    for i in range(1, size + 1):
+        if rng.random() < duplicate_ratio:
+            content = DUPLICATE_CONTENT
+        else:
+            content = f"{i}:" + "x" * content_length
+        is_human_message = i % 2 == 1
+        token_count = None if is_human_message else len(content) // 4
+        chat_histories.append(service.ChatHistoryResponse(i, content, is_human_message, token_count))
+    return chat_histories
+
+
+def _write_legacy(df: Dragonfly, key: str, chat_histories: List[service.ChatHistoryResponse]):
+    for start in range(0, len(chat_histories), WRITE_BATCH_SIZE):
+        mapping = {}
+        for history in chat_histories[start:start + WRITE_BATCH_SIZE]:
+            prefix = HUMAN_MESSAGE_PREFIX if history.is_human_message else AI_MESSAGE_PREFIX
+            mapping[f"{prefix}{history.content}"] = history.id
+        df.zadd(name=key, mapping=mapping)
+
+
+def _parse_legacy(history: (bytes, float)) -> service.ChatHistoryResponse:
+    prefixed_content = history[0].decode('utf-8', errors='replace')
+    return service.ChatHistoryResponse(
+        id=int(history[1]),
+        content=prefixed_content[2:],
+        is_human_message=prefixed_content[:2] == HUMAN_MESSAGE_PREFIX,
+    )
+
+
+def _memory_usage(df: Dragonfly, key: str) -> Optional[int]:
+    try:
+        return df.memory_usage(key)
+    except ResponseError:
+        return None
+
+
+def _measure(turns: int, read: Callable[[], List[service.ChatHistoryResponse]]) -> dict:
+    latencies = []
+    for _ in range(turns):
+        started_at = time.perf_counter()
+        read()
+        latencies.append(time.perf_counter() - started_at)
+    return {
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 3),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+    }
+
+
+def run(args: argparse.Namespace) -> dict:
+    df = Dragonfly.from_url(args.dragonfly_url)
+    df.flushdb()
+    cache = service._DataCacheService(df)
+    window_size = args.window_size
+
+    results = {}
+    try:
+        for chat_session_id, size in enumerate(args.sizes, start=1):
+            chat_histories = _chat_histories(size, args.content_length, args.duplicate_ratio)
+            legacy_key = cache.key_legacy_chat_histories(chat_session_id)
+            stream_key = cache.key_chat_histories(chat_session_id)
+            _write_legacy(df, legacy_key, chat_histories)
+            for start in range(0, size, WRITE_BATCH_SIZE):
+                cache.add_chat_histories(chat_session_id, chat_histories[start:start + WRITE_BATCH_SIZE])
+
+            results[str(size)] = {
+                "sorted_set": {
+                    "memory_bytes": _memory_usage(df, legacy_key),
+                    "entries_stored": df.zcard(legacy_key),
+                    "read_all": _measure(args.turns, lambda: [
+                        _parse_legacy(v) for v in df.zrange(legacy_key, 0, -1, withscores=True)
+                    ]),
+                    "read_window": _measure(args.turns, lambda: [
+                        _parse_legacy(v) for v in df.zrange(legacy_key, -window_size, -1, withscores=True)
+                    ]),
+                },
+                "stream": {
+                    "memory_bytes": _memory_usage(df, stream_key),
+                    "entries_stored": df.xlen(stream_key),
+                    "read_all": _measure(args.turns, lambda: [
+                        cache.stream_entry_to_response(v) for v in df.xrange(stream_key, "-", "+")
+                    ]),
+                    "read_window": _measure(args.turns, lambda: [
+                        cache.stream_entry_to_response(v) for v in df.xrevrange(stream_key, "+", "-", count=window_size)
+                    ]),
+                },
+            }
+    finally:
+        df.close()
+
+    return {
+        "config": {
+            "sizes": args.sizes,
+            "turns": args.turns,
+            "window_size": args.window_size,
+            "content_length": args.content_length,
+            "duplicate_ratio": args.duplicate_ratio,
+        },
+        "results": results,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare the sorted-set and stream layouts of the chat cache.")
+    parser.add_argument("--dragonfly-url", default="redis://localhost:6379/15", help="flushed before the run")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="number of chat history entries per chat session")
+    parser.add_argument("--turns", type=int, default=100, help="reads per chat session, layout, and read")
+    parser.add_argument("--window-size", type=int, default=20)
+    parser.add_argument("--content-length", type=int, default=200, help="characters per chat history entry")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.05,
+                        help="fraction of entries that repeat the same short message")
+    return parser.parse_args()
+
+
+def main(args: argparse.Namespace):
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+import httpx
+from redis import Redis as Dragonfly
+from sqlalchemy import create_engine
+
+import models
+
+# A benchmark of concurrent chat sessions served by a single server process, with a local fake chat model.
+#
+# It starts the API server ('uvicorn main:app --workers 1') with 'FAKE_CHAT_MODEL=1' against a fresh SQLite database,
+# so that each LLM call takes a known time without calling OpenAI. Then, for each '--concurrency' level,
+# that many chat sessions run at once, each starting a chat and continuing it for '--turns' turns.
+# The report is printed as JSON:
+#   - Chat turns per second, and p50/p95 latencies of a turn (and of the first token with '--stream').
+#   - Concurrent sessions: the average number of turns in flight, i.e., the total turn time over the wall time.
+#     With a blocking LLM call, it stays at 1 regardless of the concurrency level.
+#
+# Dragonfly must be running. The selected Dragonfly database is flushed before the run,
+# so use a database that nothing else uses:
+#   python chat_benchmark.py --dragonfly-url redis://localhost:6379/15 --concurrency 1 8 32 --stream
+
+SERVICE_START_TIMEOUT_SECONDS = 30
+
+
+def _percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def _start_server(args: argparse.Namespace, workdir: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "FAKE_CHAT_MODEL": "1",
+        "FAKE_CHAT_MODEL_FIRST_TOKEN_LATENCY_SECONDS": str(args.first_token_latency),
+        "FAKE_CHAT_MODEL_TOKEN_LATENCY_SECONDS": str(args.token_latency),
+        "DRAGONFLY_URL": args.dragonfly_url,
+        # The OpenAI client is not used, but the module still needs a key to import.
+        "OPENAI_API_KEY": env.get("OPENAI_API_KEY", "unused"),
+    })
+    # The database is 'data.db' in the working directory of the server (see 'database.py').
+    engine = create_engine(f"sqlite:///{os.path.join(workdir, 'data.db')}")
+    models.Base.metadata.create_all(engine)
+    engine.dispose()
+    log = open(os.path.join(workdir, "server.log"), "w")
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--workers", "1",
+               "--log-level", "warning", "--app-dir", os.path.dirname(os.path.abspath(__file__))]
+    return subprocess.Popen(command, env=env, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def _wait_for_server(client: httpx.AsyncClient):
+    deadline = time.monotonic() + SERVICE_START_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.5)
+    raise TimeoutError(f"API server did not start in {SERVICE_START_TIMEOUT_SECONDS} seconds")
+
+
+class _Results:
+    def __init__(self):
+        self.turn_latencies: List[float] = []
+        self.first_token_latencies: List[float] = []
+        self.errors = 0
+
+
+# Returns the chat session ID of a new chat, or None on error.
+async def _turn(
+        client: httpx.AsyncClient,
+        stream: bool,
+        results: _Results,
+        content: str,
+        chat_id: Optional[int],
+) -> Optional[int]:
+    method, url = ("POST", "/chat") if chat_id is None else ("PATCH", f"/chat/{chat_id}")
+    started_at = time.perf_counter()
+    try:
+        if not stream:
+            response = await client.request(method, url, json={"content": content})
+            response.raise_for_status()
+            result = response.json()
+        else:
+            result = None
+            first_token_at = None
+            async with client.stream(method, url, json={"content": content}, params={"stream": "true"}) as response:
+                response.raise_for_status()
+                event = None
+                async for line in response.aiter_lines():
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: "):
+                        if event == "token" and first_token_at is None:
+                            first_token_at = time.perf_counter()
+                        elif event == "done":
+                            result = json.loads(line[len("data: "):])
+            if result is None:
+                raise ValueError("the stream ended without a 'done' event")
+            if first_token_at is not None:
+                results.first_token_latencies.append(first_token_at - started_at)
+    except (httpx.HTTPError, ValueError):
+        results.errors += 1
+        return None
+    results.turn_latencies.append(time.perf_counter() - started_at)
+    return result["chat_session_id"]
+
+
+async def _session(client: httpx.AsyncClient, args: argparse.Namespace, results: _Results, session: int):
+    chat_id = await _turn(client, args.stream, results, f"Hello from session {session}", None)
+    for turn in range(args.turns):
+        if chat_id is None:
+            return
+        await _turn(client, args.stream, results, f"Turn {turn} of session {session}", chat_id)
+
+
+async def _run_level(client: httpx.AsyncClient, args: argparse.Namespace, concurrency: int) -> dict:
+    results = _Results()
+    started_at = time.perf_counter()
+    await asyncio.gather(*(_session(client, args, results, session) for session in range(concurrency)))
+    wall_seconds = time.perf_counter() - started_at
+    report = {
+        "turns": len(results.turn_latencies),
+        "errors": results.errors,
+        "wall_seconds": round(wall_seconds, 3),
+        "turns_per_second": round(len(results.turn_latencies) / wall_seconds, 2),
+        "concurrent_sessions": round(sum(results.turn_latencies) / wall_seconds, 2),
+        "turn_p50_seconds": round(_percentile(results.turn_latencies, 50), 3),
+        "turn_p95_seconds": round(_percentile(results.turn_latencies, 95), 3),
+    }
+    if args.stream:
+        report["first_token_p50_seconds"] = round(_percentile(results.first_token_latencies, 50), 3)
+        report["first_token_p95_seconds"] = round(_percentile(results.first_token_latencies, 95), 3)
+    return report
+
+
+async def run(args: argparse.Namespace) -> dict:
+    df = Dragonfly.from_url(args.dragonfly_url)
+    df.flushdb()
+    df.close()
+
+    workdir = tempfile.mkdtemp(prefix="chat-benchmark-")
+    server = _start_server(args, workdir)
+    levels = {}
+    try:
+        limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=args.timeout,
+                                     limits=limits) as client:
+            await _wait_for_server(client)
+            for concurrency in args.concurrency:
+                levels[str(concurrency)] = await _run_level(client, args, concurrency)
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+    return {
+        "config": {
+            "concurrency": args.concurrency,
+            "turns": args.turns,
+            "stream": args.stream,
+            "first_token_latency_seconds": args.first_token_latency,
+            "token_latency_seconds": args.token_latency,
+        },
+        "levels": levels,
+        "workdir": workdir,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark concurrent chat sessions per server process.")
+    parser.add_argument("--dragonfly-url", default="redis://localhost:6379/15", help="flushed before the run")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32],
+                        help="numbers of chat sessions running at once")
+    parser.add_argument("--turns", type=int, default=3, help="turns per chat session after the first")
+    parser.add_argument("--stream", action="store_true", help="stream the AI responses")
+    parser.add_argument("--first-token-latency", type=float, default=0.5, help="seconds of the fake chat model")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="seconds of the fake chat model")
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request timeout in seconds")
+    parser.add_argument("--port", type=int, default=8200)
+    return parser.parse_args()
+
+
+def main(args: argparse.Namespace):
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main(parse_args())
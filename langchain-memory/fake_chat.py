@@ -0,0 +1,91 @@
+import asyncio
+import time
+import uuid
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+# A local stand-in for the OpenAI chat model, for benchmarks and local runs without an API key.
+#
+# It replies with 'reply_tokens' words after 'first_token_latency_seconds', and then one word
+# every 'token_latency_seconds', reporting the token usage like the OpenAI chat model.
+# The tokens are counted as words, and the sleeps are asynchronous in 'ainvoke' and 'astream'.
+class FakeChatModel(BaseChatModel):
+    first_token_latency_seconds: float = 0.5
+    token_latency_seconds: float = 0.02
+    reply_tokens: int = 50
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def __reply_words(self, messages: List[BaseMessage]) -> List[str]:
+        prompt = str(messages[-1].content) if messages else ""
+        words = [f"{prompt[:20]!r}"] + ["lorem"] * (self.reply_tokens - 1)
+        return [word if i == 0 else f" {word}" for i, word in enumerate(words)]
+
+    def __message(self, messages: List[BaseMessage], words: List[str]) -> AIMessage:
+        prompt_tokens = sum(len(str(m.content).split()) for m in messages)
+        return AIMessage(
+            id=f"fake-{uuid.uuid4().hex}",
+            content="".join(words),
+            response_metadata={
+                "token_usage": {
+                    "completion_tokens": len(words),
+                    "prompt_tokens": prompt_tokens,
+                    "total_tokens": prompt_tokens + len(words),
+                },
+                "system_fingerprint": "fake",
+            },
+        )
+
+    def __total_latency_seconds(self) -> float:
+        return self.first_token_latency_seconds + self.token_latency_seconds * (self.reply_tokens - 1)
+
+    def _generate(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(self.__total_latency_seconds())
+        message = self.__message(messages, self.__reply_words(messages))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> ChatResult:
+        await asyncio.sleep(self.__total_latency_seconds())
+        message = self.__message(messages, self.__reply_words(messages))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        for i, word in enumerate(self.__reply_words(messages)):
+            time.sleep(self.first_token_latency_seconds if i == 0 else self.token_latency_seconds)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word))
+
+    async def _astream(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        for i, word in enumerate(self.__reply_words(messages)):
+            await asyncio.sleep(self.first_token_latency_seconds if i == 0 else self.token_latency_seconds)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word))
@@ -0,0 +1,127 @@
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from typing import Callable, List
+
+from redis import Redis as Dragonfly
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+import models
+import service
+
+# A benchmark of reading the chat history for a turn, full versus windowed, as the chat session grows.
+#
+# For each '--sizes' entry, a chat session with that many chat history entries is seeded into a fresh SQLite database
+# and cached in Dragonfly. Then the chat history is read '--turns' times with each of:
+#   - 'full': 'DataService.read_chat_histories', i.e., the whole sorted set.
+#   - 'windowed': 'DataService.read_chat_context', i.e., the last '--window-size' entries and the rolling summary.
+# The report is printed as JSON, with p50/p95 latencies and the content bytes returned per turn.
+#
+# The selected Dragonfly database is flushed before the run, so use a database that nothing else uses:
+#   python history_benchmark.py --dragonfly-url redis://localhost:6379/15 --sizes 100 1000 10000
+
+SEED_BATCH_SIZE = 1000
+
+
+def _percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def _seed(srv: service.DataService, db, size: int, content_length: int) -> int:
+    chat_session = models.ChatSession(llm_name="benchmark")
+    db.add(chat_session)
+    db.flush()
+    content = "x" * content_length
+    for start in range(0, size, SEED_BATCH_SIZE):
+        db.execute(insert(models.ChatHistory), [
+            {
+                "chat_session_id": chat_session.id,
+                "is_human_message": i % 2 == 0,
+                # The sorted-set member is the content, so it must be unique per entry.
+                "content": f"{i}:{content}",
+            }
+            for i in range(start, min(start + SEED_BATCH_SIZE, size))
+        ])
+    db.commit()
+    # Load the chat session into the cache, as a cache miss would.
+    srv.read_chat_histories(chat_session.id)
+    return chat_session.id
+
+
+def _measure(turns: int, read: Callable[[], List[service.ChatHistoryResponse]]) -> dict:
+    latencies = []
+    content_bytes = 0
+    for _ in range(turns):
+        started_at = time.perf_counter()
+        chat_histories = read()
+        latencies.append(time.perf_counter() - started_at)
+        content_bytes = sum(len(v.content.encode()) for v in chat_histories)
+    return {
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 3),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+        "entries_per_turn": len(chat_histories),
+        "content_bytes_per_turn": content_bytes,
+    }
+
+
+def run(args: argparse.Namespace) -> dict:
+    workdir = tempfile.mkdtemp(prefix="history-benchmark-")
+    engine = create_engine(f"sqlite:///{os.path.join(workdir, 'benchmark.db')}")
+    models.Base.metadata.create_all(engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    df = Dragonfly.from_url(args.dragonfly_url)
+    df.flushdb()
+
+    results = {}
+    try:
+        srv = service.DataService(db, df)
+        for size in args.sizes:
+            chat_session_id = _seed(srv, db, size, args.content_length)
+            results[str(size)] = {
+                "full": _measure(args.turns, lambda: srv.read_chat_histories(chat_session_id).chat_histories),
+                "windowed": _measure(
+                    args.turns,
+                    lambda: srv.read_chat_context(chat_session_id, args.window_size).chat_histories,
+                ),
+            }
+    finally:
+        db.close()
+        engine.dispose()
+        df.close()
+
+    return {
+        "config": {
+            "sizes": args.sizes,
+            "turns": args.turns,
+            "window_size": args.window_size,
+            "content_length": args.content_length,
+        },
+        "results": results,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark full versus windowed chat history reads.")
+    parser.add_argument("--dragonfly-url", default="redis://localhost:6379/15", help="flushed before the run")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="number of chat history entries per chat session")
+    parser.add_argument("--turns", type=int, default=100, help="reads per chat session and mode")
+    parser.add_argument("--window-size", type=int, default=20)
+    parser.add_argument("--content-length", type=int, default=200, help="characters per chat history entry")
+    return parser.parse_args()
+
+
+def main(args: argparse.Namespace):
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -1,19 +1,76 @@
-from fastapi import FastAPI, Depends, HTTPException
-from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
-from langchain_openai import ChatOpenAI
+import asyncio
+import json
+import os
+import socket
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Union
+
+from fastapi import BackgroundTasks, FastAPI, Depends, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from redis import Redis as Dragonfly, ConnectionPool
 from sqlalchemy.orm import Session
 
+import metrics
 import service
+import write_behind
 from database import SessionLocal
+from fake_chat import FakeChatModel
+from response_cache import ResponseCache
 from schemas import ChatMessageCreate, ChatSessionCreate, ChatHistoryCreate
 
 # Dependencies.
 LARGE_LANGUAGE_MODEL_NAME = "gpt-3.5-turbo-1106"
-chat_api_client = ChatOpenAI(model=LARGE_LANGUAGE_MODEL_NAME, temperature=0.2)
-conn_pool = ConnectionPool(host='localhost', port=6379, db=0)
+# Set 'FAKE_CHAT_MODEL=1' to use a local stand-in for the OpenAI chat model, e.g., for benchmarks (see 'fake_chat.py').
+if os.environ.get("FAKE_CHAT_MODEL") == "1":
+    chat_api_client = FakeChatModel(
+        first_token_latency_seconds=float(os.environ.get("FAKE_CHAT_MODEL_FIRST_TOKEN_LATENCY_SECONDS", "0.5")),
+        token_latency_seconds=float(os.environ.get("FAKE_CHAT_MODEL_TOKEN_LATENCY_SECONDS", "0.02")),
+    )
+else:
+    chat_api_client = ChatOpenAI(model=LARGE_LANGUAGE_MODEL_NAME, temperature=0.2)
+conn_pool = ConnectionPool.from_url(os.environ.get("DRAGONFLY_URL", "redis://localhost:6379/0"))
 dragonfly_client = Dragonfly(connection_pool=conn_pool)
 
+# Set 'LLM_RESPONSE_CACHE=1' to answer the single prompts ('/chat-without-memory' and new chats) from a semantic cache
+# of the previous responses of the same model, if a previous prompt is similar enough (see 'response_cache.py').
+response_cache = None
+if os.environ.get("LLM_RESPONSE_CACHE") == "1":
+    response_cache = ResponseCache(
+        df=dragonfly_client,
+        # The fake embeddings only match identical prompts.
+        embeddings=DeterministicFakeEmbedding(size=256) if os.environ.get("FAKE_CHAT_MODEL") == "1"
+        else OpenAIEmbeddings(model="text-embedding-3-small"),
+        model_name=LARGE_LANGUAGE_MODEL_NAME,
+        similarity_threshold=float(os.environ.get("LLM_RESPONSE_CACHE_SIMILARITY_THRESHOLD", "0.95")),
+        ttl_seconds=int(os.environ.get("LLM_RESPONSE_CACHE_TTL_SECONDS", str(24 * 60 * 60))),
+        max_entries=int(os.environ.get("LLM_RESPONSE_CACHE_MAX_ENTRIES", "10000")),
+    )
+
+# If set, only the last 'CHAT_HISTORY_WINDOW_SIZE' chat history entries are sent to the LLM when continuing a chat,
+# and the older ones are folded into a rolling summary, so that the cost of a turn does not grow with the chat.
+# By default (0), the whole chat history is sent.
+CHAT_HISTORY_WINDOW_SIZE = int(os.environ.get("CHAT_HISTORY_WINDOW_SIZE", "0"))
+# If set, the chat history entries sent to the LLM are also limited to 'CHAT_CONTEXT_TOKEN_BUDGET' tokens,
+# including the summary, so that a few long messages do not overflow the context of the LLM. Off by default (0).
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.environ.get("CHAT_CONTEXT_TOKEN_BUDGET", "0"))
+# The entries that left the window are summarized once there are this many of them, to limit the LLM calls.
+CHAT_SUMMARY_BATCH_SIZE = int(os.environ.get("CHAT_SUMMARY_BATCH_SIZE", "10"))
+# The most recently active chat sessions are loaded into Dragonfly at startup, so that the first turns
+# after a restart (or after Dragonfly is flushed) do not all query the database. Set it to 0 to disable.
+CHAT_CACHE_WARM_UP_SESSIONS = int(os.environ.get("CHAT_CACHE_WARM_UP_SESSIONS", "1000"))
+# Only one server process warms up the cache, the one that sets this key first.
+CHAT_CACHE_WARM_UP_LOCK_KEY = "chat_cache_warm_up_lock"
+CHAT_CACHE_WARM_UP_LOCK_SECONDS = 60
+# The default and maximum numbers of chat history entries in a page of 'GET /chat/{chat_id}'.
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_MAX_PAGE_SIZE = 500
+METRICS_FLUSH_INTERVAL_SECONDS = 5
+
 
 def get_chat():
     return chat_api_client
@@ -31,94 +88,349 @@ def get_dragonfly():
     return dragonfly_client
 
 
+def get_response_cache():
+    return response_cache
+
+
 # Create a new FastAPI server.
 app = FastAPI()
 
 
+def _flush_metrics(df: Dragonfly):
+    for counters in metrics.registered_counters():
+        try:
+            counters.flush(df)
+        except Exception as e:
+            print(f"Failed to flush metrics '{counters.name}': {e}")
+
+
+async def _flush_metrics_periodically():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL_SECONDS)
+        await run_in_threadpool(_flush_metrics, dragonfly_client)
+
+
+@app.on_event("startup")
+async def start_metrics_flush():
+    app.state.metrics_flush_task = asyncio.create_task(_flush_metrics_periodically())
+
+
+# In write-behind mode, every server process is a consumer of the write-behind stream.
+async def _consume_write_behind():
+    consumer = write_behind.ChatWriteBehindConsumer(
+        dragonfly_client, SessionLocal, f"{socket.gethostname()}-{os.getpid()}",
+    )
+    await run_in_threadpool(write_behind.ensure_group, dragonfly_client)
+    while True:
+        try:
+            await run_in_threadpool(consumer.run_once)
+        except Exception as e:
+            print(f"Failed to consume the write-behind stream: {e}")
+            await asyncio.sleep(1)
+
+
+@app.on_event("startup")
+async def start_write_behind_consumer():
+    if service.CHAT_WRITE_BEHIND:
+        app.state.write_behind_task = asyncio.create_task(_consume_write_behind())
+
+
+def _warm_up_chat_cache(df: Dragonfly):
+    if not df.set(CHAT_CACHE_WARM_UP_LOCK_KEY, f"{socket.gethostname()}-{os.getpid()}",
+                  nx=True, ex=CHAT_CACHE_WARM_UP_LOCK_SECONDS):
+        return
+    started_at = time.perf_counter()
+    try:
+        with SessionLocal() as db:
+            loaded = service.DataService(db, df).warm_up_chat_cache(CHAT_CACHE_WARM_UP_SESSIONS)
+    except Exception as e:
+        print(f"Failed to warm up the chat cache: {e}")
+        return
+    print(f"Warmed up the chat cache with {loaded} chat sessions in {time.perf_counter() - started_at:.2f} seconds")
+
+
+@app.on_event("startup")
+async def start_chat_cache_warm_up():
+    if CHAT_CACHE_WARM_UP_SESSIONS > 0:
+        app.state.chat_cache_warm_up_task = asyncio.create_task(
+            run_in_threadpool(_warm_up_chat_cache, dragonfly_client))
+
+
+# The counters are totals across all server processes, as of their last flush.
+# The cache hit rate and the idle time histogram are meant for tuning 'CHAT_CACHE_EXPIRATION_SECONDS'.
+@app.get("/metrics")
+def get_metrics(df: Dragonfly = Depends(get_dragonfly)):
+    _flush_metrics(df)
+    result = {counters.name: counters.read(df) for counters in metrics.registered_counters()}
+    chat_cache = result.get(service.counters.name, {})
+    hits, misses = chat_cache.get("read_hits", 0), chat_cache.get("read_misses", 0)
+    result["chat_cache_hit_rate"] = round(hits / (hits + misses), 4) if hits + misses > 0 else None
+    # The share of chat session reads that did not query the database: the cache hits (including the chat sessions
+    # loaded by the warm-up), and the unknown chat sessions answered by the negative cache.
+    saved = hits + chat_cache.get("negative_hits", 0)
+    db_loads = chat_cache.get("db_loads", 0)
+    total = saved + db_loads
+    result["chat_cache_db_queries_saved_rate"] = round(saved / total, 4) if total > 0 else None
+    if service.CHAT_WRITE_BEHIND:
+        result["chat_write_behind_lag"] = write_behind.lag(df)
+    return result
+
+
 @app.get("/")
 def hello():
     return "Hello, LangChain! Hello, OpenAI!"
 
 
+# The chat endpoints below invoke the LLM asynchronously, so that a server process serves many chats concurrently.
+# The database and Dragonfly clients are synchronous, so they are called in the thread pool.
+#
+# With 'stream=true', the AI response is streamed token by token as server-sent events:
+#   - 'event: token' with 'data: {"content": "..."}' for each token.
+#   - 'event: done' with the same data as the non-streaming response, after the chat history entries are saved.
+# The chat history entries are saved after the stream finishes, so a stream interrupted by the client is not saved.
+# Since the dependencies are closed before a streaming response finishes, the saving opens its own database session.
+
 @app.post("/chat-without-memory")
 async def chat_without_memory(
         chat_message_human: ChatMessageCreate,
+        stream: bool = False,
         chat: ChatOpenAI = Depends(get_chat),
+        cache: Optional[ResponseCache] = Depends(get_response_cache),
 ):
-    message = HumanMessage(content=chat_message_human.content)
-    chat_message = chat.invoke([message])
+    messages = [HumanMessage(content=chat_message_human.content)]
+    if stream:
+        async def save(chat_message_ai: BaseMessage) -> dict:
+            return {"content": chat_message_ai.content}
+
+        return __stream_chat(chat, messages, save, cache)
+    chat_message = await __ainvoke(chat, messages, cache)
     return {"content": chat_message.content}
 
 
 @app.post("/chat")
 async def new_chat(
         chat_message_human: ChatMessageCreate,
-        db: Session = Depends(get_db_session),
+        stream: bool = False,
         df: Dragonfly = Depends(get_dragonfly),
         chat: ChatOpenAI = Depends(get_chat),
+        cache: Optional[ResponseCache] = Depends(get_response_cache),
 ) -> service.ChatSessionResponse:
-    # Invoke the OpenAI API to get the AI response.
-    message = HumanMessage(content=chat_message_human.content)
-    chat_message_ai = chat.invoke([message])
+    messages = [HumanMessage(content=chat_message_human.content)]
 
     # Create a new chat session with the first two chat history entries.
-    chat_session = ChatSessionCreate(llm_name=LARGE_LANGUAGE_MODEL_NAME)
-    new_chat_histories = __messages_to_histories(chat_message_human, chat_message_ai)
-    srv = service.DataService(db, df)
-    chat_session_response = srv.create_chat_session(chat_session, new_chat_histories)
-    return chat_session_response
+    async def save(chat_message_ai: BaseMessage) -> service.ChatSessionResponse:
+        chat_session = ChatSessionCreate(llm_name=LARGE_LANGUAGE_MODEL_NAME)
+        new_chat_histories = __messages_to_histories(chat_message_human, chat_message_ai)
+        with SessionLocal() as db:
+            srv = service.DataService(db, df)
+            return await run_in_threadpool(srv.create_chat_session, chat_session, new_chat_histories)
+
+    if stream:
+        return __stream_chat(chat, messages, save, cache)
+    # Invoke the OpenAI API to get the AI response.
+    chat_message_ai = await __ainvoke(chat, messages, cache)
+    return await save(chat_message_ai)
 
 
 @app.patch("/chat/{chat_id}")
 async def continue_chat(
         chat_id: int,
         chat_message_human: ChatMessageCreate,
+        background_tasks: BackgroundTasks,
+        stream: bool = False,
         db: Session = Depends(get_db_session),
         df: Dragonfly = Depends(get_dragonfly),
         chat: ChatOpenAI = Depends(get_chat),
 ) -> service.ChatSessionResponse:
     # Check if the chat session exists and refresh the cache.
     srv = service.DataService(db, df)
-    prev_chat_session_response = srv.read_chat_histories(chat_id)
-    if prev_chat_session_response is None:
-        raise HTTPException(status_code=404, detail="chat not found")
+    if __windowed():
+        chat_context = await run_in_threadpool(
+            srv.read_chat_context, chat_id, CHAT_HISTORY_WINDOW_SIZE or None, CHAT_CONTEXT_TOKEN_BUDGET or None,
+        )
+        if chat_context is None:
+            raise HTTPException(status_code=404, detail="chat not found")
+        prev_chat_session_response = service.ChatSessionResponse(chat_id, chat_context.chat_histories)
+        summary = chat_context.summary
+    else:
+        prev_chat_session_response = await run_in_threadpool(srv.read_chat_histories, chat_id)
+        if prev_chat_session_response is None:
+            raise HTTPException(status_code=404, detail="chat not found")
+        summary = None
 
-    # Construct messages from chat histories and then append the new human message.
-    chat_histories = prev_chat_session_response.chat_histories
+    # Construct messages from the summary and chat histories and then append the new human message.
     messages = []
-    for i in range(len(chat_histories)):
-        if chat_histories[i].is_human_message:
-            messages.append(HumanMessage(content=chat_histories[i].content))
-        else:
-            messages.append(AIMessage(content=chat_histories[i].content))
+    if summary is not None:
+        messages.append(SystemMessage(content=f"Summary of the earlier conversation:\n{summary.content}"))
+    messages.extend(__histories_to_messages(prev_chat_session_response.chat_histories))
     messages.append(HumanMessage(content=chat_message_human.content))
 
-    # Invoke the OpenAI API to get the AI response.
-    chat_message_ai = chat.invoke(messages)
-
     # Add two chat history entries to an existing chat session.
-    new_chat_histories = __messages_to_histories(chat_message_human, chat_message_ai)
-    chat_session_response = srv.add_chat_histories(prev_chat_session_response, new_chat_histories)
-    return chat_session_response
+    # In windowed mode, the response contains the window and the new entries, not the whole chat history,
+    # and the rolling summary is updated after the response (or the 'done' event) is sent.
+    async def save(chat_message_ai: BaseMessage) -> service.ChatSessionResponse:
+        new_chat_histories = __messages_to_histories(chat_message_human, chat_message_ai)
+        with SessionLocal() as save_db:
+            save_srv = service.DataService(save_db, df)
+            chat_session_response = await run_in_threadpool(
+                save_srv.add_chat_histories, prev_chat_session_response, new_chat_histories,
+            )
+        if __windowed():
+            background_tasks.add_task(__update_chat_summary, df, chat, chat_session_response, summary)
+        return chat_session_response
+
+    if stream:
+        return __stream_chat(chat, messages, save)
+    # Invoke the OpenAI API to get the AI response.
+    chat_message_ai = await chat.ainvoke(messages)
+    return await save(chat_message_ai)
 
 
+# Without 'before', 'after', or 'limit', the whole chat history is returned.
+# Otherwise, a page of chat history entries with IDs between 'after' and 'before' (exclusive) is returned:
+#   - The last page: '?limit=50', then the previous pages: '?before={ID of the first entry}&limit=50'.
+#   - The next pages: '?after={ID of the last entry}&limit=50'.
 @app.get("/chat/{chat_id}")
 async def read_chat_histories(
         chat_id: int,
+        before: Optional[int] = Query(default=None, ge=1),
+        after: Optional[int] = Query(default=None, ge=0),
+        limit: Optional[int] = Query(default=None, ge=1, le=CHAT_HISTORY_MAX_PAGE_SIZE),
         db: Session = Depends(get_db_session),
         df: Dragonfly = Depends(get_dragonfly),
-) -> service.ChatSessionResponse:
+) -> Union[service.ChatSessionResponse, service.ChatHistoryPageResponse]:
     srv = service.DataService(db, df)
-    chat_session_response = srv.read_chat_histories(chat_id)
+    if before is not None or after is not None or limit is not None:
+        page = await run_in_threadpool(
+            srv.read_chat_history_page, chat_id, after, before, limit or CHAT_HISTORY_PAGE_SIZE,
+        )
+        if page is None:
+            raise HTTPException(status_code=404, detail="chat not found")
+        return page
+    chat_session_response = await run_in_threadpool(srv.read_chat_histories, chat_id)
     if chat_session_response is None:
         raise HTTPException(status_code=404, detail="chat not found")
     return chat_session_response
 
 
+# Invoke the LLM with a single prompt, unless a response to a similar prompt is in 'cache' (if given).
+async def __ainvoke(
+        chat: ChatOpenAI,
+        messages: List[BaseMessage],
+        cache: Optional[ResponseCache] = None,
+) -> BaseMessage:
+    if cache is None:
+        return await chat.ainvoke(messages)
+    cached_message_ai, embedding = await run_in_threadpool(cache.lookup, messages[-1].content)
+    if cached_message_ai is not None:
+        return cached_message_ai
+    chat_message_ai = await chat.ainvoke(messages)
+    await run_in_threadpool(cache.store, embedding, chat_message_ai)
+    return chat_message_ai
+
+
+# Stream the AI response as server-sent events, then save it with 'save' and send its result as the last event.
+# A response from 'cache' (if given) is sent as a single token.
+def __stream_chat(
+        chat: ChatOpenAI,
+        messages: List[BaseMessage],
+        save: Callable[[BaseMessage], Awaitable[Any]],
+        cache: Optional[ResponseCache] = None,
+) -> StreamingResponse:
+    async def events() -> AsyncIterator[str]:
+        chat_message_ai, embedding = None, None
+        if cache is not None:
+            chat_message_ai, embedding = await run_in_threadpool(cache.lookup, messages[-1].content)
+        if chat_message_ai is not None:
+            yield __server_sent_event("token", {"content": chat_message_ai.content})
+        else:
+            async for chunk in chat.astream(messages):
+                chat_message_ai = chunk if chat_message_ai is None else chat_message_ai + chunk
+                if chunk.content:
+                    yield __server_sent_event("token", {"content": chunk.content})
+            if cache is not None:
+                await run_in_threadpool(cache.store, embedding, chat_message_ai)
+        result = await save(chat_message_ai)
+        yield __server_sent_event("done", jsonable_encoder(result))
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def __server_sent_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def __histories_to_messages(chat_histories: List[service.ChatHistoryResponse]) -> List[BaseMessage]:
+    messages = []
+    for chat_history in chat_histories:
+        if chat_history.is_human_message:
+            messages.append(HumanMessage(content=chat_history.content))
+        else:
+            messages.append(AIMessage(content=chat_history.content))
+    return messages
+
+
+def __windowed() -> bool:
+    return CHAT_HISTORY_WINDOW_SIZE > 0 or CHAT_CONTEXT_TOKEN_BUDGET > 0
+
+
+# Fold the chat history entries that have left the window into the rolling summary.
+# The entries are summarized in batches of 'CHAT_SUMMARY_BATCH_SIZE', along with the previous summary,
+# so that the summary stays short and the LLM is called once every few turns.
+# It runs as a background task after the response, with a database session of its own.
+async def __update_chat_summary(
+        df: Dragonfly,
+        chat: ChatOpenAI,
+        chat_session_response: service.ChatSessionResponse,
+        summary: service.ChatSummaryResponse,
+) -> ():
+    try:
+        with SessionLocal() as db:
+            await __summarize(service.DataService(db, df), chat, chat_session_response, summary)
+    except Exception as e:
+        print(f"Failed to update the summary of chat session {chat_session_response.chat_session_id}: {e}")
+
+
+async def __summarize(
+        srv: service.DataService,
+        chat: ChatOpenAI,
+        chat_session_response: service.ChatSessionResponse,
+        summary: service.ChatSummaryResponse,
+) -> ():
+    # The window of the next turn starts at this entry, using the cached token counts of the entries.
+    window = service.take_recent_chat_histories(
+        reversed(chat_session_response.chat_histories),
+        CHAT_HISTORY_WINDOW_SIZE or None, CHAT_CONTEXT_TOKEN_BUDGET or None, summary,
+    )
+    # If even the newest entry does not fit in the budget, the next window is empty.
+    window_first_id = window[0].id if window else chat_session_response.chat_histories[-1].id + 1
+    after_id = summary.last_chat_history_id if summary is not None else 0
+    to_summarize = await run_in_threadpool(
+        srv.read_chat_histories_between,
+        chat_session_response.chat_session_id, after_id, window_first_id, CHAT_SUMMARY_BATCH_SIZE,
+    )
+    if len(to_summarize) < CHAT_SUMMARY_BATCH_SIZE:
+        return
+
+    lines = [("Human: " if v.is_human_message else "AI: ") + v.content for v in to_summarize]
+    prompt = "Progressively summarize the conversation, adding to the previous summary. " \
+             "Keep the facts, names, and decisions needed to continue the conversation.\n\n" \
+             f"Previous summary:\n{summary.content if summary is not None else ''}\n\n" \
+             "New lines of conversation:\n" + "\n".join(lines) + "\n\nNew summary:"
+    summary_message = await chat.ainvoke([HumanMessage(content=prompt)])
+    await run_in_threadpool(
+        srv.update_chat_summary,
+        chat_session_response.chat_session_id,
+        service.ChatSummaryResponse(summary_message.content, to_summarize[-1].id),
+    )
+
+
+# The token usage is not reported for streamed responses.
 def __messages_to_histories(
         chat_message_human: ChatMessageCreate,
         chat_message_ai: BaseMessage,
 ) -> (ChatMessageCreate, ChatMessageCreate):
+    token_usage = chat_message_ai.response_metadata.get("token_usage", {})
     chat_history_human = ChatHistoryCreate(
         is_human_message=True,
         content=chat_message_human.content,
@@ -126,10 +438,10 @@ def __messages_to_histories(
     chat_history_ai = ChatHistoryCreate(
         is_human_message=False,
         content=chat_message_ai.content,
-        metadata_completion_tokens=chat_message_ai.response_metadata["token_usage"]["completion_tokens"],
-        metadata_prompt_tokens=chat_message_ai.response_metadata["token_usage"]["prompt_tokens"],
-        metadata_total_tokens=chat_message_ai.response_metadata["token_usage"]["total_tokens"],
-        metadata_system_fingerprint=chat_message_ai.response_metadata["system_fingerprint"],
+        metadata_completion_tokens=token_usage.get("completion_tokens"),
+        metadata_prompt_tokens=token_usage.get("prompt_tokens"),
+        metadata_total_tokens=token_usage.get("total_tokens"),
+        metadata_system_fingerprint=chat_message_ai.response_metadata.get("system_fingerprint"),
         external_id=chat_message_ai.id,
     )
     return chat_history_human, chat_history_ai
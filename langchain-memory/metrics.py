@@ -0,0 +1,66 @@
+import threading
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from redis import Redis as Dragonfly
+
+
+def metrics_key(name: str) -> str:
+    return f"metrics:{name}"
+
+
+# Counters are incremented in-process and flushed to a Dragonfly hash periodically.
+# Since HINCRBY is atomic, every server process can flush into the same hash,
+# and the hash holds the totals across all processes: 'HGETALL metrics:{name}'.
+class Counters:
+    def __init__(self, name: str):
+        self.name = name
+        self.__lock = threading.Lock()
+        self.__unflushed: Dict[str, int] = defaultdict(int)
+        _registry.append(self)
+
+    def incr(self, field: str, amount: int = 1):
+        with self.__lock:
+            self.__unflushed[field] += amount
+
+    def flush(self, df: Dragonfly):
+        with self.__lock:
+            unflushed, self.__unflushed = self.__unflushed, defaultdict(int)
+        if not unflushed:
+            return
+        try:
+            pipe = df.pipeline(transaction=False)
+            for field, amount in unflushed.items():
+                pipe.hincrby(metrics_key(self.name), field, amount)
+            pipe.execute()
+        except Exception:
+            # Keep the increments of a failed flush, so they are flushed next time.
+            with self.__lock:
+                for field, amount in unflushed.items():
+                    self.__unflushed[field] += amount
+            raise
+
+    # Returns the totals across all processes, as of their last flush.
+    def read(self, df: Dragonfly) -> Dict[str, int]:
+        return {k.decode(): int(v) for k, v in df.hgetall(metrics_key(self.name)).items()}
+
+
+# Returns the histogram counter field of a value, i.e., '{prefix}_le_10ms' for 5 ms with the buckets (1, 10, 100).
+# Values above the last bucket fall in '{prefix}_gt_{last}{unit}'.
+def bucket(prefix: str, value: float, buckets: Tuple[int, ...], unit: str) -> str:
+    for b in buckets:
+        if value <= b:
+            return f'{prefix}_le_{b}{unit}'
+    return f'{prefix}_gt_{buckets[-1]}{unit}'
+
+
+def duration_bucket(prefix: str, seconds: float, buckets_ms: Tuple[int, ...]) -> str:
+    return bucket(prefix, seconds * 1000, buckets_ms, 'ms')
+
+
+_registry: List[Counters] = []
+
+
+# Returns all the counters created in this process.
+def registered_counters() -> List[Counters]:
+    return list(_registry)
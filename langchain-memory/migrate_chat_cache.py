@@ -0,0 +1,53 @@
+import argparse
+import json
+
+from redis import Redis as Dragonfly
+
+import service
+from database import SessionLocal
+
+# Migrate the cached chat sessions from the legacy sorted-set layout to the stream layout (see 'service.py').
+#
+# The legacy sorted sets may have lost identical messages, so they are not converted. Instead, each legacy key
+# is deleted, and with '--rebuild' the chat session is loaded from the database into the stream layout,
+# so that the active chat sessions stay cached. The server migrates the chat sessions lazily on cache misses as well,
+# so this script is only needed to free the memory of the legacy keys right away.
+#   python migrate_chat_cache.py --dragonfly-url redis://localhost:6379/0 --rebuild
+
+LEGACY_KEY_PATTERN = "chat_histories_by_session_id:*"
+
+
+def run(args: argparse.Namespace) -> dict:
+    df = Dragonfly.from_url(args.dragonfly_url)
+    db = SessionLocal()
+    srv = service.DataService(db, df)
+    deleted, rebuilt = 0, 0
+    try:
+        for key in df.scan_iter(match=LEGACY_KEY_PATTERN, count=args.scan_count, _type="zset"):
+            chat_session_id = int(key.rsplit(b":", 1)[1])
+            if args.rebuild:
+                # A cache miss in the stream layout deletes the legacy key and loads the chat session.
+                if srv.read_chat_histories(chat_session_id) is not None:
+                    rebuilt += 1
+            df.delete(key)
+            deleted += 1
+    finally:
+        db.close()
+        df.close()
+    return {"legacy_keys_deleted": deleted, "chat_sessions_rebuilt": rebuilt}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Migrate the chat cache from sorted sets to streams.")
+    parser.add_argument("--dragonfly-url", default="redis://localhost:6379/0")
+    parser.add_argument("--rebuild", action="store_true", help="load the migrated chat sessions into the cache")
+    parser.add_argument("--scan-count", type=int, default=1000)
+    return parser.parse_args()
+
+
+def main(args: argparse.Namespace):
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main(parse_args())
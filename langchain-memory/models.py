@@ -9,6 +9,9 @@ class ChatSession(Base):
 
     id = Column(Integer, primary_key=True)
     llm_name = Column(String, nullable=False)
+    # Rolling summary of the chat history entries up to (and including) 'summary_last_chat_history_id'.
+    summary = Column(String)
+    summary_last_chat_history_id = Column(Integer)
 
     chat_histories = relationship("ChatHistory", back_populates="chat_session")
 
@@ -1,7 +1,9 @@
 CREATE TABLE chat_sessions
 (
-    id       INTEGER PRIMARY KEY,
-    llm_name TEXT NOT NULL
+    id                           INTEGER PRIMARY KEY,
+    llm_name                     TEXT NOT NULL,
+    summary                      TEXT,
+    summary_last_chat_history_id INTEGER
 );
 
 CREATE TABLE chat_histories
@@ -0,0 +1,169 @@
+import time
+import uuid
+from typing import Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage, BaseMessage
+from redis import Redis as Dragonfly
+from redis.commands.search.field import VectorField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+from redis.exceptions import RedisError, ResponseError
+
+import metrics
+
+# Histogram buckets of the lookup latencies, including the prompt embedding.
+LOOKUP_LATENCY_BUCKETS_MS = (10, 50, 200, 1000)
+
+counters = metrics.Counters('llm_response_cache')
+
+
+# A semantic cache of the LLM responses to single prompts, backed by a Dragonfly vector index.
+#
+# - Each cached response is a hash 'llm_response_cache:{model}:{uuid}' with the prompt embedding, the completion,
+#   and its token metadata. The hashes of a model are indexed by 'llm_response_cache_idx:{model}',
+#   so that the responses of different models are never mixed.
+# - A lookup embeds the prompt and finds the nearest cached prompt by cosine distance (KNN 1).
+#   It is a hit if the similarity, i.e., 1 - distance, is at least 'similarity_threshold'.
+# - Cached responses expire after 'ttl_seconds'. They are also tracked in the sorted set
+#   'llm_response_cache_entries:{model}' by last use, and the least recently used ones are deleted
+#   when there are more than 'max_entries'.
+#
+# - A hit refreshes both the last use and the expiration of the cached response.
+#
+# Dragonfly must support the search commands (FT.CREATE and FT.SEARCH). If a lookup fails (including connection
+# errors and timeouts), it is counted as an error, and the LLM is called as if the cache missed.
+# If storing a response fails, it is counted as an error too, and the response is still returned.
+class ResponseCache:
+    def __init__(
+            self,
+            df: Dragonfly,
+            embeddings: Embeddings,
+            model_name: str,
+            similarity_threshold: float,
+            ttl_seconds: int,
+            max_entries: int,
+    ):
+        self.df = df
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.__index_created = False
+
+    def key_prefix(self) -> str:
+        return f"llm_response_cache:{self.model_name}:"
+
+    def key_index(self) -> str:
+        return f"llm_response_cache_idx:{self.model_name}"
+
+    def key_entries(self) -> str:
+        return f"llm_response_cache_entries:{self.model_name}"
+
+    # Returns the cached response to a similar prompt (or None), and the prompt embedding to store the response with.
+    def lookup(self, prompt: str) -> Tuple[Optional[AIMessage], bytes]:
+        started_at = time.perf_counter()
+        embedding = np.array(self.embeddings.embed_query(prompt), dtype=np.float32).tobytes()
+        try:
+            self.__ensure_index(len(embedding) // 4)
+            query = Query("*=>[KNN 1 @embedding $embedding AS distance]") \
+                .return_fields("distance", "content", "completion_tokens", "prompt_tokens", "total_tokens",
+                               "system_fingerprint", "external_id") \
+                .dialect(2)
+            docs = self.df.ft(self.key_index()).search(query, query_params={"embedding": embedding}).docs
+            doc = docs[0] if docs and 1 - float(docs[0].distance) >= self.similarity_threshold else None
+            if doc is not None:
+                # Mark the entry as recently used and extend its expiration, unless it has been evicted since.
+                pipe = self.df.pipeline(transaction=False)
+                pipe.zadd(self.key_entries(), {doc.id: time.time()}, xx=True)
+                pipe.expire(doc.id, self.ttl_seconds)
+                pipe.execute()
+        except RedisError as e:
+            counters.incr('errors')
+            print(f"Failed to look up the LLM response cache: {e}")
+            return None, embedding
+        finally:
+            counters.incr(metrics.duration_bucket('lookup_latency', time.perf_counter() - started_at,
+                                                  LOOKUP_LATENCY_BUCKETS_MS))
+
+        if doc is None:
+            counters.incr('misses')
+            return None, embedding
+        counters.incr('hits')
+        return AIMessage(
+            id=doc.external_id or None,
+            content=doc.content,
+            response_metadata={
+                "token_usage": {
+                    "completion_tokens": _optional_int(doc.completion_tokens),
+                    "prompt_tokens": _optional_int(doc.prompt_tokens),
+                    "total_tokens": _optional_int(doc.total_tokens),
+                },
+                "system_fingerprint": doc.system_fingerprint or None,
+                "cached": True,
+            },
+        ), embedding
+
+    # Cache the response to the prompt with the embedding returned by 'self.lookup',
+    # and evict the least recently used responses beyond 'max_entries'.
+    def store(self, embedding: bytes, message: BaseMessage) -> ():
+        try:
+            self.__store(embedding, message)
+        except RedisError as e:
+            counters.incr('errors')
+            print(f"Failed to store the LLM response cache: {e}")
+
+    def __store(self, embedding: bytes, message: BaseMessage) -> ():
+        key = f"{self.key_prefix()}{uuid.uuid4().hex}"
+        token_usage = message.response_metadata.get("token_usage", {})
+        now = time.time()
+        pipe = self.df.pipeline(transaction=False)
+        pipe.hset(key, mapping={
+            "embedding": embedding,
+            "content": message.content,
+            "completion_tokens": _optional_str(token_usage.get("completion_tokens")),
+            "prompt_tokens": _optional_str(token_usage.get("prompt_tokens")),
+            "total_tokens": _optional_str(token_usage.get("total_tokens")),
+            "system_fingerprint": message.response_metadata.get("system_fingerprint") or "",
+            "external_id": message.id or "",
+        })
+        pipe.expire(key, self.ttl_seconds)
+        pipe.zadd(self.key_entries(), {key: now})
+        # The entries that have not been used for the TTL have expired.
+        pipe.zremrangebyscore(self.key_entries(), "-inf", now - self.ttl_seconds)
+        pipe.zcard(self.key_entries())
+        *_, entries = pipe.execute()
+        counters.incr('stored')
+
+        if entries > self.max_entries:
+            evicted = [key for key, _ in self.df.zpopmin(self.key_entries(), entries - self.max_entries)]
+            self.df.delete(*evicted)
+            counters.incr('evicted', len(evicted))
+
+    def __ensure_index(self, dimensions: int) -> ():
+        if self.__index_created:
+            return
+        try:
+            self.df.ft(self.key_index()).create_index(
+                fields=[VectorField("embedding", "HNSW", {
+                    "TYPE": "FLOAT32",
+                    "DIM": dimensions,
+                    "DISTANCE_METRIC": "COSINE",
+                })],
+                definition=IndexDefinition(prefix=[self.key_prefix()], index_type=IndexType.HASH),
+            )
+        except ResponseError as e:
+            # The index has been created by another server process.
+            if "already exists" not in str(e).lower():
+                raise
+        self.__index_created = True
+
+
+def _optional_str(value: Optional[int]) -> str:
+    return "" if value is None else str(value)
+
+
+def _optional_int(value: Optional[str]) -> Optional[int]:
+    return int(value) if value else None
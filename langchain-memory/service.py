@@ -1,12 +1,35 @@
+import os
+import time
+from collections import defaultdict
 from dataclasses import dataclass
-from typing import List, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
+import msgpack
 from fastapi import HTTPException
 from redis import Redis as Dragonfly
+from redis.exceptions import ResponseError
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
+import metrics
 import models
 import schemas
+import write_behind
+from token_counting import count_tokens
+
+# A chat session expires from the cache after this long without being read or written.
+CHAT_CACHE_EXPIRATION_SECONDS = int(os.environ.get("CHAT_CACHE_EXPIRATION_SECONDS", str(60 * 60)))
+# A chat session that is not in the database is remembered as missing for this long, so that requests
+# for unknown chat IDs (e.g., from scanners) do not query the database each time. Set it to 0 to disable.
+CHAT_NEGATIVE_CACHE_EXPIRATION_SECONDS = int(os.environ.get("CHAT_NEGATIVE_CACHE_EXPIRATION_SECONDS", "30"))
+# Set 'CHAT_WRITE_BEHIND=1' to insert the chat turns into the database after the response, in batches
+# (see 'write_behind.py'). The cache is the source of truth for the chat turns until they are inserted.
+CHAT_WRITE_BEHIND = os.environ.get("CHAT_WRITE_BEHIND") == "1"
+# Histogram buckets of the cache operation latencies, and of the idle time of a chat session before a cache hit.
+CACHE_LATENCY_BUCKETS_MS = (1, 5, 20, 100)
+CACHE_IDLE_BUCKETS_SECONDS = (60, 300, 900, 1800, 3600)
+
+counters = metrics.Counters('chat_cache')
 
 
 @dataclass
@@ -14,6 +37,8 @@ class ChatHistoryResponse:
     id: int
     content: str
     is_human_message: bool
+    # The number of tokens of the content, if known.
+    token_count: Optional[int] = None
 
 
 @dataclass
@@ -22,6 +47,32 @@ class ChatSessionResponse:
     chat_histories: List[ChatHistoryResponse]
 
 
+# A page of the chat history entries of a chat session, in order. 'has_more' is whether there are more entries
+# in the direction of the page, i.e., before the first entry when paging backward, or after the last one otherwise.
+@dataclass
+class ChatHistoryPageResponse:
+    chat_session_id: int
+    chat_histories: List[ChatHistoryResponse]
+    has_more: bool
+
+
+# The rolling summary of a chat session, covering the chat history entries up to 'last_chat_history_id'.
+@dataclass
+class ChatSummaryResponse:
+    content: str
+    last_chat_history_id: int
+    # The number of tokens of the content, computed once when the summary is created or loaded.
+    token_count: Optional[int] = None
+
+
+# The context for the next turn of a chat session: the most recent chat history entries and the rolling summary.
+@dataclass
+class ChatContextResponse:
+    chat_session_id: int
+    chat_histories: List[ChatHistoryResponse]
+    summary: Optional[ChatSummaryResponse]
+
+
 class DataService:
     def __init__(self, db: Session, df: Dragonfly):
         self.db = db
@@ -36,21 +87,29 @@ class DataService:
     ) -> ChatSessionResponse:
         # Create a new chat session.
         chat_session = models.ChatSession(llm_name=new_chat_session.llm_name)
-        self.db.add(chat_session)
-        self.db.flush()
+        if CHAT_WRITE_BEHIND:
+            wb = write_behind.ChatWriteBehind(self.df)
+            chat_session.id = wb.allocate_ids(self.db, models.ChatSession, 1)[0]
+        else:
+            self.db.add(chat_session)
+            self.db.flush()
 
         # Add the first two chat history entries for the chat session.
         chat_history_human = self.__chat_history_schema_to_model(chat_session.id, new_chat_histories[0])
         chat_history_ai = self.__chat_history_schema_to_model(chat_session.id, new_chat_histories[1])
-        self.db.add_all([chat_history_human, chat_history_ai])
-        self.db.commit()
-        self.db.refresh(chat_session)
+        if CHAT_WRITE_BEHIND:
+            chat_history_human.id, chat_history_ai.id = wb.allocate_ids(self.db, models.ChatHistory, 2)
+            wb.enqueue(chat_session, [chat_history_human, chat_history_ai])
+        else:
+            self.db.add_all([chat_history_human, chat_history_ai])
+            self.db.commit()
+            self.db.refresh(chat_session)
 
         # Since this is a new chat session, and the user will likely want to continue this chat session.
         # We will cache the chat history entries in Dragonfly.
         ru = _DataCacheService(self.df)
         chat_histories = [chat_history_human, chat_history_ai]
-        chat_history_responses = [ChatHistoryResponse(v.id, v.content, v.is_human_message) for v in chat_histories]
+        chat_history_responses = [self.__chat_history_model_to_response(v) for v in chat_histories]
         ru.add_chat_histories(chat_session.id, chat_history_responses)
         return ChatSessionResponse(chat_session.id, chat_history_responses)
 
@@ -66,13 +125,18 @@ class DataService:
         chat_session_id = prev_chat_session_response.chat_session_id
         chat_history_human = self.__chat_history_schema_to_model(chat_session_id, new_chat_histories[0])
         chat_history_ai = self.__chat_history_schema_to_model(chat_session_id, new_chat_histories[1])
-        self.db.add_all([chat_history_human, chat_history_ai])
-        self.db.commit()
+        if CHAT_WRITE_BEHIND:
+            wb = write_behind.ChatWriteBehind(self.df)
+            chat_history_human.id, chat_history_ai.id = wb.allocate_ids(self.db, models.ChatHistory, 2)
+            wb.enqueue(None, [chat_history_human, chat_history_ai])
+        else:
+            self.db.add_all([chat_history_human, chat_history_ai])
+            self.db.commit()
 
         # Cache the chat history entries in Dragonfly.
         ru = _DataCacheService(self.df)
         chat_histories = [chat_history_human, chat_history_ai]
-        chat_history_responses = [ChatHistoryResponse(v.id, v.content, v.is_human_message) for v in chat_histories]
+        chat_history_responses = [self.__chat_history_model_to_response(v) for v in chat_histories]
         ru.add_chat_histories(chat_session_id, chat_history_responses)
         prev_chat_session_response.chat_histories.extend(chat_history_responses)
         return prev_chat_session_response
@@ -86,15 +150,186 @@ class DataService:
             return ChatSessionResponse(chat_session_id, chat_history_responses)
         # If the chat history entries are not cached in Dragonfly, read from the database.
         # Then cache them in Dragonfly.
+        loaded = self.__load_chat_session(chat_session_id)
+        if loaded is None:
+            return None
+        chat_history_responses, _ = loaded
+        return ChatSessionResponse(chat_session_id, chat_history_responses)
+
+    # Read a page of up to 'limit' chat history entries with IDs in the open interval ('after_id', 'before_id'),
+    # where either bound may be None. With only 'after_id', the page is the oldest entries after it (paging forward).
+    # Otherwise, the page is the newest entries in the interval, e.g., the last page with neither (paging backward).
+    # The cost of a cache hit is bounded by 'limit', not by the length of the chat session.
+    def read_chat_history_page(
+            self,
+            chat_session_id: int,
+            after_id: Optional[int],
+            before_id: Optional[int],
+            limit: int,
+    ) -> Union[ChatHistoryPageResponse, None]:
+        ru = _DataCacheService(self.df)
+        cached = ru.read_chat_history_page(chat_session_id, after_id, before_id, limit)
+        if cached is not None:
+            chat_history_responses, has_more = cached
+            return ChatHistoryPageResponse(chat_session_id, chat_history_responses, has_more)
+        # On a cache miss, the whole chat session is read from the database and cached,
+        # so that the following pages are served from Dragonfly.
+        loaded = self.__load_chat_session(chat_session_id)
+        if loaded is None:
+            return None
+        chat_history_responses, _ = loaded
+        chat_history_responses = [v for v in chat_history_responses
+                                  if (after_id is None or v.id > after_id) and (before_id is None or v.id < before_id)]
+        if after_id is not None and before_id is None:
+            page = chat_history_responses[:limit]
+        else:
+            page = chat_history_responses[-limit:]
+        return ChatHistoryPageResponse(chat_session_id, page, len(chat_history_responses) > limit)
+
+    # Read the context for the next turn of a chat session: its rolling summary, and the newest chat history entries
+    # after the summary, up to 'window_size' entries and 'token_budget' tokens (including the summary) if given.
+    # Unlike 'self.read_chat_histories', the cost of a cache hit does not grow with the length of the chat session.
+    def read_chat_context(
+            self,
+            chat_session_id: int,
+            window_size: Optional[int],
+            token_budget: Optional[int] = None,
+    ) -> Union[ChatContextResponse, None]:
+        ru = _DataCacheService(self.df)
+        cached = ru.read_recent_chat_histories(chat_session_id, window_size, token_budget)
+        if cached is not None:
+            chat_history_responses, summary = cached
+            return ChatContextResponse(chat_session_id, chat_history_responses, summary)
+        # On a cache miss, the whole chat session is read from the database and cached,
+        # so that the following turns are served from Dragonfly.
+        loaded = self.__load_chat_session(chat_session_id)
+        if loaded is None:
+            return None
+        chat_history_responses, summary = loaded
+        chat_history_responses = take_recent_chat_histories(
+            reversed(chat_history_responses), window_size, token_budget, summary,
+        )
+        return ChatContextResponse(chat_session_id, chat_history_responses, summary)
+
+    # Read up to 'limit' chat history entries with IDs in the open interval ('after_id', 'before_id').
+    # These are the entries that have left the window but are not yet covered by the rolling summary.
+    def read_chat_histories_between(
+            self,
+            chat_session_id: int,
+            after_id: int,
+            before_id: int,
+            limit: int,
+    ) -> List[ChatHistoryResponse]:
+        ru = _DataCacheService(self.df)
+        chat_history_responses = ru.read_chat_histories_between(chat_session_id, after_id, before_id, limit)
+        if chat_history_responses is not None:
+            return chat_history_responses
+        chat_histories = self.db.query(models.ChatHistory) \
+            .filter(models.ChatHistory.chat_session_id == chat_session_id) \
+            .filter(models.ChatHistory.id > after_id) \
+            .filter(models.ChatHistory.id < before_id) \
+            .order_by(models.ChatHistory.id) \
+            .limit(limit) \
+            .all()
+        return [self.__chat_history_model_to_response(v) for v in chat_histories]
+
+    # Replace the rolling summary of a chat session.
+    def update_chat_summary(self, chat_session_id: int, summary: ChatSummaryResponse) -> ():
+        if summary.token_count is None:
+            summary.token_count = count_tokens(summary.content)
+        if CHAT_WRITE_BEHIND:
+            wb = write_behind.ChatWriteBehind(self.df)
+            wb.enqueue_summary(chat_session_id, summary.content, summary.last_chat_history_id)
+        else:
+            self.db.query(models.ChatSession) \
+                .filter(models.ChatSession.id == chat_session_id) \
+                .update({
+                    models.ChatSession.summary: summary.content,
+                    models.ChatSession.summary_last_chat_history_id: summary.last_chat_history_id,
+                })
+            self.db.commit()
+        ru = _DataCacheService(self.df)
+        ru.set_chat_summary(chat_session_id, summary)
+
+    # Load the 'session_count' most recently active chat sessions (those with the newest chat history entries)
+    # from the database into Dragonfly, 'batch_size' chat sessions per query and per pipeline.
+    # Chat sessions that are already cached are skipped. Returns the number of chat sessions loaded.
+    def warm_up_chat_cache(self, session_count: int, batch_size: int = 100) -> int:
+        chat_session_ids = [row[0] for row in self.db.query(models.ChatHistory.chat_session_id)
+                            .group_by(models.ChatHistory.chat_session_id)
+                            .order_by(func.max(models.ChatHistory.id).desc())
+                            .limit(session_count)
+                            .all()]
+        ru = _DataCacheService(self.df)
+        loaded = 0
+        for i in range(0, len(chat_session_ids), batch_size):
+            batch = ru.filter_uncached_chat_sessions(chat_session_ids[i:i + batch_size])
+            if not batch:
+                continue
+            chat_histories = self.db.query(models.ChatHistory) \
+                .filter(models.ChatHistory.chat_session_id.in_(batch)) \
+                .order_by(models.ChatHistory.id) \
+                .all()
+            chat_sessions = self.db.query(models.ChatSession) \
+                .filter(models.ChatSession.id.in_(batch)) \
+                .filter(models.ChatSession.summary.isnot(None)) \
+                .all()
+            chat_history_responses: Dict[int, List[ChatHistoryResponse]] = defaultdict(list)
+            for chat_history in chat_histories:
+                chat_history_responses[chat_history.chat_session_id].append(
+                    self.__chat_history_model_to_response(chat_history))
+            summaries = {v.id: self.__chat_summary_model_to_response(v) for v in chat_sessions}
+            ru.add_chat_sessions(chat_history_responses, summaries)
+            loaded += len(chat_history_responses)
+        counters.incr('warmed_up_sessions', loaded)
+        return loaded
+
+    # Read all chat history entries and the rolling summary of a chat session from the database,
+    # and cache them in Dragonfly. Returns None if the chat session has no chat history entries.
+    def __load_chat_session(
+            self,
+            chat_session_id: int,
+    ) -> Optional[Tuple[List[ChatHistoryResponse], Optional[ChatSummaryResponse]]]:
+        ru = _DataCacheService(self.df)
+        if ru.is_chat_session_missing(chat_session_id):
+            return None
+        counters.incr('db_loads')
         chat_histories = self.db.query(models.ChatHistory) \
             .filter(models.ChatHistory.chat_session_id == chat_session_id) \
             .order_by(models.ChatHistory.id) \
             .all()
         if chat_histories is None or len(chat_histories) == 0:
+            ru.set_chat_session_missing(chat_session_id)
             return None
-        chat_history_responses = [ChatHistoryResponse(v.id, v.content, v.is_human_message) for v in chat_histories]
+        ru.delete_legacy_chat_histories(chat_session_id)
+        chat_session = self.db.get(models.ChatSession, chat_session_id)
+        summary = None
+        if chat_session is not None and chat_session.summary is not None:
+            summary = self.__chat_summary_model_to_response(chat_session)
+            ru.set_chat_summary(chat_session_id, summary)
+        chat_history_responses = [self.__chat_history_model_to_response(v) for v in chat_histories]
         ru.add_chat_histories(chat_session_id, chat_history_responses)
-        return ChatSessionResponse(chat_session_id, chat_history_responses)
+        return chat_history_responses, summary
+
+    @staticmethod
+    def __chat_history_model_to_response(chat_history: models.ChatHistory) -> ChatHistoryResponse:
+        # The token count of an AI message is its completion tokens, as reported by the LLM (except when streamed).
+        # Otherwise, the content is tokenized, once, since the token count is cached with the entry.
+        token_count = None if chat_history.is_human_message else chat_history.metadata_completion_tokens
+        return ChatHistoryResponse(
+            id=chat_history.id,
+            content=chat_history.content,
+            is_human_message=chat_history.is_human_message,
+            token_count=token_count if token_count is not None else count_tokens(chat_history.content),
+        )
+
+    @staticmethod
+    def __chat_summary_model_to_response(chat_session: models.ChatSession) -> ChatSummaryResponse:
+        return ChatSummaryResponse(
+            content=chat_session.summary,
+            last_chat_history_id=chat_session.summary_last_chat_history_id,
+            token_count=count_tokens(chat_session.summary),
+        )
 
     @staticmethod
     def __chat_history_schema_to_model(
@@ -113,43 +348,341 @@ class DataService:
         )
 
 
+# The chat history entries of a chat session are cached in a Dragonfly stream, one stream entry per chat history entry.
+#
+# - The stream entry ID is '{chat history ID}-0', so that the entries can be read by ID range (XRANGE)
+#   as well as from the end (XREVRANGE with COUNT), and identical messages are kept as separate entries.
+# - Each stream entry has a single field, a msgpack array of [ID, role, content, token count].
+# - Entries are appended in ID order. An entry older than the newest cached one (e.g., from two turns committed
+#   out of order) cannot be appended, so the stream is rewritten in order with it ('__merge_chat_histories').
+#
+# The previous layout was a sorted set of prefixed contents scored by ID, which collapsed identical messages.
+# Such keys are deleted when a chat session is loaded from the database ('delete_legacy_chat_histories'),
+# or all at once with 'migrate_chat_cache.py'.
 class _DataCacheService:
-    HUMAN_MESSAGE_PREFIX = "H:"
-    AI_MESSAGE_PREFIX = "A:"
+    ROLE_HUMAN = 0
+    ROLE_AI = 1
+    ENTRY_FIELD = b"e"
+    # The number of entries read at a time when reading the newest entries within a token budget.
+    READ_BATCH_SIZE = 32
+    # A chat session expires from the cache after this long without being read or written (sliding expiration).
+    EXPIRATION_SECONDS = CHAT_CACHE_EXPIRATION_SECONDS
 
     def __init__(self, df: Dragonfly):
         self.df = df
 
     @staticmethod
     def key_chat_histories(chat_session_id: int) -> str:
+        return f"chat_history_entries_by_session_id:{chat_session_id}"
+
+    @staticmethod
+    def key_legacy_chat_histories(chat_session_id: int) -> str:
         return f"chat_histories_by_session_id:{chat_session_id}"
 
     @staticmethod
-    def chat_history_tuple_to_response(chat_history: (str, float)) -> ChatHistoryResponse:
-        # Note that the sorted-set value is the content, and the score is the ID.
-        prefixed_content = chat_history[0].decode('utf-8', errors='replace')
-        if len(prefixed_content) < 2:
+    def key_chat_summary(chat_session_id: int) -> str:
+        return f"chat_summary_by_session_id:{chat_session_id}"
+
+    @staticmethod
+    def key_missing_chat_session(chat_session_id: int) -> str:
+        return f"chat_session_missing:{chat_session_id}"
+
+    @staticmethod
+    def encode_chat_history(chat_history: ChatHistoryResponse) -> bytes:
+        role = _DataCacheService.ROLE_HUMAN if chat_history.is_human_message else _DataCacheService.ROLE_AI
+        return msgpack.packb([chat_history.id, role, chat_history.content, chat_history.token_count])
+
+    @staticmethod
+    def stream_entry_to_response(stream_entry: (bytes, dict)) -> ChatHistoryResponse:
+        try:
+            encoded = stream_entry[1][_DataCacheService.ENTRY_FIELD]
+            chat_history_id, role, content, token_count = msgpack.unpackb(encoded)
+        except (KeyError, TypeError, ValueError, msgpack.UnpackException):
             raise HTTPException(status_code=500, detail="failed to parse chat history")
-        prefix, content = prefixed_content[:2], prefixed_content[2:]
         return ChatHistoryResponse(
-            id=int(chat_history[1]),
+            id=chat_history_id,
             content=content,
-            is_human_message=(prefix == _DataCacheService.HUMAN_MESSAGE_PREFIX),
+            is_human_message=(role == _DataCacheService.ROLE_HUMAN),
+            token_count=token_count,
         )
 
+    # Write the chat history entries and refresh the expiration of the chat session in a single round trip.
     def add_chat_histories(self, chat_session_id: int, chat_histories: List[ChatHistoryResponse]) -> ():
+        started_at = time.perf_counter()
+        pipe = self.df.pipeline(transaction=False)
+        queued = self.__queue_add_chat_histories(pipe, chat_session_id, chat_histories)
+        self.__execute_add(pipe, queued)
+        self.__record('write', started_at)
+
+    # Write the chat history entries and the rolling summaries of many chat sessions in a single round trip.
+    def add_chat_sessions(
+            self,
+            chat_histories: Dict[int, List[ChatHistoryResponse]],
+            summaries: Dict[int, ChatSummaryResponse],
+    ) -> ():
+        started_at = time.perf_counter()
+        pipe = self.df.pipeline(transaction=False)
+        for chat_session_id, summary in summaries.items():
+            self.__queue_set_chat_summary(pipe, chat_session_id, summary)
+        queued = []
+        for chat_session_id, chat_session_histories in chat_histories.items():
+            queued.extend(self.__queue_add_chat_histories(pipe, chat_session_id, chat_session_histories))
+        self.__execute_add(pipe, queued)
+        self.__record('bulk_write', started_at)
+
+    # Returns the chat sessions of 'chat_session_ids' whose chat history entries are not cached.
+    def filter_uncached_chat_sessions(self, chat_session_ids: List[int]) -> List[int]:
+        pipe = self.df.pipeline(transaction=False)
+        for chat_session_id in chat_session_ids:
+            pipe.exists(self.key_chat_histories(chat_session_id))
+        return [v for v, exists in zip(chat_session_ids, pipe.execute()) if not exists]
+
+    # Returns whether the chat session has been found missing from the database recently.
+    def is_chat_session_missing(self, chat_session_id: int) -> bool:
+        if CHAT_NEGATIVE_CACHE_EXPIRATION_SECONDS <= 0:
+            return False
+        missing = self.df.exists(self.key_missing_chat_session(chat_session_id)) > 0
+        if missing:
+            counters.incr('negative_hits')
+        return missing
+
+    def set_chat_session_missing(self, chat_session_id: int) -> ():
+        if CHAT_NEGATIVE_CACHE_EXPIRATION_SECONDS <= 0:
+            return
+        self.df.set(self.key_missing_chat_session(chat_session_id), 1, ex=CHAT_NEGATIVE_CACHE_EXPIRATION_SECONDS)
+
+    def read_chat_histories(self, chat_session_id: int) -> List[ChatHistoryResponse]:
+        started_at = time.perf_counter()
+        pipe = self.df.pipeline(transaction=False)
+        pipe.xrange(name=self.key_chat_histories(chat_session_id), min="-", max="+")
+        pipe.ttl(name=self.key_chat_histories(chat_session_id))
+        self.__queue_refresh_expiration(pipe, chat_session_id)
+        histories, ttl, *_ = pipe.execute()
+        self.__record('read', started_at, len(histories) > 0, ttl)
+        return [self.stream_entry_to_response(history) for history in histories]
+
+    # See 'DataService.read_chat_history_page'. One more entry than 'limit' is read to tell whether there are more.
+    # Returns None if the chat session is not cached.
+    def read_chat_history_page(
+            self,
+            chat_session_id: int,
+            after_id: Optional[int],
+            before_id: Optional[int],
+            limit: int,
+    ) -> Optional[Tuple[List[ChatHistoryResponse], bool]]:
+        started_at = time.perf_counter()
         key = self.key_chat_histories(chat_session_id)
-        mapping = {}
-        for history in chat_histories:
-            prefix = self.HUMAN_MESSAGE_PREFIX if history.is_human_message else self.AI_MESSAGE_PREFIX
-            mapping[f"{prefix}{history.content}"] = history.id
-        self.df.zadd(
-            name=key,
-            mapping=mapping,
+        # The ranges are inclusive, and '{before_id - 1}' includes any sequence number of that ID.
+        min_id = "-" if after_id is None else f"{after_id + 1}"
+        max_id = "+" if before_id is None else f"{before_id - 1}"
+        forward = after_id is not None and before_id is None
+        pipe = self.df.pipeline(transaction=False)
+        pipe.exists(key)
+        if forward:
+            pipe.xrange(name=key, min=min_id, max=max_id, count=limit + 1)
+        else:
+            pipe.xrevrange(name=key, max=max_id, min=min_id, count=limit + 1)
+        pipe.ttl(name=key)
+        self.__queue_refresh_expiration(pipe, chat_session_id)
+        exists, histories, ttl, *_ = pipe.execute()
+        self.__record('read', started_at, exists > 0, ttl)
+        if not exists:
+            return None
+        has_more = len(histories) > limit
+        histories = histories[:limit]
+        if not forward:
+            histories.reverse()
+        return [self.stream_entry_to_response(history) for history in histories], has_more
+
+    # Read the rolling summary, and the newest chat history entries after it, up to 'count' entries
+    # and 'token_budget' tokens (including the summary) if given. Returns None if the chat session is not cached.
+    #
+    # The first batch of entries is read in the same round trip as the summary. With a token budget, more batches
+    # are read only while all the entries fit in the budget, i.e., for chat sessions with many short messages.
+    def read_recent_chat_histories(
+            self,
+            chat_session_id: int,
+            count: Optional[int],
+            token_budget: Optional[int] = None,
+    ) -> Optional[Tuple[List[ChatHistoryResponse], Optional[ChatSummaryResponse]]]:
+        started_at = time.perf_counter()
+        key = self.key_chat_histories(chat_session_id)
+        batch_size = count if count is not None else self.READ_BATCH_SIZE
+        if token_budget is not None:
+            batch_size = min(batch_size, self.READ_BATCH_SIZE)
+        pipe = self.df.pipeline(transaction=False)
+        pipe.xrevrange(name=key, max="+", min="-", count=batch_size)
+        pipe.hgetall(name=self.key_chat_summary(chat_session_id))
+        pipe.ttl(name=key)
+        self.__queue_refresh_expiration(pipe, chat_session_id)
+        histories, summary_fields, ttl, *_ = pipe.execute()
+        self.__record('read', started_at, len(histories) > 0, ttl)
+        if not histories:
+            return None
+
+        summary = None
+        if summary_fields:
+            content = summary_fields[b"content"].decode('utf-8', errors='replace')
+            token_count = summary_fields.get(b"token_count")
+            summary = ChatSummaryResponse(
+                content=content,
+                last_chat_history_id=int(summary_fields[b"last_chat_history_id"]),
+                token_count=int(token_count) if token_count is not None else count_tokens(content),
+            )
+        chat_history_responses = take_recent_chat_histories(
+            self.__iter_recent_chat_histories(key, histories, batch_size), count, token_budget, summary,
         )
-        self.df.expire(name=key, time=60 * 60)
+        return chat_history_responses, summary
 
-    def read_chat_histories(self, chat_session_id: int) -> List[ChatHistoryResponse]:
+    # Iterate the chat history entries from the newest to the oldest, starting with the first batch 'histories',
+    # and reading the next batch only when the previous one is used up.
+    def __iter_recent_chat_histories(self, key: str, histories: list, batch_size: int) -> Iterator[ChatHistoryResponse]:
+        while True:
+            for history in histories:
+                yield self.stream_entry_to_response(history)
+            if len(histories) < batch_size:
+                return
+            # The entry IDs are '{chat history ID}-0', so the next batch ends at the previous chat history ID.
+            last_chat_history_id = int(histories[-1][0].split(b"-")[0])
+            histories = self.df.xrevrange(name=key, max=f"{last_chat_history_id - 1}", min="-", count=batch_size)
+
+    # Read up to 'limit' chat history entries with IDs in the open interval ('after_id', 'before_id').
+    # Returns None if the chat history entries are not cached.
+    def read_chat_histories_between(
+            self,
+            chat_session_id: int,
+            after_id: int,
+            before_id: int,
+            limit: int,
+    ) -> Optional[List[ChatHistoryResponse]]:
+        key = self.key_chat_histories(chat_session_id)
+        pipe = self.df.pipeline(transaction=False)
+        pipe.exists(key)
+        # The range is inclusive, and '{before_id - 1}' includes any sequence number of that ID.
+        pipe.xrange(name=key, min=f"{after_id + 1}", max=f"{before_id - 1}", count=limit)
+        exists, histories = pipe.execute()
+        if not exists:
+            return None
+        return [self.stream_entry_to_response(history) for history in histories]
+
+    def delete_legacy_chat_histories(self, chat_session_id: int) -> ():
+        self.df.delete(self.key_legacy_chat_histories(chat_session_id))
+
+    def set_chat_summary(self, chat_session_id: int, summary: ChatSummaryResponse) -> ():
+        pipe = self.df.pipeline(transaction=False)
+        self.__queue_set_chat_summary(pipe, chat_session_id, summary)
+        pipe.execute()
+
+    # The missing marker of the chat session is deleted along with the first write, in case the chat session
+    # was requested before it was created, e.g., by a client guessing the next chat ID.
+    # Returns the positions of the XADD commands in the pipeline, with their chat sessions and entries.
+    def __queue_add_chat_histories(
+            self,
+            pipe,
+            chat_session_id: int,
+            chat_histories: List[ChatHistoryResponse],
+    ) -> List[Tuple[int, int, ChatHistoryResponse]]:
         key = self.key_chat_histories(chat_session_id)
-        histories = self.df.zrange(name=key, start=0, end=-1, withscores=True)
-        return [self.chat_history_tuple_to_response(history) for history in histories]
+        queued = []
+        for history in chat_histories:
+            queued.append((len(pipe.command_stack), chat_session_id, history))
+            pipe.xadd(name=key, fields={self.ENTRY_FIELD: self.encode_chat_history(history)}, id=f"{history.id}-0")
+        pipe.delete(self.key_missing_chat_session(chat_session_id))
+        self.__queue_refresh_expiration(pipe, chat_session_id)
+        return queued
+
+    # An XADD is rejected if the stream already has an entry with the same or a larger ID. The entry may be cached
+    # already (e.g., by a concurrent load of the chat session), or it may be older than the newest cached entry
+    # (e.g., two turns of a chat session committed out of order). The chat sessions with rejected entries are merged.
+    def __execute_add(self, pipe, queued: List[Tuple[int, int, ChatHistoryResponse]]) -> ():
+        results = pipe.execute(raise_on_error=False)
+        rejected: Dict[int, List[ChatHistoryResponse]] = defaultdict(list)
+        for position, chat_session_id, history in queued:
+            result = results[position]
+            if isinstance(result, ResponseError) and "equal or smaller" in str(result):
+                rejected[chat_session_id].append(history)
+        for result in results:
+            if isinstance(result, ResponseError) and "equal or smaller" not in str(result):
+                raise result
+        for chat_session_id, chat_histories in rejected.items():
+            self.__merge_chat_histories(chat_session_id, chat_histories)
+
+    # Rewrite the cached chat history entries of a chat session in order, with the entries that are missing,
+    # since a stream entry cannot be inserted before the last one. The rewrite is a transaction on the stream key,
+    # retried if the stream changes in the meantime, so that concurrent writes are not lost.
+    # If the stream has expired in the meantime, it is not recreated, since it would be incomplete.
+    def __merge_chat_histories(self, chat_session_id: int, chat_histories: List[ChatHistoryResponse]) -> ():
+        key = self.key_chat_histories(chat_session_id)
+
+        def merge(pipe) -> bool:
+            cached = {v.id: v for v in (self.stream_entry_to_response(entry) for entry in pipe.xrange(key, "-", "+"))}
+            missing = [v for v in chat_histories if v.id not in cached]
+            if not cached or not missing:
+                return False
+            for history in missing:
+                cached[history.id] = history
+            pipe.multi()
+            pipe.delete(key)
+            for history in sorted(cached.values(), key=lambda v: v.id):
+                pipe.xadd(name=key, fields={self.ENTRY_FIELD: self.encode_chat_history(history)}, id=f"{history.id}-0")
+            pipe.expire(name=key, time=self.EXPIRATION_SECONDS)
+            return True
+
+        if self.df.transaction(merge, key, value_from_callable=True):
+            counters.incr('write_conflicts')
+
+    def __queue_set_chat_summary(self, pipe, chat_session_id: int, summary: ChatSummaryResponse) -> ():
+        key = self.key_chat_summary(chat_session_id)
+        pipe.hset(name=key, mapping={
+            "content": summary.content,
+            "last_chat_history_id": summary.last_chat_history_id,
+            "token_count": summary.token_count if summary.token_count is not None else count_tokens(summary.content),
+        })
+        pipe.expire(name=key, time=self.EXPIRATION_SECONDS)
+
+    # The chat history entries and the rolling summary (if any) of a chat session expire together.
+    # EXPIRE does nothing for a key that does not exist, so a read does not create empty keys.
+    def __queue_refresh_expiration(self, pipe, chat_session_id: int) -> ():
+        pipe.expire(name=self.key_chat_histories(chat_session_id), time=self.EXPIRATION_SECONDS)
+        pipe.expire(name=self.key_chat_summary(chat_session_id), time=self.EXPIRATION_SECONDS)
+
+    # Record the latency of a cache operation. For reads, also record hits and misses,
+    # and how long the chat session was idle before a hit (the expiration minus the remaining TTL),
+    # which shows how much of the TTL the traffic actually needs.
+    def __record(self, operation: str, started_at: float, hit: Optional[bool] = None, ttl: Optional[int] = None) -> ():
+        latency_seconds = time.perf_counter() - started_at
+        counters.incr(metrics.duration_bucket(f'{operation}_latency', latency_seconds, CACHE_LATENCY_BUCKETS_MS))
+        if hit is None:
+            return
+        counters.incr(f'{operation}_hits' if hit else f'{operation}_misses')
+        if hit and ttl is not None and ttl >= 0:
+            idle_seconds = max(self.EXPIRATION_SECONDS - ttl, 0)
+            counters.incr(metrics.bucket('idle', idle_seconds, CACHE_IDLE_BUCKETS_SECONDS, 's'))
+
+
+# Take the newest chat history entries after the rolling summary, up to 'count' entries and 'token_budget' tokens
+# (including the summary) if given. 'chat_histories' are from the newest to the oldest, and the result is in order.
+def take_recent_chat_histories(
+        chat_histories: Iterable[ChatHistoryResponse],
+        count: Optional[int],
+        token_budget: Optional[int],
+        summary: Optional[ChatSummaryResponse],
+) -> List[ChatHistoryResponse]:
+    taken = []
+    tokens = summary.token_count if summary is not None and summary.token_count is not None else 0
+    for chat_history in chat_histories:
+        if count is not None and len(taken) >= count:
+            break
+        # The older entries are covered by the summary.
+        if summary is not None and chat_history.id <= summary.last_chat_history_id:
+            break
+        if token_budget is not None:
+            # The entries cached before the token counts were added have no token count.
+            if chat_history.token_count is None:
+                chat_history.token_count = count_tokens(chat_history.content)
+            tokens += chat_history.token_count
+            if tokens > token_budget:
+                break
+        taken.append(chat_history)
+    taken.reverse()
+    return taken
@@ -0,0 +1,38 @@
+import threading
+from typing import Optional
+
+import tiktoken
+
+# The encoding of the OpenAI chat models (gpt-3.5-turbo and gpt-4).
+ENCODING_NAME = "cl100k_base"
+
+_lock = threading.Lock()
+_encoding: Optional[tiktoken.Encoding] = None
+_encoding_unavailable = False
+
+
+# Returns the number of tokens of a message content.
+#
+# The token counts are computed once per chat history entry (when it is created, or loaded from the database),
+# and cached with the entry, so the chat history is not tokenized again on each request.
+# If the encoding cannot be loaded (tiktoken downloads it on first use), the count is estimated
+# at 4 characters per token, which is close for English text.
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _get_encoding() -> Optional[tiktoken.Encoding]:
+    global _encoding, _encoding_unavailable
+    if _encoding is not None or _encoding_unavailable:
+        return _encoding
+    with _lock:
+        if _encoding is None and not _encoding_unavailable:
+            try:
+                _encoding = tiktoken.get_encoding(ENCODING_NAME)
+            except Exception as e:
+                _encoding_unavailable = True
+                print(f"Failed to load the '{ENCODING_NAME}' encoding, estimating token counts instead: {e}")
+    return _encoding
@@ -0,0 +1,246 @@
+import time
+from typing import Callable, Dict, List, Optional
+
+import msgpack
+from redis import Redis as Dragonfly
+from redis.exceptions import ResponseError
+from sqlalchemy import func, insert, or_, select, update
+from sqlalchemy.orm import Session
+
+import metrics
+import models
+
+# Chat turns waiting to be inserted into the database, consumed by 'ChatWriteBehindConsumer'.
+WRITE_BEHIND_STREAM_KEY = "chat_write_behind"
+WRITE_BEHIND_GROUP = "chat_write_behind"
+# Entries that failed 'MAX_DELIVERIES' times are moved here, to be inspected and re-added by hand.
+WRITE_BEHIND_DEAD_LETTER_STREAM_KEY = "chat_write_behind_dead_letter"
+MAX_DELIVERIES = 10
+# Entries delivered to a consumer that has not acknowledged them for this long are retried by another consumer.
+CLAIM_IDLE_MILLISECONDS = 30 * 1000
+ENTRY_FIELD = b"e"
+# Histogram buckets of the batch insert latencies.
+BATCH_LATENCY_BUCKETS_MS = (10, 100, 1000)
+
+counters = metrics.Counters('chat_write_behind')
+
+
+def key_id_sequence(model) -> str:
+    return f"{model.__tablename__}_id_sequence"
+
+
+# Enqueues the rows of chat turns to be inserted into the database later, instead of committing them in the handler.
+#
+# The IDs of the rows are allocated from sequences in Dragonfly, since the rows are inserted later,
+# and they are the idempotency keys of the inserts: a row whose ID already exists is skipped.
+# A sequence starts after the largest ID in the database, so the sequences and the stream must not be evicted,
+# i.e., do not use a Dragonfly instance in cache mode for the write-behind mode.
+class ChatWriteBehind:
+    # KEYS[1]: the ID sequence
+    # ARGV[1]: the number of IDs to allocate
+    #
+    # Returns the last allocated ID, or -1 if the sequence is not loaded.
+    __ALLOCATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+return redis.call('INCRBY', KEYS[1], ARGV[1])
+"""
+
+    def __init__(self, df: Dragonfly):
+        self.df = df
+        self.__allocate_script = df.register_script(self.__ALLOCATE_SCRIPT)
+
+    # Allocate 'count' consecutive IDs for the rows of 'model' (models.ChatSession or models.ChatHistory).
+    def allocate_ids(self, db: Session, model, count: int) -> List[int]:
+        key = key_id_sequence(model)
+        while True:
+            last_id = int(self.__allocate_script(keys=[key], args=[count]))
+            if last_id >= 0:
+                return list(range(last_id - count + 1, last_id + 1))
+            max_id = db.scalar(select(func.max(model.id)))
+            self.df.set(key, max_id or 0, nx=True)
+
+    def enqueue(
+            self,
+            chat_session: Optional[models.ChatSession],
+            chat_histories: List[models.ChatHistory],
+    ) -> ():
+        self.__xadd({
+            "chat_session": None if chat_session is None else {
+                "id": chat_session.id,
+                "llm_name": chat_session.llm_name,
+            },
+            "chat_histories": [{
+                "id": v.id,
+                "chat_session_id": v.chat_session_id,
+                "is_human_message": v.is_human_message,
+                "content": v.content,
+                "metadata_completion_tokens": v.metadata_completion_tokens,
+                "metadata_prompt_tokens": v.metadata_prompt_tokens,
+                "metadata_total_tokens": v.metadata_total_tokens,
+                "metadata_system_fingerprint": v.metadata_system_fingerprint,
+                "external_id": v.external_id,
+            } for v in chat_histories],
+        })
+
+    def enqueue_summary(self, chat_session_id: int, summary: str, last_chat_history_id: int) -> ():
+        self.__xadd({
+            "summary": {
+                "chat_session_id": chat_session_id,
+                "summary": summary,
+                "summary_last_chat_history_id": last_chat_history_id,
+            },
+        })
+
+    def __xadd(self, entry: dict) -> ():
+        self.df.xadd(WRITE_BEHIND_STREAM_KEY, {ENTRY_FIELD: msgpack.packb(entry)})
+        counters.incr('enqueued')
+
+
+def ensure_group(df: Dragonfly) -> ():
+    try:
+        df.xgroup_create(WRITE_BEHIND_STREAM_KEY, WRITE_BEHIND_GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        # The group already exists.
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+# Returns the lag of the write-behind: the entries not in the database yet, and the age of the oldest one.
+def lag(df: Dragonfly) -> dict:
+    pipe = df.pipeline(transaction=False)
+    pipe.xlen(WRITE_BEHIND_STREAM_KEY)
+    pipe.xrange(WRITE_BEHIND_STREAM_KEY, min="-", max="+", count=1)
+    pipe.xpending(WRITE_BEHIND_STREAM_KEY, WRITE_BEHIND_GROUP)
+    pipe.xlen(WRITE_BEHIND_DEAD_LETTER_STREAM_KEY)
+    unflushed, oldest, pending, dead_lettered = pipe.execute()
+    oldest_seconds = 0.0
+    if oldest:
+        # The entry ID starts with the Unix time in milliseconds of the XADD.
+        oldest_seconds = max(time.time() - int(oldest[0][0].split(b"-")[0]) / 1000, 0.0)
+    return {
+        "unflushed_entries": unflushed,
+        "pending_entries": pending["pending"],
+        "oldest_unflushed_seconds": round(oldest_seconds, 3),
+        "dead_lettered_entries": dead_lettered,
+    }
+
+
+# Inserts the enqueued chat turns into the database in batches, as a consumer of the write-behind consumer group.
+#
+# A batch is inserted in a single transaction, skipping the rows whose IDs already exist, so that a retried entry
+# is not inserted twice. If a batch fails, its entries are inserted one by one, so that a failing entry
+# does not hold back the others. The failed entries stay pending, and are retried after 'CLAIM_IDLE_MILLISECONDS'
+# by any consumer, e.g., a chat turn whose chat session is in an entry that another consumer has not inserted yet.
+# Acknowledged entries are deleted, so the stream holds only the entries that are not in the database yet.
+class ChatWriteBehindConsumer:
+    def __init__(self, df: Dragonfly, session_factory: Callable[[], Session], name: str, batch_size: int = 500):
+        self.df = df
+        self.session_factory = session_factory
+        self.name = name
+        self.batch_size = batch_size
+
+    # Insert a batch of new entries (waiting up to 'block_milliseconds' for them), and retry stale pending entries.
+    # Returns the number of entries inserted.
+    def run_once(self, block_milliseconds: int = 1000) -> int:
+        entries = self.__claim_stale_entries()
+        if not entries:
+            streams = self.df.xreadgroup(
+                WRITE_BEHIND_GROUP, self.name, {WRITE_BEHIND_STREAM_KEY: ">"},
+                count=self.batch_size, block=block_milliseconds,
+            )
+            entries = streams[0][1] if streams else []
+        if not entries:
+            return 0
+
+        started_at = time.perf_counter()
+        try:
+            self.__insert([msgpack.unpackb(fields[ENTRY_FIELD]) for _, fields in entries])
+            inserted_ids = [entry_id for entry_id, _ in entries]
+        except Exception as e:
+            counters.incr('batch_failures')
+            print(f"Failed to insert a write-behind batch, retrying the entries one by one: {e}")
+            inserted_ids = []
+            for entry_id, fields in entries:
+                try:
+                    self.__insert([msgpack.unpackb(fields[ENTRY_FIELD])])
+                    inserted_ids.append(entry_id)
+                except Exception as entry_e:
+                    counters.incr('entry_failures')
+                    print(f"Failed to insert the write-behind entry {entry_id}: {entry_e}")
+        if inserted_ids:
+            self.__ack(inserted_ids)
+        counters.incr('inserted_entries', len(inserted_ids))
+        counters.incr(metrics.duration_bucket('batch_latency', time.perf_counter() - started_at, BATCH_LATENCY_BUCKETS_MS))
+        return len(inserted_ids)
+
+    # Claim the entries that another consumer (or this one) has not acknowledged for 'CLAIM_IDLE_MILLISECONDS',
+    # and move those delivered 'MAX_DELIVERIES' times to the dead-letter stream.
+    def __claim_stale_entries(self) -> list:
+        stale = self.df.xpending_range(
+            WRITE_BEHIND_STREAM_KEY, WRITE_BEHIND_GROUP, min="-", max="+",
+            count=self.batch_size, idle=CLAIM_IDLE_MILLISECONDS,
+        )
+        if not stale:
+            return []
+        entries = self.df.xclaim(
+            WRITE_BEHIND_STREAM_KEY, WRITE_BEHIND_GROUP, self.name, CLAIM_IDLE_MILLISECONDS,
+            [v["message_id"] for v in stale],
+        )
+        deliveries: Dict[bytes, int] = {v["message_id"]: v["times_delivered"] for v in stale}
+        dead = [(entry_id, fields) for entry_id, fields in entries if deliveries.get(entry_id, 0) >= MAX_DELIVERIES]
+        if dead:
+            pipe = self.df.pipeline(transaction=False)
+            for _, fields in dead:
+                pipe.xadd(WRITE_BEHIND_DEAD_LETTER_STREAM_KEY, fields)
+            pipe.execute()
+            self.__ack([entry_id for entry_id, _ in dead])
+            counters.incr('dead_lettered_entries', len(dead))
+        counters.incr('retried_entries', len(entries) - len(dead))
+        # Deleted entries are claimed with empty fields.
+        return [(entry_id, fields) for entry_id, fields in entries
+                if fields and deliveries.get(entry_id, 0) < MAX_DELIVERIES]
+
+    def __ack(self, entry_ids: list) -> ():
+        pipe = self.df.pipeline(transaction=False)
+        pipe.xack(WRITE_BEHIND_STREAM_KEY, WRITE_BEHIND_GROUP, *entry_ids)
+        pipe.xdel(WRITE_BEHIND_STREAM_KEY, *entry_ids)
+        pipe.execute()
+
+    def __insert(self, entries: List[dict]) -> ():
+        chat_sessions = [v["chat_session"] for v in entries if v.get("chat_session")]
+        chat_histories = [h for v in entries for h in v.get("chat_histories", [])]
+        summaries = [v["summary"] for v in entries if v.get("summary")]
+        counts = {}
+        with self.session_factory() as db:
+            # Insert the chat sessions first, since the chat histories refer to them.
+            for model, rows in ((models.ChatSession, chat_sessions), (models.ChatHistory, chat_histories)):
+                if not rows:
+                    continue
+                existing_ids = set(db.scalars(select(model.id).where(model.id.in_([v["id"] for v in rows]))))
+                new_rows = [v for v in rows if v["id"] not in existing_ids]
+                if new_rows:
+                    db.execute(insert(model), new_rows)
+                counts[f'inserted_{model.__tablename__}'] = len(new_rows)
+                counts[f'skipped_{model.__tablename__}'] = len(rows) - len(new_rows)
+            # A summary never replaces a newer one, in case the entries are inserted out of order.
+            for summary in summaries:
+                result = db.execute(
+                    update(models.ChatSession)
+                    .where(models.ChatSession.id == summary["chat_session_id"])
+                    .where(or_(
+                        models.ChatSession.summary_last_chat_history_id.is_(None),
+                        models.ChatSession.summary_last_chat_history_id < summary["summary_last_chat_history_id"],
+                    ))
+                    .values(
+                        summary=summary["summary"],
+                        summary_last_chat_history_id=summary["summary_last_chat_history_id"],
+                    )
+                )
+                # Retry the entry later if its chat session is in an entry that has not been inserted yet.
+                if result.rowcount == 0 and db.get(models.ChatSession, summary["chat_session_id"]) is None:
+                    raise ValueError(f"chat session {summary['chat_session_id']} is not inserted yet")
+            db.commit()
+        for field, amount in counts.items():
+            counters.incr(field, amount)
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import random
 import string
+import time
 from datetime import date, datetime, timedelta, timezone
 from typing import Optional, Dict, Any
 
@@ -352,6 +353,22 @@ def generate_security_master_record(
     return record
 
 
+def generate_security_master_documents(start: int, end: int) -> tuple[list[tuple[str, str, str]], float]:
+    """
+    Generate the records seeded from `start` to `end` (exclusive), for the parallel loader.
+    - Each record is returned as (security_id, general_description, JSON document), without the embedding.
+    - The JSON documents are serialized here, so that the work is done in the worker processes,
+      and only strings are sent back to the loader process.
+    - Also returns the seconds spent, for the throughput report.
+    """
+    started_at = time.perf_counter()
+    documents = []
+    for seed in range(start, end):
+        rec = generate_security_master_record(seed=seed)
+        documents.append((rec.security_id, rec.security_description.general_description, rec.model_dump_json()))
+    return documents, time.perf_counter() - started_at
+
+
 # ---------------------------
 # EXAMPLE
 # ---------------------------
@@ -1,19 +1,29 @@
 from __future__ import annotations
 
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+
 import numpy as np
 from redis import Redis as Dragonfly
-from redis.commands.json.path import Path
 from redis.commands.search.field import TextField, TagField, NumericField, VectorField
 from redis.commands.search.index_definition import IndexDefinition, IndexType
 from redis.exceptions import ResponseError
-from sentence_transformers import SentenceTransformer
 
+from const import INDEX_NAME
 from dragonfly import connect_dragonfly
-from generator import generate_security_master_record
+from generator import generate_security_master_documents
 
-_transformer_model = SentenceTransformer("all-MiniLM-L6-v2")
+_transformer_model_name = "all-MiniLM-L6-v2"
 _transformer_model_dim = 384
-_df = connect_dragonfly()
+
+# The embedding is spliced into the JSON document generated without it (see `_with_embedding`).
+_EMBEDDING_PLACEHOLDER = '"security_general_description_embedding":null'
 
 
 def ensure_index(df: Dragonfly, index_name: str = "idx"):
@@ -48,37 +58,195 @@ def ensure_index(df: Dragonfly, index_name: str = "idx"):
             raise
 
 
-def main(n: int = 1000, step: int = 1000):
-    ensure_index(_df, "idx:securities")
+class _StageStats:
+    """
+    Records, bytes, and busy seconds of a pipeline stage, for the throughput report.
+    Stages running in parallel (generator processes, writer threads) add up their busy seconds,
+    which are divided by the parallelism, so that the rates are those of the whole stage.
+    """
+
+    def __init__(self, parallelism: int):
+        self.parallelism = parallelism
+        self.records = 0
+        self.bytes = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, records: int, nbytes: int, busy_seconds: float):
+        with self._lock:
+            self.records += records
+            self.bytes += nbytes
+            self.busy_seconds += busy_seconds
+
+    def report(self) -> dict:
+        seconds = self.busy_seconds / self.parallelism
+        return {
+            "records": self.records,
+            "mb": round(self.bytes / 1e6, 2),
+            "seconds": round(seconds, 3),
+            "records_per_second": round(self.records / seconds, 1) if seconds > 0 else None,
+            "mb_per_second": round(self.bytes / 1e6 / seconds, 2) if seconds > 0 else None,
+        }
+
+
+def _with_embedding(document: str, embedding: np.ndarray) -> str:
+    if _EMBEDDING_PLACEHOLDER not in document:
+        raise ValueError("the generated document has no embedding placeholder")
+    embedding_json = json.dumps(embedding.astype(np.float32).tolist())
+    return document.replace(_EMBEDDING_PLACEHOLDER, _EMBEDDING_PLACEHOLDER[:-len("null")] + embedding_json, 1)
 
-    pipeline = _df.pipeline(transaction=False)
-    batch_count = 0
 
-    for i in range(n):
-        rec = generate_security_master_record(seed=i)
-        embedding = _transformer_model.encode(rec.security_description.general_description)
-        rec.security_general_description_embedding = embedding.astype(np.float32).tolist()
+def _write_batches(
+        write_queue: queue.Queue,
+        stats: _StageStats,
+        errors: list[BaseException],
+        progress: dict,
+        progress_lock: threading.Lock,
+):
+    """
+    A writer thread: owns a connection and a pipeline, and writes each batch from `write_queue` in a single round trip.
+    After an error, the remaining batches are drained (not written), so that the producer never blocks on a full queue.
+    """
+    df = connect_dragonfly()
+    try:
+        while (batch := write_queue.get()) is not None:
+            if errors:
+                continue
+            try:
+                started_at = time.perf_counter()
+                pipeline = df.pipeline(transaction=False)
+                nbytes = 0
+                for key, document in batch:
+                    pipeline.execute_command("JSON.SET", key, "$", document)
+                    nbytes += len(document)
+                pipeline.execute()
+                stats.add(len(batch), nbytes, time.perf_counter() - started_at)
+                with progress_lock:
+                    progress["written"] += len(batch)
+                    print(f"Committed batch of {len(batch)} records ({progress['written']}/{progress['total']})")
+            except BaseException as e:
+                errors.append(e)
+    finally:
+        df.close()
+
+
+def main(
+        n: int = 1000,
+        step: int = 1000,
+        workers: int | None = None,
+        writers: int = 4,
+        encode_batch_size: int = 64,
+) -> dict:
+    """
+    Load `n` security master records into Dragonfly with a producer/consumer pipeline:
+    - Generate: `workers` processes generate and serialize the records, `step` records per task.
+    - Encode: the loader process encodes the general descriptions of each batch with SentenceTransformer,
+      `encode_batch_size` descriptions at a time.
+    - Write: `writers` threads, each with its own connection, write each batch of `step` records in a pipeline.
+    The stages run concurrently, with bounded queues in between, and the throughput of each stage is reported.
+    """
+    workers = workers or os.cpu_count() or 1
+    started_at = time.perf_counter()
+    df = connect_dragonfly()
+    ensure_index(df, INDEX_NAME)
+    df.close()
+    # Imported here, since the generator processes import this module too (as the main module), and it takes seconds.
+    from sentence_transformers import SentenceTransformer
+    transformer_model = SentenceTransformer(_transformer_model_name)
+
+    generate_stats = _StageStats(workers)
+    encode_stats = _StageStats(1)
+    write_stats = _StageStats(writers)
+    errors: list[BaseException] = []
+    progress = {"written": 0, "total": n}
+    progress_lock = threading.Lock()
+    write_queue: queue.Queue = queue.Queue(maxsize=writers * 2)
+    writer_threads = [
+        threading.Thread(
+            target=_write_batches,
+            args=(write_queue, write_stats, errors, progress, progress_lock),
+            name=f"writer-{i}",
+            daemon=True,
+        )
+        for i in range(writers)
+    ]
+    for thread in writer_threads:
+        thread.start()
+
+    # Spawn (rather than fork) the generator processes, since the loader process runs the model's threads.
+    # The generator processes import only the generator module, not the model.
+    starts = iter(range(0, n, step))
+    pending: set[Future] = set()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            while not errors:
+                # Keep the generator processes busy while the loader process encodes, without generating too far ahead.
+                while len(pending) < workers * 2 and (start := next(starts, None)) is not None:
+                    pending.add(pool.submit(generate_security_master_documents, start, min(start + step, n)))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    documents, generate_seconds = future.result()
+                    generate_stats.add(len(documents), sum(len(v[2]) for v in documents), generate_seconds)
 
-        key = f"sec:{rec.security_id}"
-        payload = rec.model_dump(mode="json")
-        pipeline.json().set(key, Path.root_path(), payload)
-        batch_count += 1
+                    encode_started_at = time.perf_counter()
+                    embeddings = transformer_model.encode(
+                        [description for _, description, _ in documents],
+                        batch_size=encode_batch_size,
+                        convert_to_numpy=True,
+                    )
+                    batch = [
+                        (f"sec:{security_id}", _with_embedding(document, embedding))
+                        for (security_id, _, document), embedding in zip(documents, embeddings)
+                    ]
+                    encode_stats.add(len(batch), embeddings.astype(np.float32).nbytes,
+                                     time.perf_counter() - encode_started_at)
+                    write_queue.put(batch)
+            for future in pending:
+                future.cancel()
+    finally:
+        for _ in writer_threads:
+            write_queue.put(None)
+        for thread in writer_threads:
+            thread.join()
+    if errors:
+        raise errors[0]
 
-        # Execute the pipeline when reaching the batch size.
-        # After pipeline execution, reset the pipeline for the next batch.
-        if batch_count >= step:
-            pipeline.execute()
-            print(f"Committed batch of {batch_count} records (up to #{i})")
-            pipeline = _df.pipeline(transaction=False)
-            batch_count = 0
+    wall_seconds = time.perf_counter() - started_at
+    report = {
+        "config": {
+            "records": n,
+            "batch_size": step,
+            "workers": workers,
+            "writers": writers,
+            "encode_batch_size": encode_batch_size,
+        },
+        "generate": generate_stats.report(),
+        "encode": encode_stats.report(),
+        "write": write_stats.report(),
+        "total": {
+            "records": write_stats.records,
+            "seconds": round(wall_seconds, 3),
+            "records_per_second": round(write_stats.records / wall_seconds, 1),
+            "mb_per_second": round(write_stats.bytes / 1e6 / wall_seconds, 2),
+        },
+    }
+    print(f"Loaded {write_stats.records} security master records into Dragonfly.")
+    print(json.dumps(report, indent=2))
+    return report
 
-    # Flush any remaining records
-    if batch_count > 0:
-        pipeline.execute()
-        print(f"Committed final batch of {batch_count} records.")
 
-    print(f"Loaded {n} security master records into Dragonfly.")
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load generated security master records into Dragonfly.")
+    parser.add_argument("--records", dest="n", type=int, default=1000, help="number of records to load")
+    parser.add_argument("--batch-size", dest="step", type=int, default=1000,
+                        help="records per generator task and per writer pipeline")
+    parser.add_argument("--workers", type=int, default=None, help="generator processes (default: CPU count)")
+    parser.add_argument("--writers", type=int, default=4, help="writer threads, each with its own connection")
+    parser.add_argument("--encode-batch-size", type=int, default=64, help="descriptions per SentenceTransformer batch")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    main(1000)
+    main(**vars(parse_args()))